@@ -0,0 +1,156 @@
+"""
+<Description>
+	An asyncio transport for the requestors in simplexorrequestor.
+
+	The threaded transport in raidpir_client.py uses one sending thread and
+	one receiving thread per mirror.   This module drives all mirror
+	connections of one or more requestors from a single event loop instead,
+	so a process can run many retrievals (or use many mirrors) at once
+	without starting two threads per connection.
+
+	Flow control is explicit: at most 'window' requests are outstanding on a
+	connection.   A new request is only sent once a reply came back.
+
+"""
+
+import sys
+
+import asyncio
+
+import socket
+
+# helper functions that are shared
+import raidpirlib as lib
+
+# the message abstraction, we use the asyncio versions
+import session
+
+# builds the request messages
+import simplexorrequestor
+
+try:
+	#for packing more complicated messages
+	import msgpack
+except ImportError:
+	print("Requires MsgPack module (http://msgpack.org/)")
+	sys.exit(1)
+
+_timer = lib._timer
+
+# default number of outstanding requests per mirror connection
+DEFAULT_WINDOW = 32
+
+
+async def _serve_mirror(rxgobj, tid, window):
+	"""private helper, runs the whole session with one mirror of a requestor"""
+
+	mirror = rxgobj.activemirrors[tid]
+	mirror.connecttime = _timer()
+
+	reader, writer = await asyncio.open_connection(mirror.info['ip'], mirror.info['port'])
+	writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	try:
+		# send the params once and check that they arrived
+		await session.sendmessage_async(writer, b"P" + msgpack.packb(mirror.params, use_bin_type=True))
+
+		if await session.recvmessage_async(reader) != b'PARAMS OK':
+			raise Exception("Params were not delivered correctly or wrong format.")
+
+		# one credit per request that may be outstanding
+		credits = asyncio.Semaphore(window)
+
+		# the sender puts a token here for every request it sent and None when
+		# it is done, so the receiver knows how many replies to wait for.
+		sentrequests = asyncio.Queue()
+
+		async def sender():
+			while True:
+				await credits.acquire()
+
+				thisrequest = rxgobj.get_next_xorrequest(tid)
+				if thisrequest == ():
+					break
+
+				await session.sendmessage_async(writer, simplexorrequestor.request_message(thisrequest))
+				sentrequests.put_nowait(True)
+
+			sentrequests.put_nowait(None)
+
+		async def receiver():
+			while await sentrequests.get() != None:
+				data = await session.recvmessage_async(reader)
+				rxgobj.notify_success(mirror, data)
+				mirror.note_reply(data)
+				credits.release()
+
+		await asyncio.gather(sender(), receiver())
+
+		if rxgobj.timing:
+			# request total computation time and measure delay
+			ping_start = _timer()
+			await session.sendmessage_async(writer, "T")
+			mirror.comptime = float((await session.recvmessage_async(reader))[1:])
+			mirror.ping = _timer() - ping_start
+
+		await session.sendmessage_async(writer, "Q")
+
+	finally:
+		writer.close()
+
+
+async def retrieve(rxgobj, window=DEFAULT_WINDOW):
+	"""
+	<Purpose>
+		Retrieves all blocks of a requestor, talking to all of its mirrors
+		concurrently.
+
+	<Arguments>
+		rxgobj: a requestor from simplexorrequestor (not connected)
+
+		window: the maximum number of outstanding requests per mirror
+
+	<Exceptions>
+		socket errors or SessionEOF if communications fail.
+
+	<Side Effects>
+		Contacts the mirrors of the requestor.   Closes the connections when done.
+
+	<Returns>
+		None. The blocks can be read with rxgobj.return_block()
+	"""
+
+	if window < 1:
+		raise ValueError("The window must allow at least one outstanding request")
+
+	await asyncio.gather(*[_serve_mirror(rxgobj, tid, window) for tid in range(len(rxgobj.activemirrors))])
+
+
+async def retrieve_all(rxgobjlist, window=DEFAULT_WINDOW):
+	"""runs the retrievals of several requestors concurrently, see retrieve()"""
+	await asyncio.gather(*[retrieve(rxgobj, window) for rxgobj in rxgobjlist])
+
+
+def run(rxgobjlist, window=DEFAULT_WINDOW):
+	"""
+	<Purpose>
+		Runs one or more retrievals concurrently in a new event loop and waits
+		until all of them finished.
+
+	<Arguments>
+		rxgobjlist: a list of requestors from simplexorrequestor (not connected)
+
+		window: the maximum number of outstanding requests per mirror
+
+	<Exceptions>
+		socket errors or SessionEOF if communications fail.
+
+	<Returns>
+		None
+	"""
+
+	loop = asyncio.new_event_loop()
+	try:
+		loop.run_until_complete(retrieve_all(rxgobjlist, window))
+	finally:
+		loop.close()
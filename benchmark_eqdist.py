@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Times the eqdist layout on a synthetic release.
+#
+# usage: python3 benchmark_eqdist.py [<blockcount> [<blocksize>]]
+#
+# The files are written to a temporary directory. With the default of 10^6
+# blocks of 64 Bytes, they need 64 MB.
+
+import sys
+
+import os
+
+import random
+
+import shutil
+
+import tempfile
+
+import time
+
+import raidpirlib as lib
+
+blockcount = 1000000
+blocksize = 64
+
+if len(sys.argv) > 1:
+	blockcount = int(sys.argv[1])
+if len(sys.argv) > 2:
+	blocksize = int(sys.argv[2])
+
+rootdir = tempfile.mkdtemp()
+
+try:
+	# files of 1 to 2000 blocks (and odd sizes), until the release is full
+	random.seed(0)
+	remainingbytes = blockcount * blocksize
+	filenum = 0
+	while remainingbytes > 0:
+		length = min(remainingbytes, random.randint(1, 2000 * blocksize))
+		with open(os.path.join(rootdir, "file%06d" % filenum), 'wb') as fd:
+			fd.write(os.urandom(length))
+		remainingbytes = remainingbytes - length
+		filenum = filenum + 1
+
+	fileinfolist = lib._generate_fileinfolist(rootdir)
+
+	start = time.perf_counter()
+	hashlist = lib.datastore_layout_function_eqdist(fileinfolist, rootdir, blocksize, "sha256-raw")
+	elapsed = time.perf_counter() - start
+
+	assert len(hashlist) == blockcount
+
+	# every block is used exactly once
+	usedblocks = set()
+	for fileinfo in fileinfolist:
+		for offset in fileinfo['offsets']:
+			usedblocks.add(offset // blocksize)
+	assert len(usedblocks) == blockcount
+
+	print("eqdist layout of", blockcount, "blocks in", filenum, "files took %f seconds" % elapsed)
+
+finally:
+	shutil.rmtree(rootdir)
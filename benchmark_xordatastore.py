@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Times the XOR scan of the RAM datastore for several bit densities and block
+# sizes.
+#
+# usage: python3 benchmark_xordatastore.py [<datastore MB> [<queries per batch>]]
+#
+# Every query selects each block with the given probability. Chunked queries
+# (-r) select only a few blocks outside of their own chunk, so low densities
+# matter as well.
+
+import sys
+
+import os
+
+import random
+
+import time
+
+import fastsimplexordatastore
+
+megabytes = 256
+numstrings = 4
+
+if len(sys.argv) > 1:
+	megabytes = int(sys.argv[1])
+if len(sys.argv) > 2:
+	numstrings = int(sys.argv[2])
+
+random.seed(0)
+
+
+def random_bitstring(blockcount, density):
+	"""returns a bitstring that selects every block with probability density"""
+	bitstring = bytearray((blockcount + 7) // 8)
+	for blocknum in random.sample(range(blockcount), int(blockcount * density)):
+		bitstring[blocknum >> 3] |= 128 >> (blocknum & 7)
+	return bytes(bitstring)
+
+
+def time_call(function, *args):
+	"""returns the fastest of three calls in milliseconds"""
+	function(*args)
+	fastest = None
+	for _ in range(3):
+		start = time.perf_counter()
+		function(*args)
+		elapsed = time.perf_counter() - start
+		if fastest == None or elapsed < fastest:
+			fastest = elapsed
+	return fastest * 1000
+
+
+print("blocksize  density  single query (ms)  " + str(numstrings) + " queries at once (ms)")
+
+for blocksize in [64, 256, 1024, 4096]:
+	blockcount = megabytes * 1024 * 1024 // blocksize
+
+	datastore = fastsimplexordatastore.XORDatastore(blocksize, blockcount, "RAM", None)
+	data = os.urandom(1024 * 1024)
+	for offset in range(0, blockcount * blocksize, len(data)):
+		datastore.set_data(offset, data)
+
+	for density in [0.5, 0.1, 0.01, 0.001]:
+		bitstrings = [random_bitstring(blockcount, density) for _ in range(numstrings)]
+
+		single = time_call(datastore.produce_xor_from_bitstring, bitstrings[0])
+		multiple = time_call(datastore.produce_xor_from_multiple_bitstrings, b''.join(bitstrings), numstrings)
+
+		print("%9d  %7.3f  %17.2f  %s" % (blocksize, density, single, ("%.2f" % multiple).rjust(19 + len(str(numstrings)))))
+
+	del datastore
@@ -0,0 +1,270 @@
+"""
+<Description>
+	Stores retrieved blocks for the RAID-PIR client: an on-disk journal and
+	an in-memory cache.
+
+	Retrieving large files can take a long time.   If the client is
+	interrupted, everything retrieved so far would be lost.   The client
+	therefore appends every block it reconstructed (and checked against the
+	manifest) to a journal file.   When the retrieval is started again, the
+	blocks in the journal are used and only the missing ones are requested.
+
+	The journal is named after the digest of the manifest, so it is never
+	used for a different release.   It is a sequence of records: the block
+	number (4 bytes, big endian) followed by the block.   A record that was
+	cut off by a crash is removed when the journal is opened.   Every block
+	is checked against the manifest again when the journal is opened.
+
+	Records are written with unbuffered writes, so they survive the client
+	process being killed.   They are not synced to disk after every block.
+
+	The cache keeps recently retrieved blocks in memory, so popular blocks
+	don't have to be retrieved again.   It can be shared by several clients
+	(also for different releases) and is bounded in size.   Blocks are
+	checked against the manifest before they are put into the cache.
+
+"""
+
+import os
+
+import threading
+
+# the cache is ordered by the last use
+import collections
+
+# helper functions that are shared
+import raidpirlib as lib
+
+# size of the block number in front of every record
+_BLOCKNUMBERBYTES = 4
+
+
+class BlockJournal(object):
+	"""
+	<Purpose>
+		Keeps retrieved blocks of one release on disk until the retrieval is
+		complete.
+
+	<Side Effects>
+		Creates, extends and removes the journal file.
+
+	<Example Use>
+		journal = BlockJournal(".", manifestdict)
+		missing = [b for b in blocklist if b not in journal]
+		...
+		journal.add(blocknum, block)
+		...
+		journal.close()
+	"""
+
+	def __init__(self, directory, manifestdict):
+		"""
+		<Purpose>
+			Opens the journal for a release, creating it if necessary.
+
+		<Arguments>
+			directory: where the journal file is kept, it is created if it does
+				not exist
+
+			manifestdict: the manifest of the release
+
+		<Exceptions>
+			OSError if the journal can't be opened.
+		"""
+		self.manifestdict = manifestdict
+		self.blocksize = manifestdict['blocksize']
+		self.recordsize = _BLOCKNUMBERBYTES + self.blocksize
+		self.filename = os.path.join(directory, lib.manifest_digest(manifestdict) + ".journal")
+
+		# block number -> offset of the block in the file
+		self.offsets = {}
+
+		# the blocks that are being written
+		self.writing = set()
+
+		self.lock = threading.Lock()
+
+		os.makedirs(directory, exist_ok=True)
+		self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600)
+		self._load()
+
+
+	def _load(self):
+		"""private helper, indexes the blocks that are in the journal"""
+		filesize = os.fstat(self.fd).st_size
+
+		# remove a record that was cut off
+		completesize = filesize - filesize % self.recordsize
+		if completesize != filesize:
+			os.ftruncate(self.fd, completesize)
+
+		for offset in range(0, completesize, self.recordsize):
+			record = os.pread(self.fd, self.recordsize, offset)
+			blocknum = int.from_bytes(record[:_BLOCKNUMBERBYTES], byteorder='big')
+			block = record[_BLOCKNUMBERBYTES:]
+
+			# ignore anything that does not match the manifest
+			if blocknum >= self.manifestdict['blockcount']:
+				continue
+			if lib.find_hash(block, self.manifestdict['hashalgorithm']) != self.manifestdict['blockhashlist'][blocknum]:
+				continue
+
+			self.offsets[blocknum] = offset + _BLOCKNUMBERBYTES
+
+		self.end = completesize
+
+
+	def __contains__(self, blocknum):
+		return blocknum in self.offsets
+
+
+	def __len__(self):
+		return len(self.offsets)
+
+
+	def get(self, blocknum):
+		"""returns a block from the journal"""
+		return os.pread(self.fd, self.blocksize, self.offsets[blocknum])
+
+
+	def add(self, blocknum, block):
+		"""
+		<Purpose>
+			Appends a checked block to the journal.   It may be called from
+			several threads.
+
+		<Arguments>
+			blocknum: the number of the block
+
+			block: the block, which must match the manifest
+
+		<Returns>
+			None
+		"""
+		# every block is written once, even if two threads add it at once
+		with self.lock:
+			if blocknum in self.offsets or blocknum in self.writing:
+				return
+
+			self.writing.add(blocknum)
+			offset = self.end
+			self.end = self.end + self.recordsize
+
+		record = blocknum.to_bytes(_BLOCKNUMBERBYTES, byteorder='big') + block
+		os.pwrite(self.fd, record, offset)
+
+		# only blocks that are completely written can be read
+		with self.lock:
+			self.writing.discard(blocknum)
+			self.offsets[blocknum] = offset + _BLOCKNUMBERBYTES
+
+
+	def close(self):
+		"""closes the journal, it is used again by the next retrieval"""
+		os.close(self.fd)
+
+
+	def remove(self):
+		"""deletes the closed journal, once all blocks are where they belong"""
+		os.remove(self.filename)
+
+
+class BlockCache(object):
+	"""
+	<Purpose>
+		A bounded least recently used cache of blocks, keyed by the digest of
+		the manifest and the block number.   It may be used from several
+		threads.
+
+	<Side Effects>
+		None.
+
+	<Example Use>
+		cache = BlockCache(64 * 1024 * 1024)
+		client = RaidPirClient(manifestdict, blockcache=cache)
+		...
+		block = cache.get(lib.manifest_digest(manifestdict), 5)
+	"""
+
+	def __init__(self, maxbytes):
+		"""
+		<Purpose>
+			Creates an empty cache.
+
+		<Arguments>
+			maxbytes: the maximum size of all blocks in the cache
+
+		<Exceptions>
+			ValueError if maxbytes is not positive.
+		"""
+		if maxbytes <= 0:
+			raise ValueError("The cache size must be positive")
+
+		self.maxbytes = maxbytes
+		self.size = 0
+
+		# (manifest digest, block number) -> block, least recently used first
+		self.blocks = collections.OrderedDict()
+
+		self.lock = threading.Lock()
+
+
+	def __len__(self):
+		return len(self.blocks)
+
+
+	def __contains__(self, key):
+		"""key is (manifest digest, block number), doesn't count as a use"""
+		return key in self.blocks
+
+
+	def get(self, manifestdigest, blocknum):
+		"""returns a cached block and marks it as used, None if it is not cached"""
+		key = (manifestdigest, blocknum)
+		with self.lock:
+			block = self.blocks.get(key)
+			if block != None:
+				self.blocks.move_to_end(key)
+			return block
+
+
+	def add(self, manifestdigest, manifestdict, blocknum, block):
+		"""
+		<Purpose>
+			Puts a block into the cache, evicting the least recently used blocks
+			if the cache is full.
+
+		<Arguments>
+			manifestdigest: the digest of the manifest (see lib.manifest_digest)
+
+			manifestdict: the manifest the block is checked against
+
+			blocknum: the number of the block
+
+			block: the block
+
+		<Exceptions>
+			ValueError if the block does not match the manifest.
+
+		<Returns>
+			None
+		"""
+		if lib.find_hash(block, manifestdict['hashalgorithm']) != manifestdict['blockhashlist'][blocknum]:
+			raise ValueError("Block " + str(blocknum) + " does not match the manifest")
+
+		# blocks that don't fit at all are not cached
+		if len(block) > self.maxbytes:
+			return
+
+		key = (manifestdigest, blocknum)
+		with self.lock:
+			if key in self.blocks:
+				self.blocks.move_to_end(key)
+				return
+
+			self.blocks[key] = bytes(block)
+			self.size = self.size + len(block)
+
+			while self.size > self.maxbytes:
+				_, evicted = self.blocks.popitem(last=False)
+				self.size = self.size - len(evicted)
@@ -0,0 +1,196 @@
+"""
+<Description>
+	A pool of open connections to RAID-PIR mirrors for the client.
+
+	Opening a connection and sending the params costs several round trips.
+	A client that does many small retrievals keeps its connections in this
+	pool instead of closing them after every retrieval.   The pool remembers
+	which params were sent on a connection, so they are only sent again when
+	they change.   Params that contain a fresh seed (-R) always change.
+
+	A connection is used by one requestor at a time.   Idle connections are
+	checked before they are handed out again: a connection the mirror closed
+	is noticed without a round trip, connections that were idle for longer
+	than the health check interval are probed with a HELLO message.
+
+"""
+
+import sys
+
+import socket
+
+import threading
+
+# helper functions that are shared
+import raidpirlib as lib
+
+import session
+
+try:
+	#for packing more complicated messages
+	import msgpack
+except ImportError:
+	print("Requires MsgPack module (http://msgpack.org/)")
+	sys.exit(1)
+
+_timer = lib._timer
+
+# idle connections older than this (in seconds) are probed before they are reused
+DEFAULT_HEALTHCHECK_INTERVAL = 10
+
+
+def _mirrorkey(mirrorinfo):
+	"""private helper, the key of a mirror in the pool"""
+	return (mirrorinfo['ip'], mirrorinfo['port'])
+
+
+class MirrorConnectionPool(object):
+	"""
+	<Purpose>
+		Keeps idle connections to mirrors open between retrievals.
+
+	<Side Effects>
+		Opens sockets to mirrors and keeps them open until close() is called.
+
+	<Example Use>
+		pool = MirrorConnectionPool()
+		sock, paramssent = pool.acquire(mirrorinfo, params)
+		# if paramssent, the mirror answers with PARAMS OK before anything else
+		...
+		pool.release(mirrorinfo, sock)
+		pool.close()
+	"""
+
+	def __init__(self, healthcheckinterval=DEFAULT_HEALTHCHECK_INTERVAL):
+		self.healthcheckinterval = healthcheckinterval
+
+		# (ip, port) -> list of idle connections. A connection is a dict with
+		# the socket, the params that were last sent on it and when it was used.
+		self._idle = {}
+
+		# the connections that are handed out, socket -> connection
+		self._busy = {}
+
+		self._lock = threading.Lock()
+
+
+	def _is_alive(self, conn):
+		"""private helper, checks that an idle connection can be reused"""
+		sock = conn['sock']
+
+		# a connection that the mirror closed is readable and returns b''. There
+		# must not be any other data either, the mirror only answers requests.
+		try:
+			sock.setblocking(False)
+			try:
+				sock.recv(1, socket.MSG_PEEK)
+				return False
+			except BlockingIOError:
+				pass
+			finally:
+				sock.setblocking(True)
+		except OSError:
+			return False
+
+		if _timer() - conn['lastused'] <= self.healthcheckinterval:
+			return True
+
+		# idle for a while, make sure the mirror still answers
+		try:
+			session.sendmessage(sock, "HELLO")
+			return session.recvmessage(sock) == b'HI!'
+		except (OSError, session.SessionEOF):
+			return False
+
+
+	def acquire(self, mirrorinfo, params):
+		"""
+		<Purpose>
+			Hands out a connection to a mirror with the given params.
+
+		<Arguments>
+			mirrorinfo: the mirror to connect to (a dict with 'ip' and 'port')
+
+			params: the params dict the requestor uses for this mirror
+
+		<Exceptions>
+			socket errors if no connection can be opened.
+
+		<Side Effects>
+			May open a new connection and send the params on it.
+
+		<Returns>
+			A tuple (socket, paramssent). If paramssent is True, the params were
+			sent and the mirror's PARAMS OK reply still has to be read.
+		"""
+
+		mirrorkey = _mirrorkey(mirrorinfo)
+
+		# take the most recently used idle connection that still works. The
+		# check may need a round trip, so it is done without holding the lock.
+		conn = None
+		while conn == None:
+			with self._lock:
+				idlelist = self._idle.get(mirrorkey, [])
+				if len(idlelist) == 0:
+					break
+				conn = idlelist.pop()
+
+			if not self._is_alive(conn):
+				conn['sock'].close()
+				conn = None
+
+		if conn == None:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			sock.connect(mirrorkey)
+			conn = {'sock': sock, 'params': None}
+
+		with self._lock:
+			self._busy[conn['sock']] = conn
+
+		if conn['params'] == params:
+			return conn['sock'], False
+
+		session.sendmessage(conn['sock'], b"P" + msgpack.packb(params, use_bin_type=True))
+		conn['params'] = dict(params)
+		return conn['sock'], True
+
+
+	def release(self, mirrorinfo, sock):
+		"""returns a connection to the pool after all replies were received"""
+		with self._lock:
+			conn = self._busy.pop(sock)
+			conn['lastused'] = _timer()
+			self._idle.setdefault(_mirrorkey(mirrorinfo), []).append(conn)
+
+
+	def discard(self, sock):
+		"""closes a handed out connection that is in an unknown state"""
+		with self._lock:
+			if self._busy.pop(sock, None) == None:
+				# not handed out (anymore)
+				return
+		sock.close()
+
+
+	def __len__(self):
+		"""the number of idle connections"""
+		with self._lock:
+			return sum([len(idlelist) for idlelist in self._idle.values()])
+
+
+	def close(self):
+		"""tells the mirrors we are done and closes all connections"""
+		with self._lock:
+			conns = [conn for idlelist in self._idle.values() for conn in idlelist] + list(self._busy.values())
+			self._idle = {}
+			self._busy = {}
+
+		for conn in conns:
+			try:
+				session.sendmessage(conn['sock'], "Q")
+			except OSError:
+				# the connection is gone already
+				pass
+			conn['sock'].close()
@@ -17,13 +17,14 @@
  */
 
 
-// This should be *waaaay* more than we would ever need
+// The table starts with this many entries and doubles when it is full
 #define STARTING_XORDATASTORE_TABLESIZE 16
 
-static int xordatastorestablesize = STARTING_XORDATASTORE_TABLESIZE;
-static int xordatastoreinited = 0;
+static int xordatastorestablesize = 0;
 
-static XORDatastore xordatastoretable[STARTING_XORDATASTORE_TABLESIZE];
+// The entries are allocated one by one, so they don't move when the table
+// grows.   The XOR workers use their entry without holding the GIL.
+static XORDatastore **xordatastoretable = NULL;
 
 
 
@@ -56,46 +57,130 @@ static inline char *dword_align(char *ptr) {
 
 // A helper function that checks to see if the table entry is used or free
 static int is_table_entry_used(int i) {
-	return (xordatastoretable[i].raw_datastore != NULL);
+	return (i >= 0 && i < xordatastorestablesize && xordatastoretable[i] != NULL);
 }
 
 
-// This allocates memory and stores the size / num_blocks for
-// error checking later
-static datastore_descriptor allocate(long block_size, long num_blocks)  {
+// Finds a free table entry and allocates it (zeroed).   If all entries are
+// used, the table grows.   Returns -1 (with a Python exception) if there is
+// not enough memory.
+static datastore_descriptor new_table_entry(void) {
 	int i;
 
-	// If it isn't inited, let's fill in the table with empty entries
-	if (!xordatastoreinited) {
-		// start the table as entry
-		for (i=0; i<STARTING_XORDATASTORE_TABLESIZE; i++) {
-			xordatastoretable[i].numberofblocks = 0;
-			xordatastoretable[i].sizeofablock = 0;
-			xordatastoretable[i].raw_datastore = NULL;
-			xordatastoretable[i].datastore = NULL;
+	for (i=0; i<xordatastorestablesize; i++) {
+		if (!is_table_entry_used(i)) {
+			break;
 		}
-		// We've initted now!
-		xordatastoreinited = 1;
 	}
 
-	for (i=0; i<xordatastorestablesize; i++) {
-		// Look for an empty entry
-		if (!is_table_entry_used(i)) {
-			xordatastoretable[i].numberofblocks = num_blocks;
-			xordatastoretable[i].sizeofablock = block_size;
+	if (i == xordatastorestablesize) {
+		int newsize = xordatastorestablesize == 0 ? STARTING_XORDATASTORE_TABLESIZE : 2 * xordatastorestablesize;
+		XORDatastore **newtable = (XORDatastore **) realloc(xordatastoretable, newsize * sizeof(XORDatastore *));
+		if (newtable == NULL) {
+			PyErr_NoMemory();
+			return -1;
+		}
+		memset(newtable + xordatastorestablesize, 0, (newsize - xordatastorestablesize) * sizeof(XORDatastore *));
+		xordatastoretable = newtable;
+		xordatastorestablesize = newsize;
+	}
+
+	xordatastoretable[i] = (XORDatastore *) calloc(1, sizeof(XORDatastore));
+	if (xordatastoretable[i] == NULL) {
+		PyErr_NoMemory();
+		return -1;
+	}
+
+	return i;
+}
+
+
+// Frees a table entry, the datastore must be released already
+static void free_table_entry(datastore_descriptor ds) {
+	free(xordatastoretable[ds]);
+	xordatastoretable[ds] = NULL;
+}
+
+
+// This allocates zeroed memory with mmap.   A full scan of the datastore
+// touches every page, so with huge pages there are 512 times fewer TLB misses.
+// HUGEPAGES_TRANSPARENT aligns the memory to 2 MiB and asks the kernel for
+// transparent huge pages (it may ignore this), HUGEPAGES_EXPLICIT takes the
+// memory from the reserved huge pages (/proc/sys/vm/nr_hugepages) and falls
+// back to transparent huge pages if there are not enough of them.
+// Returns NULL if there is not enough memory, *mappedsize is the size to unmap.
+static char *allocate_memory(size_t size, int hugepages, size_t *mappedsize) {
+	char *memory, *raw;
+
+	if (hugepages == HUGEPAGES_NONE) {
+		memory = (char *) mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+		*mappedsize = size;
+		return memory == MAP_FAILED ? NULL : memory;
+	}
 
-			// I allocate a little bit extra so that I can DWORD align it
-			xordatastoretable[i].raw_datastore = (char*) calloc(1, num_blocks * block_size + sizeof(__m128i));
+	// huge pages are used completely
+	size_t hugesize = (size + HUGEPAGESIZE - 1) / HUGEPAGESIZE * HUGEPAGESIZE;
 
-			// and align it...
-			xordatastoretable[i].datastore = (__m128i *) dword_align(xordatastoretable[i].raw_datastore);
-			return i;
+#ifdef MAP_HUGETLB
+	if (hugepages == HUGEPAGES_EXPLICIT) {
+		memory = (char *) mmap(NULL, hugesize, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS | MAP_HUGETLB, -1, 0);
+		if (memory != MAP_FAILED) {
+			*mappedsize = hugesize;
+			return memory;
 		}
+		printf("Not enough huge pages reserved, using transparent huge pages.\n");
 	}
+#endif
 
-	// The table is full! I should expand it...
-	printf("Internal Error: I need to expand the table size (unimplemented)\n");
-	return -1;
+	// map 2 MiB more than needed and cut off what is before and after the
+	// aligned part
+	raw = (char *) mmap(NULL, hugesize + HUGEPAGESIZE, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+	if (raw == MAP_FAILED) {
+		return NULL;
+	}
+
+	memory = (char *) (((uintptr_t) raw + HUGEPAGESIZE - 1) & ~((uintptr_t) HUGEPAGESIZE - 1));
+	if (memory > raw) {
+		munmap(raw, memory - raw);
+	}
+	if (raw + HUGEPAGESIZE > memory) {
+		munmap(memory + hugesize, raw + HUGEPAGESIZE - memory);
+	}
+
+#ifdef MADV_HUGEPAGE
+	madvise(memory, hugesize, MADV_HUGEPAGE);
+#endif
+
+	*mappedsize = hugesize;
+	return memory;
+}
+
+
+// This allocates memory and stores the size / num_blocks for
+// error checking later
+static datastore_descriptor allocate(long block_size, long num_blocks, int hugepages)  {
+	datastore_descriptor ds = new_table_entry();
+	if (ds < 0) {
+		return -1;
+	}
+
+	XORDatastore *xordatastore = xordatastoretable[ds];
+
+	// mmap returns page aligned memory, so it is DWORD aligned
+	xordatastore->raw_datastore = allocate_memory(num_blocks * block_size, hugepages, &xordatastore->datastoresize);
+	if (xordatastore->raw_datastore == NULL) {
+		free_table_entry(ds);
+		PyErr_NoMemory();
+		return -1;
+	}
+
+	xordatastore->numberofblocks = num_blocks;
+	xordatastore->sizeofablock = block_size;
+	xordatastore->datastore = (__m128i *) xordatastore->raw_datastore;
+	xordatastore->groups = NULL;
+	xordatastore->groupssize = 0;
+	xordatastore->hugepages = hugepages;
+	return ds;
 }
 
 
@@ -103,8 +188,9 @@ static datastore_descriptor allocate(long block_size, long num_blocks)  {
 // Python wrapper...
 static PyObject *Allocate(PyObject *module, PyObject *args) {
 	long blocksize, numblocks;
+	int hugepages = HUGEPAGES_NONE;
 
-	if (!PyArg_ParseTuple(args, "ll", &blocksize, &numblocks)) {
+	if (!PyArg_ParseTuple(args, "ll|i", &blocksize, &numblocks, &hugepages)) {
 		// Incorrect args...
 		return NULL;
 	}
@@ -114,12 +200,23 @@ static PyObject *Allocate(PyObject *module, PyObject *args) {
 		return NULL;
 	}
 
-	return Py_BuildValue("i", allocate(blocksize, numblocks));
+	if (hugepages != HUGEPAGES_NONE && hugepages != HUGEPAGES_TRANSPARENT && hugepages != HUGEPAGES_EXPLICIT) {
+		PyErr_SetString(PyExc_ValueError, "Unknown huge page setting");
+		return NULL;
+	}
+
+	datastore_descriptor ds = allocate(blocksize, numblocks, hugepages);
+	if (ds < 0) {
+		// the exception is set
+		return NULL;
+	}
+
+	return Py_BuildValue("i", ds);
 }
 
 
 // This method preprocesses the data using the 4-Russian technique
-static inline __m128i* do_preprocessing(long num_blocks, int block_size, long blocks_per_group, char* datastorebase) {
+static inline __m128i* do_preprocessing(long num_blocks, int block_size, long blocks_per_group, char* datastorebase, int hugepages, size_t *groupssize) {
 	long num_groups = num_blocks/blocks_per_group;
 	long extra_rows = num_blocks%blocks_per_group;
 
@@ -132,20 +229,16 @@ static inline __m128i* do_preprocessing(long num_blocks, int block_size, long bl
 	int dwords_per_block = block_size / sizeof(__m128i);
 
 
-	// allocate memory for the current group
-	char *raw_precomputation_buffer = (char*) calloc(
-		1, block_size*group_size*num_groups + sizeof(__m128i));
+	// allocate memory for all groups, it is page aligned
+	__m128i* precomputation_buffer = (__m128i *) allocate_memory(
+		block_size*group_size*num_groups, hugepages, groupssize);
 
-	if (raw_precomputation_buffer == NULL) {
+	if (precomputation_buffer == NULL) {
 		// not enough memory
 		printf("Could not allocate memory for precomputation. %ld MBytes needed.\n", block_size * group_size * num_groups / (1024*1024));
 		return NULL;
 	}
 
-	// align it
-	__m128i* precomputation_buffer = (__m128i *) dword_align(
-		raw_precomputation_buffer);
-
 	char* datastore_current_group = datastorebase;
 	char* current_group = (char*)precomputation_buffer;
 
@@ -181,10 +274,13 @@ static inline __m128i* do_preprocessing(long num_blocks, int block_size, long bl
 			memcpy(current_group + graycode * block_size,
 				     current_group + last_graycode * block_size, block_size);
 
-			// XOR the block represented by the change in the graycode
-			XOR_fullblocks((__m128i *) (current_group + graycode * block_size),
-									   (__m128i *) (datastore_current_group + offset*block_size),
-										 dwords_per_block);
+			// XOR the block represented by the change in the graycode, the last
+			// group has no blocks after the end of the datastore
+			if (group < num_blocks / blocks_per_group || offset < extra_rows) {
+				XOR_fullblocks((__m128i *) (current_group + graycode * block_size),
+										   (__m128i *) (datastore_current_group + offset*block_size),
+											 dwords_per_block);
+			}
 
 			// group element done
 		}
@@ -203,26 +299,55 @@ static inline __m128i* do_preprocessing(long num_blocks, int block_size, long bl
 }
 
 
-// This function needs to be fast.   It is a good candidate for releasing Python's GIL
+// Returns the first block at or after block whose bit is set in bit_string
+// (0 = MSB of the first byte), or num_blocks if there is none.   Bytes
+// without set bits are skipped at once.
+static inline long next_set_bit(const unsigned char *bit_string, long block, long num_blocks) {
+	while (block < num_blocks) {
+		// ignore the bits of the blocks before block
+		unsigned int byte = bit_string[block >> 3] & (0xff >> (block & 7));
+		if (byte != 0) {
+			block = (block & ~7L) + __builtin_clz(byte) - (8 * sizeof(unsigned int) - 8);
+			return block < num_blocks ? block : num_blocks;
+		}
+		block = (block & ~7L) + 8;
+	}
+	return num_blocks;
+}
+
+
+// Asks the CPU to load the start of a block into the cache.   The hardware
+// prefetcher follows the rest of a block once it is being read, but it can't
+// guess which block is selected next.
+static inline void prefetch_block(const char *block, int block_size) {
+	int i;
+	int bytes = block_size < PREFETCH_BYTES ? block_size : PREFETCH_BYTES;
+	for (i = 0; i < bytes; i += 64) {
+		_mm_prefetch(block + i, _MM_HINT_T0);
+	}
+}
+
+
+// This function needs to be fast.   It runs without holding Python's GIL
 
-static void multi_bitstring_xor_worker(int ds, char *bit_string, long bit_string_length, unsigned int numstrings, __m128i *resultbuffer, char use_precomputed_data) {
+static void multi_bitstring_xor_worker(XORDatastore *xordatastore, char *bit_string, long bit_string_length, unsigned int numstrings, __m128i *resultbuffer, char use_precomputed_data) {
 	long one_bit_string_length = bit_string_length / numstrings; // length of one bit string
 	long remaininglength = one_bit_string_length * 8; // convert bytes to bits
 
-	if (remaininglength > xordatastoretable[ds].numberofblocks){
-		remaininglength = xordatastoretable[ds].numberofblocks;
+	if (remaininglength > xordatastore->numberofblocks){
+		remaininglength = xordatastore->numberofblocks;
 	}
 
 	char *current_bit_string_pos;
 	current_bit_string_pos = bit_string;
 	long long offset = 0;
-	int block_size = xordatastoretable[ds].sizeofablock;
+	int block_size = xordatastore->sizeofablock;
 	char *datastorebase;
-	datastorebase = (char *) xordatastoretable[ds].datastore;
+	datastorebase = (char *) xordatastore->datastore;
 
 	int dwords_per_block = block_size / sizeof(__m128i);
 
-	long num_blocks = xordatastoretable[ds].numberofblocks;
+	long num_blocks = xordatastore->numberofblocks;
 
 
 	if (use_precomputed_data == 1) {
@@ -230,10 +355,10 @@ static void multi_bitstring_xor_worker(int ds, char *bit_string, long bit_string
 		// blocks_per_group is set to a constant number (4) to keep the memory
 		// requirements at a manageable level
 
-		__m128i* groups = xordatastoretable[ds].groups;
+		__m128i* groups = xordatastore->groups;
 
 		if (groups == NULL) {
-			printf("Error: xordatastoretable[ds].groups is NULL\n");
+			printf("Error: the data is not preprocessed\n");
 			return;
 		}
 
@@ -281,14 +406,18 @@ static void multi_bitstring_xor_worker(int ds, char *bit_string, long bit_string
 				if (group % 2 == 0) {
 					offset = ((current_bitstring_byte & 0xf0)>>4);
 
-					if (offset != 0 && offset < (1<<extra_rows)) {
+					// only the first extra_rows bits of the group are blocks
+					offset &= (0xf << (blocks_per_group - extra_rows)) & 0xf;
+					if (offset != 0) {
 						XOR_fullblocks(resultbuffer + dwords_per_block * i,
 													 (__m128i *) (current_group + offset * block_size),
 													 dwords_per_block);
 					}
 				} else {
 					offset = (current_bitstring_byte & 0x0f);
-					if (offset != 0 && offset < (1<<extra_rows)) {
+					// only the first extra_rows bits of the group are blocks
+					offset &= (0xf << (blocks_per_group - extra_rows)) & 0xf;
+					if (offset != 0) {
 						XOR_fullblocks(resultbuffer + dwords_per_block * i,
 													 (__m128i *) (current_group + offset * block_size),
 													 dwords_per_block);
@@ -299,41 +428,63 @@ static void multi_bitstring_xor_worker(int ds, char *bit_string, long bit_string
 
 
 	} else {
-		unsigned char bit = 128;
 		unsigned int i;
+		long j;
+
+		// the blocks that are selected by any of the bit strings
+		unsigned char *selected = (unsigned char *) malloc(one_bit_string_length);
+		if (selected == NULL) {
+			printf("Error: could not allocate memory for the selected blocks\n");
+			return;
+		}
+		memcpy(selected, bit_string, one_bit_string_length);
+		for(i = 1; i < numstrings; i++) {
+			for(j = 0; j < one_bit_string_length; j++) {
+				selected[j] |= bit_string[one_bit_string_length * i + j];
+			}
+		}
+
+		// prefetch the first selected blocks, from then on one block is
+		// prefetched for every block that is XORed
+		long block = next_set_bit(selected, 0, remaininglength);
+		long ahead = block;
+		for(i = 0; i < PREFETCH_DISTANCE && ahead < remaininglength; i++) {
+			prefetch_block(datastorebase + ahead * block_size, block_size);
+			ahead = next_set_bit(selected, ahead + 1, remaininglength);
+		}
 
-		// let's iterate over all bits of the bit_string
 		// each bit of the bit_string represents one PIR block
-		while (remaininglength > 0) {
+		while (block < remaininglength) {
+			if (ahead < remaininglength) {
+				prefetch_block(datastorebase + ahead * block_size, block_size);
+				ahead = next_set_bit(selected, ahead + 1, remaininglength);
+			}
 
+			unsigned char bit = 128 >> (block & 7);
 			for(i = 0; i < numstrings; i++){
-				if ( *(current_bit_string_pos + one_bit_string_length * i) & bit) {
-					XOR_fullblocks(resultbuffer + dwords_per_block * i, (__m128i *) (datastorebase + offset), dwords_per_block);
+				if (bit_string[one_bit_string_length * i + (block >> 3)] & bit) {
+					XOR_fullblocks(resultbuffer + dwords_per_block * i, (__m128i *) (datastorebase + block * block_size), dwords_per_block);
 				}
 			}
 
-			offset += block_size;
-			bit /= 2;
-			remaininglength -=1;
-			if (bit == 0) {
-				bit = 128;
-				current_bit_string_pos++;
-			}
+			block = next_set_bit(selected, block + 1, remaininglength);
 		}
+
+		free(selected);
 	}
 }
 
 
 
-// This function needs to be fast.   It is a good candidate for releasing Python's GIL
+// This function needs to be fast.   It runs without holding Python's GIL
 
-static void bitstring_xor_worker(int ds, char *bit_string, long bit_string_length, __m128i *resultbuffer, char use_precomputed_data) {
+static void bitstring_xor_worker(XORDatastore *xordatastore, char *bit_string, long bit_string_length, __m128i *resultbuffer, char use_precomputed_data) {
 	char *current_bit_string_pos = bit_string;
 	long long offset = 0;
 
-	int block_size = xordatastoretable[ds].sizeofablock;
-	char *datastorebase = (char *) xordatastoretable[ds].datastore;
-	long num_blocks = xordatastoretable[ds].numberofblocks;
+	int block_size = xordatastore->sizeofablock;
+	char *datastorebase = (char *) xordatastore->datastore;
+	long num_blocks = xordatastore->numberofblocks;
 
 	int dwords_per_block = block_size / sizeof(__m128i);
 
@@ -342,10 +493,10 @@ static void bitstring_xor_worker(int ds, char *bit_string, long bit_string_lengt
 		// blocks_per_group is set to a constant number (4) to keep the memory
 		// requirements at a manageable level
 
-		__m128i* groups = xordatastoretable[ds].groups;
+		__m128i* groups = xordatastore->groups;
 
 		if (groups == NULL) {
-			printf("Error: xordatastoretable[ds].groups is NULL\n");
+			printf("Error: the data is not preprocessed\n");
 			return;
 		}
 
@@ -354,8 +505,11 @@ static void bitstring_xor_worker(int ds, char *bit_string, long bit_string_lengt
 		long extra_rows = num_blocks%blocks_per_group;
 		// the last group may be smaller then all other groups
 
+		// the extra bits after the last block are ignored
+		long last_group_mask = 0xf;
 		if (extra_rows > 0) {
 			num_groups++;
+			last_group_mask = (0xf << (blocks_per_group - extra_rows)) & 0xf;
 		}
 
 		unsigned char current_bitstring_byte = *(current_bit_string_pos);
@@ -366,6 +520,7 @@ static void bitstring_xor_worker(int ds, char *bit_string, long bit_string_lengt
 
 			if (group % 2 == 0) {
 				offset = ((current_bitstring_byte & 0xf0)>>4);
+				if (group == num_groups - 1) offset &= last_group_mask;
 				if (offset != 0) {
 					XOR_fullblocks(resultbuffer,
 											   (__m128i *) (current_group + offset * block_size),
@@ -373,6 +528,7 @@ static void bitstring_xor_worker(int ds, char *bit_string, long bit_string_lengt
 			  }
 			} else {
 				offset = (current_bitstring_byte & 0x0f);
+				if (group == num_groups - 1) offset &= last_group_mask;
 				if (offset != 0) {
 					XOR_fullblocks(resultbuffer,
 											   (__m128i *) (current_group + offset * block_size),
@@ -388,26 +544,33 @@ static void bitstring_xor_worker(int ds, char *bit_string, long bit_string_lengt
 	} else {
 		long remaininglength = bit_string_length * 8;  // convert bytes to bits
 
-		if (remaininglength > xordatastoretable[ds].numberofblocks){
-			remaininglength = xordatastoretable[ds].numberofblocks;
+		if (remaininglength > xordatastore->numberofblocks){
+			remaininglength = xordatastore->numberofblocks;
 		}
 
-		unsigned char bit = 128;
+		unsigned char *selected = (unsigned char *) bit_string;
+		int i;
 
-		// let's iterate over all bits of the bit_string
-		while (remaininglength > 0) {
-			// each bit of the bit_string represents one PIR block
-			// if the bit is set, we XOR the block
-			if ((*current_bit_string_pos) & bit) {
-				XOR_fullblocks(resultbuffer, (__m128i *) (datastorebase + offset), dwords_per_block);
-			}
-			offset += block_size;
-			bit /= 2;
-			remaininglength -=1;
-			if (bit == 0) {
-				bit = 128;
-				current_bit_string_pos++;
+		// prefetch the first selected blocks, from then on one block is
+		// prefetched for every block that is XORed
+		long block = next_set_bit(selected, 0, remaininglength);
+		long ahead = block;
+		for(i = 0; i < PREFETCH_DISTANCE && ahead < remaininglength; i++) {
+			prefetch_block(datastorebase + ahead * block_size, block_size);
+			ahead = next_set_bit(selected, ahead + 1, remaininglength);
+		}
+
+		// each bit of the bit_string represents one PIR block
+		// if the bit is set, we XOR the block
+		while (block < remaininglength) {
+			if (ahead < remaininglength) {
+				prefetch_block(datastorebase + ahead * block_size, block_size);
+				ahead = next_set_bit(selected, ahead + 1, remaininglength);
 			}
+
+			XOR_fullblocks(resultbuffer, (__m128i *) (datastorebase + block * block_size), dwords_per_block);
+
+			block = next_set_bit(selected, block + 1, remaininglength);
 		}
 	}
 }
@@ -440,17 +603,23 @@ static PyObject *Produce_Xor_From_Bitstring(PyObject *module, PyObject *args) {
 		return NULL;
 	}
 
+	// the entry stays where it is while the GIL is released
+	XORDatastore *xordatastore = xordatastoretable[ds];
+
 	// Let's prepare a place to put the answer (1 block + alignment)
-	raw_resultbuffer = (char*) calloc(1, xordatastoretable[ds].sizeofablock + sizeof(__m128i));
+	raw_resultbuffer = (char*) calloc(1, xordatastore->sizeofablock + sizeof(__m128i));
 
 	// align it
 	resultbuffer = (__m128i *) dword_align(raw_resultbuffer);
 
-	// Let's actually calculate this!
-	bitstring_xor_worker(ds, bitstringbuffer, bitstringlength, resultbuffer, use_precomputed_data);
+	// Let's actually calculate this!   The bit string can't change and the
+	// datastore is only deallocated by its owner, so other threads may run.
+	Py_BEGIN_ALLOW_THREADS
+	bitstring_xor_worker(xordatastore, bitstringbuffer, bitstringlength, resultbuffer, use_precomputed_data);
+	Py_END_ALLOW_THREADS
 
 	// okay, let's put it in a buffer
-	PyObject *return_str_obj = Py_BuildValue("y#", (char *)resultbuffer, xordatastoretable[ds].sizeofablock);
+	PyObject *return_str_obj = Py_BuildValue("y#", (char *)resultbuffer, xordatastore->sizeofablock);
 
 	// clear the buffer
 	free(raw_resultbuffer);
@@ -483,17 +652,23 @@ static PyObject *Produce_Xor_From_Bitstrings(PyObject *module, PyObject *args) {
 		return NULL;
 	}
 
+	// the entry stays where it is while the GIL is released
+	XORDatastore *xordatastore = xordatastoretable[ds];
+
 	// Let's prepare a place to put the answer (numstrings blocks + alignment)
-	raw_resultbuffer = (char*) calloc(1, xordatastoretable[ds].sizeofablock * numstrings + sizeof(__m128i));
+	raw_resultbuffer = (char*) calloc(1, xordatastore->sizeofablock * numstrings + sizeof(__m128i));
 
 	// align it
 	resultbuffer = (__m128i *) dword_align(raw_resultbuffer);
 
-	// Let's actually calculate this!
-	multi_bitstring_xor_worker(ds, bitstringbuffer, bitstringlength, numstrings, resultbuffer, use_precomputed_data);
+	// Let's actually calculate this!   The bit string can't change and the
+	// datastore is only deallocated by its owner, so other threads may run.
+	Py_BEGIN_ALLOW_THREADS
+	multi_bitstring_xor_worker(xordatastore, bitstringbuffer, bitstringlength, numstrings, resultbuffer, use_precomputed_data);
+	Py_END_ALLOW_THREADS
 
 	// okay, let's put it in a buffer
-	PyObject *return_str_obj = Py_BuildValue("y#", (char *)resultbuffer, xordatastoretable[ds].sizeofablock * numstrings);
+	PyObject *return_str_obj = Py_BuildValue("y#", (char *)resultbuffer, xordatastore->sizeofablock * numstrings);
 
 	// clear the buffer
 	free(raw_resultbuffer);
@@ -525,12 +700,12 @@ static PyObject *SetData(PyObject *module, PyObject *args) {
 	}
 
 	// Is this outside of the bounds...
-	if (offset + quantity > xordatastoretable[ds].numberofblocks * xordatastoretable[ds].sizeofablock) {
+	if (offset + quantity > xordatastoretable[ds]->numberofblocks * xordatastoretable[ds]->sizeofablock) {
 		PyErr_SetString(PyExc_ValueError, "SetData out of bounds");
 		return NULL;
 	}
 
-	memcpy(((char *)xordatastoretable[ds].datastore)+offset, stringbuffer, quantity);
+	memcpy(((char *)xordatastoretable[ds]->datastore)+offset, stringbuffer, quantity);
 
 	return Py_BuildValue("");
 
@@ -559,12 +734,12 @@ static PyObject *GetData(PyObject *module, PyObject *args) {
 	}
 
 	// Is this outside of the bounds...
-	if (offset + quantity > xordatastoretable[ds].numberofblocks * xordatastoretable[ds].sizeofablock) {
+	if (offset + quantity > xordatastoretable[ds]->numberofblocks * xordatastoretable[ds]->sizeofablock) {
 		PyErr_SetString(PyExc_ValueError, "GetData out of bounds");
 		return NULL;
 	}
 
-	return Py_BuildValue("y#", ((char *)xordatastoretable[ds].datastore)+offset, quantity);
+	return Py_BuildValue("y#", ((char *)xordatastoretable[ds]->datastore)+offset, quantity);
 }
 
 
@@ -575,12 +750,11 @@ static void deallocate(datastore_descriptor ds){
 		printf("Error, double deallocate on %d.   Ignoring.\n",ds);
 	}
 	else {
-		free(xordatastoretable[ds].raw_datastore);
-		xordatastoretable[ds].numberofblocks = 0;
-		xordatastoretable[ds].sizeofablock = 0;
-		xordatastoretable[ds].raw_datastore = NULL;
-		xordatastoretable[ds].datastore = NULL;
-		// TODO: free raw_precomputation_buffer
+		munmap(xordatastoretable[ds]->raw_datastore, xordatastoretable[ds]->datastoresize);
+		if (xordatastoretable[ds]->groups != NULL) {
+			munmap(xordatastoretable[ds]->groups, xordatastoretable[ds]->groupssize);
+		}
+		free_table_entry(ds);
 	}
 }
 
@@ -615,15 +789,21 @@ static PyObject *DoPreprocessing(PyObject *module, PyObject *args) {
 		return NULL;
 	}
 
-	long num_blocks = xordatastoretable[ds].numberofblocks;
-	int block_size = xordatastoretable[ds].sizeofablock;
+	long num_blocks = xordatastoretable[ds]->numberofblocks;
+	int block_size = xordatastoretable[ds]->sizeofablock;
 
 	long blocks_per_group = 4; // do not change!
 
 	char *datastorebase;
-	datastorebase = (char *) xordatastoretable[ds].datastore;
+	datastorebase = (char *) xordatastoretable[ds]->datastore;
+
+	// preprocessing again replaces the precomputed data
+	if (xordatastoretable[ds]->groups != NULL) {
+		munmap(xordatastoretable[ds]->groups, xordatastoretable[ds]->groupssize);
+		xordatastoretable[ds]->groups = NULL;
+	}
 
-	xordatastoretable[ds].groups = do_preprocessing(num_blocks, block_size, blocks_per_group, datastorebase);
+	xordatastoretable[ds]->groups = do_preprocessing(num_blocks, block_size, blocks_per_group, datastorebase, xordatastoretable[ds]->hugepages, &xordatastoretable[ds]->groupssize);
 
 	return Py_BuildValue("");
 }
@@ -724,6 +904,104 @@ static PyObject *do_xor(PyObject *module, PyObject *args) {
 
 }
 
+// XORs the count strings in data into dest in a single pass. The strings may
+// have any alignment, every 16 byte piece of dest is written only once.
+static void XOR_multiple(char *dest, const char **data, Py_ssize_t count, Py_ssize_t stringlength) {
+	Py_ssize_t pos, i;
+	__m128i acc;
+	char lastbytes;
+
+	for (pos = 0; pos + (Py_ssize_t) sizeof(__m128i) <= stringlength; pos += sizeof(__m128i)) {
+		acc = _mm_loadu_si128((const __m128i *) (data[0] + pos));
+		for (i = 1; i < count; i++) {
+			acc = _mm_xor_si128(acc, _mm_loadu_si128((const __m128i *) (data[i] + pos)));
+		}
+		_mm_storeu_si128((__m128i *) (dest + pos), acc);
+	}
+
+	// XOR anything left over at the end...
+	for (; pos < stringlength; pos++) {
+		lastbytes = data[0][pos];
+		for (i = 1; i < count; i++) {
+			lastbytes ^= data[i][pos];
+		}
+		dest[pos] = lastbytes;
+	}
+}
+
+
+// XORs a list of equal length strings into one new string. The client uses
+// this to reconstruct a block from the replies of all k mirrors at once.
+static PyObject *do_xor_multiple(PyObject *module, PyObject *args) {
+	PyObject *stringlist;
+	PyObject *stringseq;
+	PyObject *return_str_obj;
+	const char **data;
+	Py_ssize_t count, length, i;
+
+	// Parse the calling arguments
+	if (!PyArg_ParseTuple(args, "O", &stringlist)) {
+		return NULL;
+	}
+
+	stringseq = PySequence_Fast(stringlist, "do_xor_multiple requires a sequence of bytes");
+	if (stringseq == NULL) {
+		return NULL;
+	}
+
+	count = PySequence_Fast_GET_SIZE(stringseq);
+	if (count < 1) {
+		Py_DECREF(stringseq);
+		PyErr_SetString(PyExc_ValueError, "do_xor_multiple requires at least one string");
+		return NULL;
+	}
+
+	data = (const char **) malloc(count * sizeof(char *));
+	if (data == NULL) {
+		Py_DECREF(stringseq);
+		return PyErr_NoMemory();
+	}
+
+	length = -1;
+	for (i = 0; i < count; i++) {
+		PyObject *item = PySequence_Fast_GET_ITEM(stringseq, i);
+
+		if (!PyBytes_Check(item)) {
+			free(data);
+			Py_DECREF(stringseq);
+			PyErr_SetString(PyExc_TypeError, "do_xor_multiple must be called with bytes");
+			return NULL;
+		}
+
+		if (length == -1) {
+			length = PyBytes_GET_SIZE(item);
+		} else if (PyBytes_GET_SIZE(item) != length) {
+			free(data);
+			Py_DECREF(stringseq);
+			PyErr_SetString(PyExc_ValueError, "do_xor_multiple requires strings of the same length");
+			return NULL;
+		}
+
+		data[i] = PyBytes_AS_STRING(item);
+	}
+
+	// the result is written directly into the new bytes object
+	return_str_obj = PyBytes_FromStringAndSize(NULL, length);
+	if (return_str_obj != NULL) {
+		char *dest = PyBytes_AS_STRING(return_str_obj);
+
+		// the strings can't change, other threads may run meanwhile
+		Py_BEGIN_ALLOW_THREADS
+		XOR_multiple(dest, data, count, length);
+		Py_END_ALLOW_THREADS
+	}
+
+	free(data);
+	Py_DECREF(stringseq);
+
+	return return_str_obj;
+}
+
 static PyMethodDef FastSimpleXORDatastoreMethods [] = {
 	{"Allocate", Allocate, METH_VARARGS, "Allocate a datastore."},
 	{"Deallocate", Deallocate, METH_VARARGS, "Deallocate a datastore."},
@@ -733,6 +1011,7 @@ static PyMethodDef FastSimpleXORDatastoreMethods [] = {
 	{"Produce_Xor_From_Bitstring", Produce_Xor_From_Bitstring, METH_VARARGS, "Extract XOR from datastore."},
 	{"Produce_Xor_From_Bitstrings", Produce_Xor_From_Bitstrings, METH_VARARGS, "Extract XORs from datastore."},
 	{"do_xor", do_xor, METH_VARARGS, "does the XOR of two equal length strings."},
+	{"do_xor_multiple", do_xor_multiple, METH_VARARGS, "does the XOR of a list of equal length strings."},
 	{NULL, NULL, 0, NULL}
 };
 
@@ -7,6 +7,19 @@
 #include "Python.h"
 #include <stdint.h>
 #include <emmintrin.h>
+#include <sys/mman.h>
+
+// How the datastore and the precomputed data are backed (see allocate_memory)
+#define HUGEPAGES_NONE 0
+#define HUGEPAGES_TRANSPARENT 1
+#define HUGEPAGES_EXPLICIT 2
+
+#define HUGEPAGESIZE (2 * 1024 * 1024)
+
+// The XOR loops prefetch the blocks this many selected blocks ahead...
+#define PREFETCH_DISTANCE 8
+// ... and at most this many bytes of each of them
+#define PREFETCH_BYTES 256
 
 
 typedef int datastore_descriptor;
@@ -14,9 +27,12 @@ typedef int datastore_descriptor;
 typedef struct {
 	long numberofblocks;  // Blocks in the datastore
 	long sizeofablock;    // Bytes in a block.
-	char *raw_datastore;  // This points to what malloc returns...
+	char *raw_datastore;  // This points to what mmap returns...
+	size_t datastoresize; // ... and this is its size
 	__m128i *datastore;   // This is the DWORD aligned start to the datastore
 	__m128i *groups;      // This is the DWORD aligned start to the precomputed data
+	size_t groupssize;    // The size of the precomputed data
+	int hugepages;        // HUGEPAGES_*, for the datastore and the precomputed data
 } XORDatastore;
 
 // Define all of the functions...
@@ -25,11 +41,16 @@ static inline void XOR_fullblocks(__m128i *dest, const __m128i *data, Py_ssize_t
 static inline void XOR_byteblocks(char *dest, const char *data, Py_ssize_t count);
 static inline char *dword_align(char *ptr);
 static int is_table_entry_used(int i);
-static datastore_descriptor allocate(long block_size, long num_blocks);
+static datastore_descriptor new_table_entry(void);
+static void free_table_entry(datastore_descriptor ds);
+static char *allocate_memory(size_t size, int hugepages, size_t *mappedsize);
+static datastore_descriptor allocate(long block_size, long num_blocks, int hugepages);
 static PyObject *Allocate(PyObject *module, PyObject *args);
-static inline __m128i* do_preprocessing(long num_blocks, int block_size, long blocks_per_group, char* datastorebase);
-static void bitstring_xor_worker(int ds, char *bit_string, long bit_string_length, __m128i *resultbuffer, char use_precomputed_data);
-static void multi_bitstring_xor_worker(int ds, char *bit_string, long bit_string_length, unsigned int num_bitstrings, __m128i *resultbuffer, char use_precomputed_data);
+static inline __m128i* do_preprocessing(long num_blocks, int block_size, long blocks_per_group, char* datastorebase, int hugepages, size_t *groupssize);
+static inline long next_set_bit(const unsigned char *bit_string, long block, long num_blocks);
+static inline void prefetch_block(const char *block, int block_size);
+static void bitstring_xor_worker(XORDatastore *xordatastore, char *bit_string, long bit_string_length, __m128i *resultbuffer, char use_precomputed_data);
+static void multi_bitstring_xor_worker(XORDatastore *xordatastore, char *bit_string, long bit_string_length, unsigned int num_bitstrings, __m128i *resultbuffer, char use_precomputed_data);
 static PyObject *Produce_Xor_From_Bitstring(PyObject *module, PyObject *args);
 static PyObject *Produce_Xor_From_Bitstrings(PyObject *module, PyObject *args);
 static PyObject *SetData(PyObject *module, PyObject *args);
@@ -17,6 +17,21 @@
 import fastsimplexordatastore_c
 import mmapxordatastore_c
 import math
+import os
+import concurrent.futures
+
+# how the RAM datastore and the precomputed data are backed, see
+# allocate_memory in fastsimplexordatastore.c
+HUGEPAGES = {'none': 0, 'transparent': 1, 'explicit': 2}
+
+# hints for mapping a database file, see mmapxordatastore.h
+MMAPADVICE = {'populate': 1, 'sequential': 2, 'willneed': 4, 'hugepage': 8}
+
+# where Linux describes the NUMA nodes
+_NUMA_NODEDIR = "/sys/devices/system/node"
+
+# the shards are placed on their node by writing zeros in pieces of this size
+_TOUCH_SIZE = 4 * 1024 * 1024
 
 
 def do_xor(bytes_a, bytes_b):
@@ -30,6 +45,62 @@ def do_xor(bytes_a, bytes_b):
 	return fastsimplexordatastore_c.do_xor(bytes_a, bytes_b)
 
 
+def do_xor_multiple(byteslist):
+	"""XORs a list of equal length byte strings in a single pass. The C
+	extension checks the types and lengths."""
+	return fastsimplexordatastore_c.do_xor_multiple(byteslist)
+
+
+def _parse_cpulist(cpulist):
+	"""private helper, turns a list like '0-3,8,10-11' into a set of CPUs"""
+	cpus = set()
+	for cpurange in cpulist.strip().split(','):
+		if not cpurange:
+			continue
+		if '-' in cpurange:
+			first, last = cpurange.split('-')
+			cpus.update(range(int(first), int(last) + 1))
+		else:
+			cpus.add(int(cpurange))
+	return cpus
+
+
+def numa_nodes():
+	"""
+	<Purpose>
+		Finds the NUMA nodes of this machine.
+
+	<Arguments>
+		None
+
+	<Exceptions>
+		None
+
+	<Returns>
+		A list with the set of CPUs of every node, only the CPUs this process
+		may run on are included.   Nodes without such CPUs are left out.   If
+		the nodes are unknown, the list has a single set with all CPUs.
+	"""
+	allowed = os.sched_getaffinity(0)
+
+	try:
+		nodenames = [name for name in os.listdir(_NUMA_NODEDIR) if name.startswith("node") and name[4:].isdigit()]
+	except OSError:
+		nodenames = []
+
+	nodes = []
+	for nodename in sorted(nodenames, key=lambda name: int(name[4:])):
+		with open(os.path.join(_NUMA_NODEDIR, nodename, "cpulist")) as cpulistfo:
+			cpus = _parse_cpulist(cpulistfo.read()) & allowed
+		if cpus:
+			nodes.append(cpus)
+
+	if not nodes:
+		nodes.append(allowed)
+
+	return nodes
+
+
 class XORDatastore(object):
 	"""
 	<Purpose>
@@ -53,7 +124,7 @@ class XORDatastore(object):
 	dstype = ""
 	use_precomputed_data = 0
 
-	def __init__(self, block_size, num_blocks, dstype, dbname, use_precomputed_data=False):  # allocate
+	def __init__(self, block_size, num_blocks, dstype, dbname, use_precomputed_data=False, hugepages='none', mmapadvice=()):  # allocate
 		"""
 		<Purpose>
 			Allocate a place to store data for efficient XOR.
@@ -64,6 +135,9 @@ class XORDatastore(object):
 
 			num_blocks: the number of blocks.   This must be a positive integer
 			use_precomputed_data: Use the precomputed 4R data
+			hugepages: one of HUGEPAGES, backs the RAM datastore and the
+									precomputed data with huge pages
+			mmapadvice: some of MMAPADVICE, hints for mapping the database file
 
 		<Exceptions>
 			TypeError is raised if invalid parameters are given.
@@ -86,16 +160,25 @@ class XORDatastore(object):
 			raise TypeError("Number of blocks must be positive")
 
 
+		if hugepages not in HUGEPAGES:
+			raise TypeError("Huge pages must be one of " + ", ".join(HUGEPAGES))
+
+		mmapflags = 0
+		for advice in mmapadvice:
+			if advice not in MMAPADVICE:
+				raise TypeError("Unknown mmap advice '" + advice + "'")
+			mmapflags = mmapflags | MMAPADVICE[advice]
+
 		self.numberofblocks = num_blocks
 		self.sizeofblocks = block_size #in byte
 		self.use_precomputed_data = int(use_precomputed_data)
 		self.dstype = dstype
 
 		if dstype == "mmap":
-			self.ds = mmapxordatastore_c.Initialize(block_size, num_blocks, dbname)
+			self.ds = mmapxordatastore_c.Initialize(block_size, num_blocks, dbname, mmapflags)
 			self.dsobj = mmapxordatastore_c
 		else: # RAM
-			self.ds = fastsimplexordatastore_c.Allocate(block_size, num_blocks)
+			self.ds = fastsimplexordatastore_c.Allocate(block_size, num_blocks, HUGEPAGES[hugepages])
 			self.dsobj = fastsimplexordatastore_c
 
 
@@ -256,3 +339,289 @@ class XORDatastore(object):
 		# if there is an error, this might be an uninitialized object...
 		if self.ds != None:
 			self.dsobj.Deallocate(self.ds)
+
+
+class ShardedXORDatastore(object):
+	"""
+	<Purpose>
+		A RAM datastore that is split into one shard per NUMA node.   Every
+		shard is an XORDatastore of consecutive blocks.   Its memory (and its
+		precomputed data) is placed on its node, and it is only scanned by
+		threads that run on the CPUs of that node.   A query is scanned by all
+		shards at the same time and the partial results are XORed.
+
+		It has the same interface as an XORDatastore in RAM.
+
+	<Side Effects>
+		Starts a pool of threads for every node.
+
+	<Example Use>
+		datastore = ShardedXORDatastore(1024, 100000, numa_nodes())
+		datastore.set_data(0, data)
+		datastore.finalize()
+		xoredblock = datastore.produce_xor_from_bitstring(bitstring)
+
+	"""
+
+	# these are public so that a caller can read information about a created
+	# datastore.   They should not be changed.
+	numberofblocks = None
+	sizeofblocks = None
+	dstype = "RAM"
+	use_precomputed_data = 0
+
+	def __init__(self, block_size, num_blocks, nodes, use_precomputed_data=False, hugepages='none'):
+		"""
+		<Purpose>
+			Allocates the shards on their nodes.
+
+		<Arguments>
+			block_size: the size of each block, a positive multiple of 64
+
+			num_blocks: the number of blocks, a positive integer
+
+			nodes: a list with a set of CPUs for every node (see numa_nodes)
+
+			use_precomputed_data: Use the precomputed 4R data
+
+			hugepages: one of HUGEPAGES, backs the shards and the precomputed
+									data with huge pages
+
+		<Exceptions>
+			TypeError is raised if invalid parameters are given.
+
+		"""
+		if not nodes:
+			raise TypeError("At least one node is needed")
+
+		if type(num_blocks) != int or num_blocks <= 0:
+			raise TypeError("Number of blocks must be a positive integer")
+
+		self.numberofblocks = num_blocks
+		self.sizeofblocks = block_size
+		self.use_precomputed_data = int(use_precomputed_data)
+
+		# every shard starts at a byte of the bit strings
+		blocks_per_shard = math.ceil(num_blocks / len(nodes) / 8.0) * 8
+
+		# (first block, datastore, pool of threads on the node)
+		self.shards = []
+
+		try:
+			for nodenum, cpus in enumerate(nodes):
+				firstblock = nodenum * blocks_per_shard
+				if firstblock >= num_blocks:
+					break
+				shard_blocks = min(blocks_per_shard, num_blocks - firstblock)
+
+				pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(cpus),
+					thread_name_prefix="RAID-PIR node " + str(nodenum),
+					initializer=os.sched_setaffinity, initargs=(0, cpus))
+
+				# Linux places a page on the node of the thread that writes it first
+				try:
+					datastore = pool.submit(self._allocate_shard, block_size, shard_blocks, use_precomputed_data, hugepages).result()
+				except:
+					pool.shutdown()
+					raise
+
+				self.shards.append((firstblock, datastore, pool))
+
+		except:
+			self.close()
+			raise
+
+
+	@staticmethod
+	def _allocate_shard(block_size, num_blocks, use_precomputed_data, hugepages):
+		"""private helper, creates a shard and writes all of its pages"""
+		datastore = XORDatastore(block_size, num_blocks, "RAM", None, use_precomputed_data, hugepages)
+
+		size = block_size * num_blocks
+		zeros = bytes(min(size, _TOUCH_SIZE))
+		for offset in range(0, size, _TOUCH_SIZE):
+			datastore.set_data(offset, zeros[:size - offset])
+
+		return datastore
+
+
+	def _bitstring_slices(self, bitstring, num_strings):
+		"""private helper, cuts the bit strings into the pieces of the shards"""
+		bitstringlength = len(bitstring) // num_strings
+		slices = []
+		for firstblock, datastore, _ in self.shards:
+			start = firstblock // 8
+			end = start + math.ceil(datastore.numberofblocks / 8.0)
+			slices.append(b"".join(bitstring[i * bitstringlength + start:i * bitstringlength + end] for i in range(num_strings)))
+		return slices
+
+
+	def _xor_shards(self, bitstring, num_strings):
+		"""private helper, scans all shards and XORs their results"""
+		futures = []
+		for (_, datastore, pool), shardbitstring in zip(self.shards, self._bitstring_slices(bitstring, num_strings)):
+			if num_strings == 1:
+				futures.append(pool.submit(datastore.produce_xor_from_bitstring, shardbitstring))
+			else:
+				futures.append(pool.submit(datastore.produce_xor_from_multiple_bitstrings, shardbitstring, num_strings))
+
+		results = [future.result() for future in futures]
+		if len(results) == 1:
+			return results[0]
+		return do_xor_multiple(results)
+
+
+	def produce_xor_from_bitstring(self, bitstring):
+		"""
+		<Purpose>
+			Returns an XORed block, see XORDatastore.produce_xor_from_bitstring
+
+		<Arguments>
+			bitstring: bytes that indicates what to XOR.
+
+		<Exceptions>
+			TypeError is raised if the bitstring is invalid
+
+		<Returns>
+			The XORed block.
+
+		"""
+		if type(bitstring) != bytes:
+			raise TypeError("bitstring must be of type bytes")
+
+		if len(bitstring) != math.ceil(self.numberofblocks/8.0):
+			raise TypeError("bitstring is not of the correct length")
+
+		return self._xor_shards(bitstring, 1)
+
+
+	def produce_xor_from_multiple_bitstrings(self, bitstring, num_strings):
+		"""
+		<Purpose>
+			Returns multiple XORed blocks, see
+			XORDatastore.produce_xor_from_multiple_bitstrings
+
+		<Arguments>
+			bitstring: concatenated string of bits that indicates what to XOR.
+
+			num_strings: the number of requests in bitstring
+
+		<Exceptions>
+			TypeError is raised if the bitstring is invalid
+
+		<Returns>
+			The XORed blocks.
+
+		"""
+		if type(bitstring) != bytes:
+			raise TypeError("bitstring must be of type bytes")
+
+		if len(bitstring) != math.ceil(self.numberofblocks / 8.0)*num_strings :
+			raise TypeError("bitstring is not of the correct length")
+
+		return self._xor_shards(bitstring, num_strings)
+
+
+	def _shard_pieces(self, offset, quantity):
+		"""private helper, yields (datastore, offset in the shard, start, end) for
+		the shards that the bytes from offset to offset + quantity are in"""
+		for firstblock, datastore, _ in self.shards:
+			shardstart = firstblock * self.sizeofblocks
+			shardend = shardstart + datastore.numberofblocks * self.sizeofblocks
+			start = max(offset, shardstart)
+			end = min(offset + quantity, shardend)
+			if start < end:
+				yield datastore, start - shardstart, start - offset, end - offset
+
+
+	def set_data(self, offset, data_to_add):
+		"""
+		<Purpose>
+			Sets the raw data, see XORDatastore.set_data.   The pages are already
+			on their node, so this is done by the calling thread.
+
+		<Arguments>
+			offset: a non-negative integer
+
+			data_to_add: the bytes that should be added
+
+		<Exceptions>
+			TypeError if the arguments are the wrong type or have invalid values.
+
+		<Returns>
+			None
+
+		"""
+		if type(data_to_add) != bytes:
+			raise TypeError("Data_to_add to XORdatastore must be bytes.")
+
+		if type(offset) != int or offset < 0:
+			raise TypeError("Offset must be a non-negative integer")
+
+		if offset + len(data_to_add) > self.numberofblocks * self.sizeofblocks:
+			raise TypeError("Offset + added data overflows the XORdatastore")
+
+		for datastore, shardoffset, start, end in self._shard_pieces(offset, len(data_to_add)):
+			if start == 0 and end == len(data_to_add):
+				datastore.set_data(shardoffset, data_to_add)
+			else:
+				datastore.set_data(shardoffset, data_to_add[start:end])
+
+
+	def get_data(self, offset, quantity):
+		"""
+		<Purpose>
+			Returns raw data, see XORDatastore.get_data
+
+		<Arguments>
+			offset: a non-negative integer
+
+			quantity: a positive integer
+
+		<Exceptions>
+			TypeError if the arguments are the wrong type or have invalid values.
+
+		<Returns>
+			A string containing the data.
+
+		"""
+		if type(offset) != int or offset < 0:
+			raise TypeError("Offset must be a non-negative integer")
+
+		if type(quantity) != int or quantity <= 0:
+			raise TypeError("Quantity must be a positive integer")
+
+		if offset + quantity > self.numberofblocks * self.sizeofblocks:
+			raise TypeError("Quantity + offset is larger than XORdatastore")
+
+		pieces = [datastore.get_data(shardoffset, end - start) for datastore, shardoffset, start, end in self._shard_pieces(offset, quantity)]
+		if len(pieces) == 1:
+			return pieces[0]
+		return b"".join(pieces)
+
+
+	def finalize(self):
+		"""
+		<Purpose>
+			Does the preprocessing of all shards at the same time, each on its
+			own node
+
+		<Arguments>
+			None
+
+		<Exceptions>
+			None
+
+		<Returns>
+			None
+
+		"""
+		futures = [pool.submit(datastore.finalize) for _, datastore, pool in self.shards]
+		for future in futures:
+			future.result()
+
+
+	def close(self):
+		"""stops the threads, the shards are deallocated with this object"""
+		for _, _, pool in self.shards:
+			pool.shutdown()
@@ -0,0 +1,275 @@
+"""
+<Description>
+	Latency- and load-aware mirror selection for the RAID-PIR client.
+
+	The client keeps statistics about every mirror it talked to: how long it
+	took until the first reply arrived (connection setup plus one request),
+	the throughput of the replies and how often the mirror failed.   The
+	statistics are smoothed over many retrievals and can be stored in a file,
+	so they survive between runs.   Mirrors additionally advertise their load
+	(open connections and answered requests per second) with their
+	mirrorinfo, which the vendor passes on unchanged.
+
+	From this, every mirror gets a cost: its expected latency, scaled up by
+	its load and its recent failures.   A selection policy then orders the
+	mirrors.   The requestors use the first k of them and keep the rest as
+	backups.
+
+	The load is reported by the mirrors themselves and nobody checks it.   A
+	mirror that advertises little load is picked more often by the weighted
+	and best policies, so colluding mirrors could lie to be chosen together.
+	These policies therefore assume that the mirrors report honestly, on top
+	of the usual assumption that the k chosen mirrors don't collude.   The
+	default policy (random) ignores the statistics and makes no such
+	assumption.
+
+"""
+
+import sys
+
+import os
+
+import random
+
+import tempfile
+
+# to timestamp the statistics
+import time
+
+try:
+	# for packing more complicated messages
+	import msgpack
+except ImportError:
+	print("Requires MsgPack module (http://msgpack.org/)")
+	sys.exit(1)
+
+# the selection policies
+#   random:   uniformly random, ignores the statistics (the original behavior)
+#   weighted: random, but the chance of a mirror is inversely proportional to its cost
+#   best:     the mirrors with the lowest cost
+POLICIES = ['random', 'weighted', 'best']
+DEFAULT_POLICY = 'random'
+
+# weight of a new measurement in the moving averages
+SMOOTHING = 0.3
+
+# the latency (in seconds) assumed for a mirror nobody measured yet, if
+# there are no measurements of other mirrors either
+DEFAULT_LATENCY = 0.1
+
+# every open connection on a mirror adds this fraction to its cost
+CONNECTION_COST = 0.1
+
+# every answered request per second on a mirror adds this fraction to its cost
+REQUESTRATE_COST = 0.001
+
+
+def _mirrorkey(mirrorinfo):
+	"""private helper, the key of a mirror in the statistics"""
+	return mirrorinfo['ip'] + ":" + str(mirrorinfo['port'])
+
+
+def _smooth(old, new):
+	"""private helper, exponentially weighted moving average"""
+	if old == None:
+		return new
+	return (1 - SMOOTHING) * old + SMOOTHING * new
+
+
+class MirrorStats(object):
+	"""
+	<Purpose>
+		Statistics about the mirrors, optionally stored in a file.
+
+	<Side Effects>
+		Reads and writes the statistics file, if there is one.
+
+	<Example Use>
+		stats = MirrorStats("mirrorstats.dat")
+		orderedmirrors = select_mirrors(mirrorinfolist, stats, 'weighted')
+		...
+		stats.record(mirrorinfo, 0.02, 1000000)
+		stats.save()
+	"""
+
+	def __init__(self, filename=None):
+		"""
+		<Purpose>
+			Loads the statistics.
+
+		<Arguments>
+			filename: the file the statistics are stored in, None to keep them
+				in memory only.   A missing or unreadable file starts empty.
+		"""
+		self.filename = filename
+
+		# mirror key -> {'latency': seconds, 'throughput': bytes per second or
+		# None, 'failures': smoothed failure count, 'updated': time}
+		self.mirrors = {}
+
+		if filename != None and os.path.exists(filename):
+			try:
+				with open(filename, 'rb') as fd:
+					self.mirrors = msgpack.unpackb(fd.read(), raw=False)
+			except (ValueError, msgpack.exceptions.UnpackException):
+				# statistics are only hints, start over
+				self.mirrors = {}
+
+			if type(self.mirrors) != dict:
+				self.mirrors = {}
+
+
+	def record(self, mirrorinfo, latency, throughput):
+		"""
+		<Purpose>
+			Adds a measurement of a successful retrieval.
+
+		<Arguments>
+			mirrorinfo: the mirror that was measured
+
+			latency: the time (in seconds) until its first reply arrived
+
+			throughput: the bytes per second it delivered, None if unknown
+
+		<Returns>
+			None
+		"""
+		entry = self.mirrors.setdefault(_mirrorkey(mirrorinfo), {'latency': None, 'throughput': None, 'failures': 0})
+
+		entry['latency'] = _smooth(entry['latency'], latency)
+		if throughput != None:
+			entry['throughput'] = _smooth(entry['throughput'], throughput)
+		entry['failures'] = _smooth(entry['failures'], 0)
+		entry['updated'] = time.time()
+
+
+	def record_failure(self, mirrorinfo):
+		"""notes that a mirror failed or was too slow to be used"""
+		entry = self.mirrors.setdefault(_mirrorkey(mirrorinfo), {'latency': None, 'throughput': None, 'failures': 0})
+
+		entry['failures'] = _smooth(entry['failures'], 1)
+		entry['updated'] = time.time()
+
+
+	def cost(self, mirrorinfo):
+		"""
+		<Purpose>
+			Estimates how expensive it is to use a mirror.   Lower is better.
+
+		<Arguments>
+			mirrorinfo: the mirror as advertised by the vendor (possibly with 'load')
+
+		<Returns>
+			A positive float, roughly the expected latency in seconds
+		"""
+		entry = self.mirrors.get(_mirrorkey(mirrorinfo))
+
+		if entry != None and entry['latency'] != None:
+			latency = entry['latency']
+		else:
+			# unknown mirrors are assumed to be typical, so they get tried
+			latency = self._typical_latency()
+
+		cost = max(latency, 1e-6)
+
+		load = mirrorinfo.get('load')
+		if type(load) == dict:
+			cost = cost * (1 + CONNECTION_COST * load.get('connections', 0) + REQUESTRATE_COST * load.get('requestrate', 0))
+
+		if entry != None:
+			# a mirror that fails half of the time costs about twice as much
+			cost = cost * (1 + 2 * entry['failures'])
+
+		return cost
+
+
+	def _typical_latency(self):
+		"""private helper, the median latency of all measured mirrors"""
+		latencies = sorted([entry['latency'] for entry in self.mirrors.values() if entry['latency'] != None])
+		if len(latencies) == 0:
+			return DEFAULT_LATENCY
+		return latencies[len(latencies) // 2]
+
+
+	def update(self, mirrorstatlist):
+		"""
+		<Purpose>
+			Adds the measurements of a retrieval.
+
+		<Arguments>
+			mirrorstatlist: a list of (mirrorinfo, latency, throughput) as returned
+				by the requestors' return_mirrorstats(). A latency of None means
+				the mirror failed.
+
+		<Returns>
+			None
+		"""
+		for mirrorinfo, latency, throughput in mirrorstatlist:
+			if latency == None:
+				self.record_failure(mirrorinfo)
+			else:
+				self.record(mirrorinfo, latency, throughput)
+
+
+	def save(self):
+		"""writes the statistics to the file (if there is one)"""
+		if self.filename == None:
+			return
+
+		# write a new file and atomically replace the old one, so concurrent
+		# clients never read half a file.   Every client writes its own
+		# temporary file.
+		tmpfd, tmpfilename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)))
+		try:
+			with os.fdopen(tmpfd, 'wb') as fd:
+				fd.write(msgpack.packb(self.mirrors, use_bin_type=True))
+
+			os.replace(tmpfilename, self.filename)
+		except:
+			os.remove(tmpfilename)
+			raise
+
+
+def select_mirrors(mirrorinfolist, stats, policy=DEFAULT_POLICY):
+	"""
+	<Purpose>
+		Orders the mirrors according to a selection policy.
+
+	<Arguments>
+		mirrorinfolist: the mirrors as advertised by the vendor
+
+		stats: a MirrorStats object
+
+		policy: one of POLICIES
+
+	<Exceptions>
+		ValueError if the policy is unknown.
+
+	<Returns>
+		A new list with the same mirrors. The requestors use the first k and
+		keep the others as backups, in this order.
+	"""
+	orderedlist = mirrorinfolist[:]
+
+	# shuffling first makes the order of equally good mirrors random
+	random.shuffle(orderedlist)
+
+	if policy == 'random':
+		return orderedlist
+
+	if policy == 'best':
+		orderedlist.sort(key=stats.cost)
+		return orderedlist
+
+	if policy == 'weighted':
+		# weighted sampling without replacement (Efraimidis and Spirakis): every
+		# mirror draws u^(1/weight) for a uniform u, the largest values win.
+		sysrandom = random.SystemRandom()
+		keys = {}
+		for index, mirrorinfo in enumerate(orderedlist):
+			weight = 1.0 / stats.cost(mirrorinfo)
+			keys[index] = sysrandom.random() ** (1.0 / weight)
+
+		return [orderedlist[index] for index in sorted(keys, key=keys.get, reverse=True)]
+
+	raise ValueError("Unknown mirror selection policy " + str(policy))
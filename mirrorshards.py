@@ -0,0 +1,214 @@
+"""
+<Description>
+	Splits the datastore of a mirror across several hosts, for databases that
+	don't fit into the memory of one host.
+
+	Every shard is a mirror process that holds a range of consecutive blocks
+	(raidpir_mirror.py --shard <number>/<count>).   The coordinator
+	(raidpir_mirror.py --shards <IP:port>,...) is the mirror the clients talk
+	to.   An answer is the XOR of the blocks selected by the bit string, so the
+	coordinator sends every shard the part of the bit string for its blocks
+	and XORs the partial answers.   The shards scan at the same time, so a
+	query takes about the scan time of one shard.
+
+	The shards speak the usual mirror protocol (batched 'X' requests).   They
+	are not advertised to the vendor.   A coordinator and its shards see the
+	same bit strings and together are a single mirror, so they must be run by
+	the same party.
+
+"""
+
+import math
+
+# helper functions that are shared
+import raidpirlib as lib
+
+# the partial answers are XORed by the C extension
+import fastsimplexordatastore
+
+import session
+
+# the connections to the shards are kept open
+import connectionpool
+
+
+class ShardError(Exception):
+	"""A shard did not answer as expected"""
+
+
+def shard_blockrange(blockcount, shardnumber, shardcount):
+	"""
+	<Purpose>
+		Computes which blocks a shard holds.   All shards but the last hold the
+		same number of blocks, a multiple of 8, so every shard starts at a byte
+		of the bit strings.
+
+	<Arguments>
+		blockcount: the number of blocks of the release
+
+		shardnumber: the number of the shard, from 0 to shardcount - 1
+
+		shardcount: the number of shards
+
+	<Exceptions>
+		ValueError if the shard number is invalid or the shard would be empty.
+
+	<Returns>
+		A tuple (first block, number of blocks).
+	"""
+	if shardnumber < 0 or shardnumber >= shardcount:
+		raise ValueError("Shard number " + str(shardnumber) + " is not in 0 to " + str(shardcount - 1))
+
+	blocks_per_shard = math.ceil(blockcount / shardcount / 8.0) * 8
+	firstblock = shardnumber * blocks_per_shard
+
+	if firstblock >= blockcount:
+		raise ValueError("There are too many shards for " + str(blockcount) + " blocks")
+
+	return firstblock, min(blocks_per_shard, blockcount - firstblock)
+
+
+class RemoteShardsXORDatastore(object):
+	"""
+	<Purpose>
+		The datastore of a coordinator.   It answers queries by forwarding the
+		parts of the bit strings to the shards and XORing their answers.   It
+		has the query interface of an XORDatastore, but no data.
+
+	<Side Effects>
+		Opens connections to the shards and keeps them open until close().
+
+	<Example Use>
+		datastore = RemoteShardsXORDatastore(manifestdict,
+				[{'ip': '10.0.0.1', 'port': 62001}, {'ip': '10.0.0.2', 'port': 62001}])
+		xoredblock = datastore.produce_xor_from_bitstring(bitstring)
+	"""
+
+	# these are public so that a caller can read information about a created
+	# datastore.   They should not be changed.
+	numberofblocks = None
+	sizeofblocks = None
+	dstype = "remote"
+
+	def __init__(self, manifestdict, shardinfolist):
+		"""
+		<Purpose>
+			Sets up the coordinator, the shards are connected on the first query.
+
+		<Arguments>
+			manifestdict: the manifest of the release
+
+			shardinfolist: the shards in the order of their numbers, dicts with
+					'ip' and 'port'
+
+		<Exceptions>
+			ValueError if there are too many shards for the release.
+		"""
+		self.numberofblocks = manifestdict['blockcount']
+		self.sizeofblocks = manifestdict['blocksize']
+
+		# (shardinfo, first block, number of blocks)
+		self.shards = []
+		for shardnumber, shardinfo in enumerate(shardinfolist):
+			firstblock, numblocks = shard_blockrange(self.numberofblocks, shardnumber, len(shardinfolist))
+			self.shards.append((shardinfo, firstblock, numblocks))
+
+		# the shards answer batches of requests for the release
+		self.params = {'cn': 1, 'k': 1, 'r': 1, 'cl': 1, 'lcl': 1, 'b': True, 'p': False}
+		self.params['m'] = lib.manifest_digest(manifestdict)
+
+		self.connectionpool = connectionpool.MirrorConnectionPool()
+
+
+	def produce_xor_from_bitstring(self, bitstring):
+		"""
+		<Purpose>
+			Returns an XORed block, see XORDatastore.produce_xor_from_bitstring
+
+		<Arguments>
+			bitstring: bytes that indicates what to XOR.
+
+		<Exceptions>
+			TypeError is raised if the bitstring is invalid.
+
+			ShardError or socket errors if a shard fails.
+
+		<Returns>
+			The XORed block.
+		"""
+		return self.produce_xor_from_multiple_bitstrings(bitstring, 1)
+
+
+	def produce_xor_from_multiple_bitstrings(self, bitstring, num_strings):
+		"""
+		<Purpose>
+			Returns multiple XORed blocks, see
+			XORDatastore.produce_xor_from_multiple_bitstrings
+
+		<Arguments>
+			bitstring: concatenated string of bits that indicates what to XOR.
+
+			num_strings: the number of requests in bitstring
+
+		<Exceptions>
+			TypeError is raised if the bitstring is invalid.
+
+			ShardError or socket errors if a shard fails.
+
+		<Returns>
+			The XORed blocks.
+		"""
+		if type(bitstring) != bytes:
+			raise TypeError("bitstring must be of type bytes")
+
+		bitstringlength = lib.bits_to_bytes(self.numberofblocks)
+		if len(bitstring) != bitstringlength * num_strings:
+			raise TypeError("bitstring is not of the correct length")
+
+		# (shardinfo, socket, paramssent) of the shards that were sent requests
+		requested = []
+
+		try:
+			# first send all shards their requests, so they scan at the same time...
+			for shardinfo, firstblock, numblocks in self.shards:
+				sock, paramssent = self.connectionpool.acquire(shardinfo, self.params)
+				requested.append((shardinfo, sock, paramssent))
+
+				start = firstblock // 8
+				end = start + lib.bits_to_bytes(numblocks)
+				for i in range(num_strings):
+					session.sendmessage(sock, b"X" + bitstring[i * bitstringlength + start:i * bitstringlength + end])
+
+			# ... then collect their answers
+			answers = []
+			while requested:
+				shardinfo, sock, paramssent = requested[0]
+
+				if paramssent and session.recvmessage(sock) != b'PARAMS OK':
+					raise ShardError("Shard " + shardinfo['ip'] + ":" + str(shardinfo['port']) + " refused the params")
+
+				for _ in range(num_strings):
+					answer = session.recvmessage(sock)
+					if len(answer) != self.sizeofblocks:
+						raise ShardError("Shard " + shardinfo['ip'] + ":" + str(shardinfo['port']) + " answered: " + str(answer[:40]))
+					answers.append(answer)
+
+				self.connectionpool.release(shardinfo, sock)
+				requested.pop(0)
+
+		except:
+			# the connections are in an unknown state
+			for _, sock, _ in requested:
+				self.connectionpool.discard(sock)
+			raise
+
+		# the answers of a shard are in the order of the requests
+		if len(self.shards) == 1:
+			return b"".join(answers)
+
+		return fastsimplexordatastore.do_xor_multiple([b"".join(answers[shardnum * num_strings:(shardnum + 1) * num_strings]) for shardnum in range(len(self.shards))])
+
+
+	def close(self):
+		"""closes the connections to the shards"""
+		self.connectionpool.close()
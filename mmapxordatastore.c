@@ -9,13 +9,14 @@
 #include <Python.h>
 #include "mmapxordatastore.h"
 
-// This should be *waaaay* more than we would ever need
+// The table starts with this many entries and doubles when it is full
 #define STARTING_XORDATASTORE_TABLESIZE 16
 
-static int xordatastorestablesize = STARTING_XORDATASTORE_TABLESIZE;
-static int xordatastoreinited = 0;
+static int xordatastorestablesize = 0;
 
-static XORDatastore xordatastoretable[STARTING_XORDATASTORE_TABLESIZE];
+// The entries are allocated one by one, so they don't move when the table
+// grows.   The XOR workers use their entry without holding the GIL.
+static XORDatastore **xordatastoretable = NULL;
 
 
 
@@ -48,64 +49,126 @@ static inline char *dword_align(char *ptr) {
 
 // A helper function that checks to see if the table entry is used or free
 static int is_table_entry_used(int i) {
-	return (xordatastoretable[i].datastore != NULL);
+	return (i >= 0 && i < xordatastorestablesize && xordatastoretable[i] != NULL);
 }
 
 
-static datastore_descriptor do_mmap(long block_size, long num_blocks, char* filename){
+// Finds a free table entry and allocates it (zeroed).   If all entries are
+// used, the table grows.   Returns -1 (with a Python exception) if there is
+// not enough memory.
+static datastore_descriptor new_table_entry(void) {
 	int i;
 
-	// If it isn't inited, let's fill in the table with empty entries
-	if (!xordatastoreinited) {
-		// start the table as entry
-		for (i=0; i<STARTING_XORDATASTORE_TABLESIZE; i++) {
-			xordatastoretable[i].numberofblocks = 0;
-			xordatastoretable[i].sizeofablock = 0;
-			xordatastoretable[i].datastore = NULL;
+	for (i=0; i<xordatastorestablesize; i++) {
+		if (!is_table_entry_used(i)) {
+			break;
 		}
-		// We've initted now!
-		xordatastoreinited = 1;
 	}
 
-	for (i=0; i<xordatastorestablesize; i++) {
-		// Look for an empty entry
-		if (!is_table_entry_used(i)) {
-			xordatastoretable[i].numberofblocks = num_blocks;
-			xordatastoretable[i].sizeofablock = block_size;
+	if (i == xordatastorestablesize) {
+		int newsize = xordatastorestablesize == 0 ? STARTING_XORDATASTORE_TABLESIZE : 2 * xordatastorestablesize;
+		XORDatastore **newtable = (XORDatastore **) realloc(xordatastoretable, newsize * sizeof(XORDatastore *));
+		if (newtable == NULL) {
+			PyErr_NoMemory();
+			return -1;
+		}
+		memset(newtable + xordatastorestablesize, 0, (newsize - xordatastorestablesize) * sizeof(XORDatastore *));
+		xordatastoretable = newtable;
+		xordatastorestablesize = newsize;
+	}
 
-			int dbfd = open(filename, O_RDONLY, 0);
+	xordatastoretable[i] = (XORDatastore *) calloc(1, sizeof(XORDatastore));
+	if (xordatastoretable[i] == NULL) {
+		PyErr_NoMemory();
+		return -1;
+	}
 
-			if (dbfd < 0){
-				printf("error opening db %s!\n", filename);
-				exit(1);
-			}
+	return i;
+}
 
-			xordatastoretable[i].datastore  = (__m128i *) mmap64(NULL, num_blocks * block_size, PROT_READ, MAP_SHARED, dbfd, 0);
 
-			if (xordatastoretable[i].datastore == MAP_FAILED) {
-				printf("mmap failed!\n");
-				exit(1);
-			}
+// Frees a table entry, the datastore must be released already
+static void free_table_entry(datastore_descriptor ds) {
+	free(xordatastoretable[ds]);
+	xordatastoretable[ds] = NULL;
+}
 
-			// we can close dbfd here already, mmap still works fine
-			close(dbfd);
 
-			// check for valid header
-			if (strncmp((char*) xordatastoretable[i].datastore, "RAIDPIRDB_v0.9.5", 16) != 0){
-				printf("%s is not a valid RAID-PIR db!\n", filename);
-				exit(1);
-			}
+static datastore_descriptor do_mmap(long block_size, long num_blocks, char* filename, int flags){
+	db_header header;
+	__m128i *datastore;
 
-			// skip header, if it was correct
-			xordatastoretable[i].datastore++;
+	int dbfd = open(filename, O_RDONLY, 0);
 
-			return i;
-		}
+	if (dbfd < 0){
+		PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+		return -1;
+	}
+
+	// check for a valid header
+	if (pread(dbfd, &header, sizeof(header), 0) != sizeof(header) ||
+			memcmp(header.magic, DB_MAGIC, sizeof(DB_MAGIC)) != 0) {
+		close(dbfd);
+		PyErr_Format(PyExc_ValueError, "%s is not a valid RAID-PIR db!", filename);
+		return -1;
+	}
+
+	if (header.formatversion != DB_FORMAT_VERSION) {
+		close(dbfd);
+		PyErr_Format(PyExc_ValueError, "%s has db format %u, expected %d", filename, header.formatversion, DB_FORMAT_VERSION);
+		return -1;
 	}
 
-	// The table is full! I should expand it...
-	printf("Internal Error: I need to expand the table size (unimplemented)\n");
-	return -1;
+	if (header.blocksize != (uint64_t) block_size || header.blockcount != (uint64_t) num_blocks) {
+		close(dbfd);
+		PyErr_Format(PyExc_ValueError, "%s has a different number or size of blocks", filename);
+		return -1;
+	}
+
+	if (header.dataoffset % sysconf(_SC_PAGESIZE) != 0) {
+		close(dbfd);
+		PyErr_Format(PyExc_ValueError, "%s: the blocks don't start at a page boundary", filename);
+		return -1;
+	}
+
+	// map only the blocks, they start at a page boundary. With
+	// MAP_POPULATE, this reads the whole database, so the first queries
+	// don't have to wait for the disk.
+	datastore = (__m128i *) mmap64(NULL, num_blocks * block_size, PROT_READ,
+			MAP_SHARED | ((flags & MMAP_POPULATE) ? MAP_POPULATE : 0), dbfd, header.dataoffset);
+
+	// we can close dbfd here already, mmap still works fine
+	close(dbfd);
+
+	if (datastore == MAP_FAILED) {
+		PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+		return -1;
+	}
+
+	// these are only hints, the kernel may ignore them
+	if (flags & MMAP_SEQUENTIAL) {
+		madvise(datastore, num_blocks * block_size, MADV_SEQUENTIAL);
+	}
+	if (flags & MMAP_WILLNEED) {
+		madvise(datastore, num_blocks * block_size, MADV_WILLNEED);
+	}
+#ifdef MADV_HUGEPAGE
+	if (flags & MMAP_HUGEPAGE) {
+		madvise(datastore, num_blocks * block_size, MADV_HUGEPAGE);
+	}
+#endif
+
+	datastore_descriptor ds = new_table_entry();
+	if (ds < 0) {
+		munmap(datastore, num_blocks * block_size);
+		return -1;
+	}
+
+	xordatastoretable[ds]->datastore = datastore;
+	xordatastoretable[ds]->numberofblocks = num_blocks;
+	xordatastoretable[ds]->sizeofablock = block_size;
+
+	return ds;
 }
 
 
@@ -113,9 +176,10 @@ static datastore_descriptor do_mmap(long block_size, long num_blocks, char* file
 static PyObject *Initialize(PyObject *module, PyObject *args) {
 	long blocksize, numblocks;
 	char* filename;
-	int filenamelen;
+	Py_ssize_t filenamelen;
+	int flags = 0;
 
-	if (!PyArg_ParseTuple(args, "lls#", &blocksize, &numblocks, &filename, &filenamelen)) {
+	if (!PyArg_ParseTuple(args, "lls#|i", &blocksize, &numblocks, &filename, &filenamelen, &flags)) {
 		// Incorrect args...
 		return NULL;
 	}
@@ -125,71 +189,142 @@ static PyObject *Initialize(PyObject *module, PyObject *args) {
 		return NULL;
 	}
 
-	return Py_BuildValue("i", do_mmap(blocksize, numblocks, filename));
+	datastore_descriptor ds = do_mmap(blocksize, numblocks, filename, flags);
+	if (ds < 0) {
+		// the exception is set
+		return NULL;
+	}
+
+	return Py_BuildValue("i", ds);
 }
 
 
-// This function needs to be fast.   It is a good candidate for releasing Python's GIL
-static void multi_bitstring_xor_worker(int ds, char *bit_string, long bit_string_length, unsigned int numstrings, __m128i *resultbuffer) {
+// Returns the first block at or after block whose bit is set in bit_string
+// (0 = MSB of the first byte), or num_blocks if there is none.   Bytes
+// without set bits are skipped at once.
+static inline long next_set_bit(const unsigned char *bit_string, long block, long num_blocks) {
+	while (block < num_blocks) {
+		// ignore the bits of the blocks before block
+		unsigned int byte = bit_string[block >> 3] & (0xff >> (block & 7));
+		if (byte != 0) {
+			block = (block & ~7L) + __builtin_clz(byte) - (8 * sizeof(unsigned int) - 8);
+			return block < num_blocks ? block : num_blocks;
+		}
+		block = (block & ~7L) + 8;
+	}
+	return num_blocks;
+}
+
+
+// Asks the CPU to load the start of a block into the cache.   For a mapped
+// file this also faults the page in a little before the block is XORed.
+static inline void prefetch_block(const char *block, int block_size) {
+	int i;
+	int bytes = block_size < PREFETCH_BYTES ? block_size : PREFETCH_BYTES;
+	for (i = 0; i < bytes; i += 64) {
+		_mm_prefetch(block + i, _MM_HINT_T0);
+	}
+}
+
+
+// This function needs to be fast.   It runs without holding Python's GIL
+static void multi_bitstring_xor_worker(XORDatastore *xordatastore, char *bit_string, long bit_string_length, unsigned int numstrings, __m128i *resultbuffer) {
 	long one_bit_string_length = bit_string_length / numstrings; // length of one bit string
 	long remaininglength = one_bit_string_length * 8; // convert bytes to bits
-	char *current_bit_string_pos;
-	current_bit_string_pos = bit_string;
-	long long offset = 0;
-	int block_size = xordatastoretable[ds].sizeofablock;
+	long block_size = xordatastore->sizeofablock;
 	char *datastorebase;
-	datastorebase = (char *) xordatastoretable[ds].datastore;
+	datastorebase = (char *) xordatastore->datastore;
 
 	int dwords_per_block = block_size / sizeof(__m128i);
 
-	unsigned char bit = 128;
 	unsigned int i;
+	long j;
+
+	// the extra bits in the last byte are ignored
+	if (remaininglength > xordatastore->numberofblocks) {
+		remaininglength = xordatastore->numberofblocks;
+	}
+
+	// the blocks that are selected by any of the bit strings
+	unsigned char *selected = (unsigned char *) malloc(one_bit_string_length);
+	if (selected == NULL) {
+		printf("Error: could not allocate memory for the selected blocks\n");
+		return;
+	}
+	memcpy(selected, bit_string, one_bit_string_length);
+	for(i = 1; i < numstrings; i++) {
+		for(j = 0; j < one_bit_string_length; j++) {
+			selected[j] |= bit_string[one_bit_string_length * i + j];
+		}
+	}
 
-	while (remaininglength > 0) {
+	// prefetch the first selected blocks, from then on one block is
+	// prefetched for every block that is XORed
+	long block = next_set_bit(selected, 0, remaininglength);
+	long ahead = block;
+	for(i = 0; i < PREFETCH_DISTANCE && ahead < remaininglength; i++) {
+		prefetch_block(datastorebase + ahead * block_size, block_size);
+		ahead = next_set_bit(selected, ahead + 1, remaininglength);
+	}
+
+	// each bit of the bit_string represents one PIR block
+	while (block < remaininglength) {
+		if (ahead < remaininglength) {
+			prefetch_block(datastorebase + ahead * block_size, block_size);
+			ahead = next_set_bit(selected, ahead + 1, remaininglength);
+		}
 
+		unsigned char bit = 128 >> (block & 7);
 		for(i = 0; i < numstrings; i++){
-			if ( *(current_bit_string_pos + one_bit_string_length * i) & bit) {
-				XOR_fullblocks(resultbuffer + dwords_per_block * i, (__m128i *) (datastorebase + offset), dwords_per_block);
+			if (bit_string[one_bit_string_length * i + (block >> 3)] & bit) {
+				XOR_fullblocks(resultbuffer + dwords_per_block * i, (__m128i *) (datastorebase + block * block_size), dwords_per_block);
 			}
 		}
 
-		offset += block_size;
-		bit /= 2;
-		remaininglength -=1;
-		if (bit == 0) {
-			bit = 128;
-			current_bit_string_pos++;
-		}
+		block = next_set_bit(selected, block + 1, remaininglength);
 	}
-}
 
+	free(selected);
+}
 
 
-// This function needs to be fast.   It is a good candidate for releasing Python's GIL
-static void bitstring_xor_worker(int ds, char *bit_string, long bit_string_length, __m128i *resultbuffer) {
+// This function needs to be fast.   It runs without holding Python's GIL
+static void bitstring_xor_worker(XORDatastore *xordatastore, char *bit_string, long bit_string_length, __m128i *resultbuffer) {
 	long remaininglength = bit_string_length * 8;  // convert bytes to bits
-	char *current_bit_string_pos;
-	current_bit_string_pos = bit_string;
-	long long offset = 0;
-	int block_size = xordatastoretable[ds].sizeofablock;
+	long block_size = xordatastore->sizeofablock;
 	char *datastorebase;
-	datastorebase = (char *) xordatastoretable[ds].datastore;
+	datastorebase = (char *) xordatastore->datastore;
 
 	int dwords_per_block = block_size / sizeof(__m128i);
 
-	unsigned char bit = 128;
+	unsigned char *selected = (unsigned char *) bit_string;
+	int i;
 
-	while (remaininglength > 0) {
-		if ((*current_bit_string_pos) & bit) {
-			XOR_fullblocks(resultbuffer, (__m128i *) (datastorebase + offset), dwords_per_block);
-		}
-		offset += block_size;
-		bit /= 2;
-		remaininglength -=1;
-		if (bit == 0) {
-			bit = 128;
-			current_bit_string_pos++;
+	// the extra bits in the last byte are ignored
+	if (remaininglength > xordatastore->numberofblocks) {
+		remaininglength = xordatastore->numberofblocks;
+	}
+
+	// prefetch the first selected blocks, from then on one block is
+	// prefetched for every block that is XORed
+	long block = next_set_bit(selected, 0, remaininglength);
+	long ahead = block;
+	for(i = 0; i < PREFETCH_DISTANCE && ahead < remaininglength; i++) {
+		prefetch_block(datastorebase + ahead * block_size, block_size);
+		ahead = next_set_bit(selected, ahead + 1, remaininglength);
+	}
+
+	// each bit of the bit_string represents one PIR block
+	// if the bit is set, we XOR the block
+	while (block < remaininglength) {
+		if (ahead < remaininglength) {
+			prefetch_block(datastorebase + ahead * block_size, block_size);
+			ahead = next_set_bit(selected, ahead + 1, remaininglength);
 		}
+
+		XOR_fullblocks(resultbuffer, (__m128i *) (datastorebase + block * block_size), dwords_per_block);
+
+		block = next_set_bit(selected, block + 1, remaininglength);
 	}
 }
 
@@ -199,35 +334,41 @@ static void bitstring_xor_worker(int ds, char *bit_string, long bit_string_lengt
 // Python Wrapper object
 static PyObject *Produce_Xor_From_Bitstring(PyObject *module, PyObject *args) {
 	datastore_descriptor ds;
-	int bitstringlength;
+	Py_ssize_t bitstringlength;
 	char *bitstringbuffer;
 	char *raw_resultbuffer;
 	__m128i *resultbuffer;
+	// accepted for the same calls as fastsimplexordatastore, nothing is precomputed here
+	char use_precomputed_data = 0;
 
-	if (!PyArg_ParseTuple(args, "iy#", &ds, &bitstringbuffer, &bitstringlength)) {
+	if (!PyArg_ParseTuple(args, "iy#|b", &ds, &bitstringbuffer, &bitstringlength, &use_precomputed_data)) {
 		// Incorrect args...
 		return NULL;
 	}
 
-	printf("ds %i  .  ", ds);
-
 	// Is the ds valid?
 	if (!is_table_entry_used(ds)) {
 		PyErr_SetString(PyExc_ValueError, "Bad index for Produce_Xor_From_Bitstring");
 		return NULL;
 	}
 
+	// the entry stays where it is while the GIL is released
+	XORDatastore *xordatastore = xordatastoretable[ds];
+
 	// Let's prepare a place to put the answer (1 block + alignment)
-	raw_resultbuffer = (char*) calloc(1, xordatastoretable[ds].sizeofablock + sizeof(__m128i));
+	raw_resultbuffer = (char*) calloc(1, xordatastore->sizeofablock + sizeof(__m128i));
 
 	// align it
 	resultbuffer = (__m128i *) dword_align(raw_resultbuffer);
 
-	// Let's actually calculate this!
-	bitstring_xor_worker(ds, bitstringbuffer, bitstringlength, resultbuffer);
+	// Let's actually calculate this!   The bit string can't change and the
+	// datastore is only deallocated by its owner, so other threads may run.
+	Py_BEGIN_ALLOW_THREADS
+	bitstring_xor_worker(xordatastore, bitstringbuffer, bitstringlength, resultbuffer);
+	Py_END_ALLOW_THREADS
 
 	// okay, let's put it in a buffer
-	PyObject *return_str_obj = Py_BuildValue("y#",(char *)resultbuffer, xordatastoretable[ds].sizeofablock);
+	PyObject *return_str_obj = Py_BuildValue("y#",(char *)resultbuffer, xordatastore->sizeofablock);
 
 	// clear the buffer
 	free(raw_resultbuffer);
@@ -241,14 +382,16 @@ static PyObject *Produce_Xor_From_Bitstring(PyObject *module, PyObject *args) {
 // Python Wrapper object
 static PyObject *Produce_Xor_From_Bitstrings(PyObject *module, PyObject *args) {
 	datastore_descriptor ds;
-	int bitstringlength;
+	Py_ssize_t bitstringlength;
 	unsigned int numstrings;
 	char *bitstringbuffer;
 	char *raw_resultbuffer;
 	__m128i *resultbuffer;
+	// accepted for the same calls as fastsimplexordatastore, nothing is precomputed here
+	char use_precomputed_data = 0;
 
 
-	if (!PyArg_ParseTuple(args, "iy#I", &ds, &bitstringbuffer, &bitstringlength, &numstrings)) {
+	if (!PyArg_ParseTuple(args, "iy#I|b", &ds, &bitstringbuffer, &bitstringlength, &numstrings, &use_precomputed_data)) {
 		// Incorrect args...
 		return NULL;
 	}
@@ -260,17 +403,23 @@ static PyObject *Produce_Xor_From_Bitstrings(PyObject *module, PyObject *args) {
 		return NULL;
 	}
 
+	// the entry stays where it is while the GIL is released
+	XORDatastore *xordatastore = xordatastoretable[ds];
+
 	// Let's prepare a place to put the answer (numstrings blocks + alignment)
-	raw_resultbuffer = (char*) calloc(1, xordatastoretable[ds].sizeofablock * numstrings + sizeof(__m128i));
+	raw_resultbuffer = (char*) calloc(1, xordatastore->sizeofablock * numstrings + sizeof(__m128i));
 
 	// align it
 	resultbuffer = (__m128i *) dword_align(raw_resultbuffer);
 
-	// Let's actually calculate this!
-	multi_bitstring_xor_worker(ds, bitstringbuffer, bitstringlength, numstrings, resultbuffer);
+	// Let's actually calculate this!   The bit string can't change and the
+	// datastore is only deallocated by its owner, so other threads may run.
+	Py_BEGIN_ALLOW_THREADS
+	multi_bitstring_xor_worker(xordatastore, bitstringbuffer, bitstringlength, numstrings, resultbuffer);
+	Py_END_ALLOW_THREADS
 
 	// okay, let's put it in a buffer
-	PyObject *return_str_obj = Py_BuildValue("y#",(char *)resultbuffer, xordatastoretable[ds].sizeofablock * numstrings);
+	PyObject *return_str_obj = Py_BuildValue("y#",(char *)resultbuffer, xordatastore->sizeofablock * numstrings);
 
 	// clear the buffer
 	free(raw_resultbuffer);
@@ -301,12 +450,12 @@ static PyObject *GetData(PyObject *module, PyObject *args) {
 	}
 
 	// Is this outside of the bounds...
-	if (offset + quantity > xordatastoretable[ds].numberofblocks * xordatastoretable[ds].sizeofablock) {
+	if (offset + quantity > xordatastoretable[ds]->numberofblocks * xordatastoretable[ds]->sizeofablock) {
 		PyErr_SetString(PyExc_ValueError, "GetData out of bounds");
 		return NULL;
 	}
 
-	return Py_BuildValue("y#", ((char *)xordatastoretable[ds].datastore)+offset, quantity);
+	return Py_BuildValue("y#", ((char *)xordatastoretable[ds]->datastore)+offset, quantity);
 
 }
 
@@ -318,10 +467,8 @@ static void deallocate(datastore_descriptor ds){
 		printf("Error, double deallocate on %d.   Ignoring.\n",ds);
 	}
 	else {
-		munmap(xordatastoretable[ds].datastore, xordatastoretable[ds].numberofblocks * xordatastoretable[ds].sizeofablock);
-		xordatastoretable[ds].numberofblocks = 0;
-		xordatastoretable[ds].sizeofablock = 0;
-		xordatastoretable[ds].datastore = NULL;
+		munmap(xordatastoretable[ds]->datastore, xordatastoretable[ds]->numberofblocks * xordatastoretable[ds]->sizeofablock);
+		free_table_entry(ds);
 	}
 }
 
@@ -9,9 +9,36 @@
 #include <emmintrin.h>
 #include <sys/mman.h>
 #include <fcntl.h>
+#include <unistd.h>
 
 typedef int datastore_descriptor;
 
+// Hints for mapping the database (Initialize), they can be combined
+#define MMAP_POPULATE 1    // read the whole database when it is mapped
+#define MMAP_SEQUENTIAL 2  // MADV_SEQUENTIAL, read ahead aggressively and drop pages behind
+#define MMAP_WILLNEED 4    // MADV_WILLNEED, start reading the database in the background
+#define MMAP_HUGEPAGE 8    // MADV_HUGEPAGE, if the file system supports it
+
+// The XOR loops prefetch the blocks this many selected blocks ahead...
+#define PREFETCH_DISTANCE 8
+// ... and at most this many bytes of each of them
+#define PREFETCH_BYTES 256
+
+// The header of a database file, written by raidpirlib.py (_DB_HEADER_FORMAT).
+// All numbers are little endian, like the machines this runs on.
+#define DB_MAGIC "RAIDPIR"
+#define DB_FORMAT_VERSION 2
+
+typedef struct {
+	char magic[8];            // DB_MAGIC, zero terminated
+	uint32_t formatversion;   // DB_FORMAT_VERSION
+	uint32_t reserved;
+	uint64_t blocksize;       // Bytes in a block
+	uint64_t blockcount;      // Blocks in the database
+	uint64_t dataoffset;      // Start of the first block, a multiple of the page size
+	char manifestdigest[64];  // hex digest of the manifest, checked by the mirror
+} db_header;
+
 typedef struct {
 	long numberofblocks;      // Blocks in the datastore
 	long sizeofablock;        // Bytes in a block.
@@ -24,8 +51,12 @@ static inline void XOR_fullblocks(__m128i *dest, const __m128i *data, long count
 static inline void XOR_byteblocks(char *dest, const char *data, long count);
 static inline char *dword_align(char *ptr);
 static int is_table_entry_used(int i);
-static void bitstring_xor_worker(int ds, char *bit_string, long bit_string_length, __m128i *resultbuffer);
-static void multi_bitstring_xor_worker(int ds, char *bit_string, long bit_string_length, unsigned int num_bitstrings, __m128i *resultbuffer);
+static datastore_descriptor new_table_entry(void);
+static void free_table_entry(datastore_descriptor ds);
+static inline long next_set_bit(const unsigned char *bit_string, long block, long num_blocks);
+static inline void prefetch_block(const char *block, int block_size);
+static void bitstring_xor_worker(XORDatastore *xordatastore, char *bit_string, long bit_string_length, __m128i *resultbuffer);
+static void multi_bitstring_xor_worker(XORDatastore *xordatastore, char *bit_string, long bit_string_length, unsigned int num_bitstrings, __m128i *resultbuffer);
 static void deallocate(datastore_descriptor ds);
 static char *slow_XOR(char *dest, const char *data, unsigned long stringlength);
 static char *fast_XOR(char *dest, const char *data, unsigned long stringlength);
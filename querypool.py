@@ -0,0 +1,224 @@
+"""
+<Description>
+	An on-disk pool of precomputed query shares for the RAID-PIR client.
+
+	The randomness of a (non-chunked) RAID-PIR query does not depend on the
+	block that is requested: k-1 mirrors receive random bitstrings and the
+	k-th mirror receives the XOR of these strings with a single bit flipped.
+	The expensive part (generating and XORing k-1 random strings of
+	blockcount bits) can therefore be done ahead of time, while the client is
+	idle.   At request time only the bit flip remains.
+
+	Every entry of the pool must be used at most once.   Entries are removed
+	from the pool file *before* they are handed out, so a crash can never
+	lead to a share being sent twice.
+
+"""
+
+import sys
+
+import os
+
+# the pool file is locked while it is changed
+import fcntl
+
+# helper functions that are shared
+import raidpirlib as lib
+
+import fastsimplexordatastore as xordatastore
+
+try:
+	# for packing more complicated messages
+	import msgpack
+except ImportError:
+	print("Requires MsgPack module (http://msgpack.org/)")
+	sys.exit(1)
+
+
+class IncompatibleQueryPool(Exception):
+	"""The pool was created for a different number of blocks or mirrors"""
+
+
+def generate_query_shares(blockcount, privacythreshold):
+	"""
+	<Purpose>
+		Creates the shares for a single query, without selecting a block.
+
+	<Arguments>
+		blockcount: the number of blocks in the release (bits per share)
+
+		privacythreshold: the number of mirrors (k) that receive a share
+
+	<Returns>
+		A list of k bitstrings.   The first k-1 are random, the last one is the
+		XOR of all others.   Flipping the bit of the desired block in the last
+		share turns this into a valid query.
+	"""
+
+	shares = []
+	for _ in range(privacythreshold - 1):
+		shares.append(lib.randombits(blockcount))
+
+	shares.append(xordatastore.do_xor_multiple(shares))
+	return shares
+
+
+class QueryPool(object):
+	"""
+	<Purpose>
+		A file backed pool of precomputed query shares.   The file starts with
+		a msgpack'd header that records the block count and number of mirrors
+		the shares were created for, followed by the entries.   Every entry is
+		a record of k shares of bits_to_bytes(blockcount) bytes each, so
+		entries are taken from the end of the file without reading the rest.
+
+		The file is locked (flock) while it is changed, so several clients can
+		share a pool.
+
+	<Side Effects>
+		Reads and writes the pool file.
+	"""
+
+	def __init__(self, filename, blockcount, privacythreshold):
+		"""
+		<Purpose>
+			Opens (or prepares to create) a query pool.
+
+		<Arguments>
+			filename: the file the pool is stored in
+
+			blockcount: the number of blocks in the release
+
+			privacythreshold: the number of mirrors (k) per query
+
+		<Exceptions>
+			IncompatibleQueryPool if an existing pool file was created for
+			different parameters.
+		"""
+		self.filename = filename
+		self.blockcount = blockcount
+		self.privacythreshold = privacythreshold
+
+		self.sharesize = lib.bits_to_bytes(blockcount)
+		self.recordsize = privacythreshold * self.sharesize
+		self.headersize = len(msgpack.packb(self._header(), use_bin_type=True))
+
+		if os.path.exists(filename):
+			with open(filename, 'rb') as fd:
+				headerdata = fd.read(self.headersize)
+
+			# a fill that was interrupted before the header was written left an
+			# empty pool, the next fill writes the header (see fill)
+			if len(headerdata) < self.headersize:
+				return
+
+			try:
+				header = msgpack.unpackb(headerdata, raw=False)
+			except ValueError:
+				# the header of a pool for other parameters has another size
+				header = None
+
+			if header != self._header():
+				raise IncompatibleQueryPool("Query pool " + filename + " was not created for " + str(blockcount) + " blocks and k=" + str(privacythreshold))
+
+
+	def _header(self):
+		return {'blockcount': self.blockcount, 'k': self.privacythreshold, 'recordsize': self.recordsize}
+
+
+	def _entries_in(self, filesize):
+		"""private helper, the number of complete entries in a file of this size"""
+		return max(0, filesize - self.headersize) // self.recordsize
+
+
+	def __len__(self):
+		try:
+			return self._entries_in(os.stat(self.filename).st_size)
+		except FileNotFoundError:
+			return 0
+
+
+	def fill(self, count):
+		"""
+		<Purpose>
+			Precomputes query shares and appends them to the pool.
+
+		<Arguments>
+			count: the number of queries to add
+
+		<Side Effects>
+			Creates or extends the pool file.
+
+		<Returns>
+			None
+		"""
+		fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX)
+
+			filesize = os.fstat(fd).st_size
+			if filesize < self.headersize:
+				os.ftruncate(fd, 0)
+				os.write(fd, msgpack.packb(self._header(), use_bin_type=True))
+				filesize = self.headersize
+
+			# a fill that was interrupted may have left an incomplete entry
+			offset = self.headersize + self._entries_in(filesize) * self.recordsize
+			os.ftruncate(fd, offset)
+
+			for _ in range(count):
+				entry = b"".join(generate_query_shares(self.blockcount, self.privacythreshold))
+				os.pwrite(fd, entry, offset)
+				offset = offset + self.recordsize
+
+			os.fsync(fd)
+
+		finally:
+			# closing the file releases the lock
+			os.close(fd)
+
+
+	def take(self, count):
+		"""
+		<Purpose>
+			Removes up to count entries from the pool and returns them.
+
+		<Arguments>
+			count: the maximum number of entries to return
+
+		<Side Effects>
+			Truncates the pool file before the returned entries.
+
+		<Returns>
+			A list of share lists (see generate_query_shares). It may be shorter
+			than count (or empty) if the pool runs dry.
+		"""
+		try:
+			fd = os.open(self.filename, os.O_RDWR)
+		except FileNotFoundError:
+			return []
+
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX)
+
+			available = self._entries_in(os.fstat(fd).st_size)
+			count = min(count, available)
+			if count <= 0:
+				return []
+
+			remaining = self.headersize + (available - count) * self.recordsize
+			data = os.pread(fd, count * self.recordsize, remaining)
+
+			# the entries are removed from the file before they are handed out, so
+			# an entry can never be used twice.
+			os.ftruncate(fd, remaining)
+			os.fsync(fd)
+
+		finally:
+			os.close(fd)
+
+		taken = []
+		for entrystart in range(0, len(data), self.recordsize):
+			taken.append([data[sharestart:sharestart + self.sharesize] for sharestart in range(entrystart, entrystart + self.recordsize, self.sharesize)])
+
+		return taken
@@ -26,7 +26,9 @@
 		[-p]
 		[-b]
 		[-t]
+		[--async [--window <NUMBER>]]
 		[--vendorip <IP>]
+		[--querypool <FILE> [--fillquerypool <NUMBER>]]
 		file1 [file2 ...]
 
 <Options>
@@ -50,16 +52,20 @@
 # The XORRequestor interface is used to address these issues.
 # The programmer defines an object that is provided the manifest,
 # mirrorlist, and blocks to retrieve.   The XORRequestor object must support
-# several methods: get_next_xorrequest(), notify_failure(xorrequest),
-# notify_success(xorrequest, xordata), and return_block(blocknum).   The
-# request_blocks_from_mirrors function in this file will use threads to call
-# these methods to determine what to retrieve.   The notify_* routines are
+# several methods: get_next_xorrequest(), send_xorrequest(xorrequest),
+# notify_failure(xorrequest), notify_success(mirrorstate, xordata), and
+# return_block(blocknum).   The request_blocks_from_mirrors function in this
+# file will use threads to call these methods to determine what to retrieve.   The notify_* routines are
 # used to inform the XORRequestor object of prior results so that it can
 # decide how to issue future block requests.   This separates out the 'what'
 # from the 'how' but has a slight loss of control.  Note that the block
 # reconstruction, etc. is done here to allow easy extensibility of malicious
 # mirror detection / vendor notification.
 #
+# Other programs can use the RaidPirClient class instead of the command line.
+# It keeps the manifest, the mirror list and the mirror connections between
+# retrievals.
+#
 # The manifest file could also be extended to support huge files (those that
 # span multiple releases).   The client would need to download files from
 # multiple releases and then stitch them back together.   This would require
@@ -80,200 +86,725 @@ import simplexorrequestor
 
 import session
 
+# offline precomputation of query shares
+import querypool
+
+# drives all mirror connections from one event loop
+import asyncxorrequestor
+
+# keeps mirror connections open between retrievals
+import connectionpool
+
+# orders the mirrors by their statistics
+import mirrorselection
+
+# keeps retrieved blocks on disk until a retrieval is complete
+import blockstore
+
 # for basename
 import os.path
 
 # to sleep...
 import time
+
+# to choose dummy blocks
+import random
+
+import collections
+
 _timer = lib._timer
 
+# rounds of rejection sampling when drawing dummy and filler blocks, before
+# giving up on a range that is (almost) completely requested or cached
+DRAW_ROUNDS = 8
+
 
 def _request_helper(rxgobj, tid):
-	"""Private helper to get requests.
-	Multiple threads will execute this, each with a unique tid."""
+	"""Private helper to send requests.
+	Multiple threads will execute this, each with a unique tid. A failed
+	mirror is replaced by a backup mirror in send_xorrequest."""
 	thisrequest = rxgobj.get_next_xorrequest(tid)
 
-	#the socket is fixed for each thread, so we only need to do this once
-	socket = thisrequest[0]['sock']
-
 	# go until there are no more requests
 	while thisrequest != ():
-		bitstring = thisrequest[2]
-		try:
-			# request the XOR block...
-			lib.request_xorblock(socket, bitstring)
-
-		except Exception as e:
-			if 'socked' in str(e):
-				rxgobj.notify_failure(thisrequest)
-				sys.stdout.write('F')
-				sys.stdout.flush()
-			else:
-				# otherwise, re-raise...
-				raise
-
-		# regardless of failure or success, get another request...
+		rxgobj.send_xorrequest(thisrequest)
 		thisrequest = rxgobj.get_next_xorrequest(tid)
 
 	# and that's it!
 	return
 
 
-def _request_helper_chunked(rxgobj, tid):
-	"""Private helper to get requests with chunks.
-	Potentially multiple threads will execute this, each with a unique tid."""
-	thisrequest = rxgobj.get_next_xorrequest(tid)
+class RaidPirClient(object):
+	"""
+	<Purpose>
+		Retrieves blocks and files of one release privately, for use from other
+		Python programs.   The manifest, the mirror list and the connections to
+		the mirrors are kept between retrievals, so a long running process can do
+		many lookups without setting anything up again.
 
-	#the socket is fixed for each thread, so we only need to do this once
-	socket = thisrequest[0]['sock']
-	rqtype = thisrequest[3] #the request type is also fixed
+	<Side Effects>
+		Contacts the vendor for the mirror list and keeps sockets to the mirrors
+		open until close() is called.
+
+	<Example Use>
+		client = RaidPirClient(manifestdict, numberofmirrors=3, redundancy=2)
+		filedata = client.get_file('somefile')
+		blockdict = client.get_blocks([3, 7])
+		client.close()
+	"""
+
+	def __init__(self, manifestdict, numberofmirrors=2, redundancy=None, rng=False, parallel=False, batch=False, vendorip=None, mirrorinfolist=None, querypoolfile=None, asynchronous=False, window=asyncxorrequestor.DEFAULT_WINDOW, hedgepercentile=None, selectionpolicy=mirrorselection.DEFAULT_POLICY, mirrorstatsfile=None, journaldirectory=None, blockcache=None, timinglog=None, verbose=False):
+		"""
+		<Purpose>
+			Sets up a client for the release described by the manifest.
+
+		<Arguments>
+			manifestdict: the manifest with information about the release
+
+			numberofmirrors: how many mirrors (k) are queried
+
+			redundancy: use chunks and overlap them this often (r), None for no chunks
+
+			rng: use seed expansion for the latter chunks (requires redundancy)
+
+			parallel: query one block per chunk (requires redundancy)
+
+			batch: ask the mirrors to compute the answers in batches
+
+			vendorip: overrides the vendor from the manifest
+
+			mirrorinfolist: use this list of mirrors instead of asking the vendor
+
+			querypoolfile: take precomputed query shares from this file (not with redundancy)
+
+			asynchronous: drive the mirror connections from an asyncio event loop.
+				In this mode connections are not kept between retrievals.
+
+			window: the maximum number of outstanding requests per mirror (asynchronous)
+
+			hedgepercentile: request blocks again from other mirrors if a mirror
+				did not reply for longer than this percentile of the reply
+				latencies, None for no hedging (not with redundancy or asynchronous)
+
+			selectionpolicy: how the mirrors are chosen, one of
+				mirrorselection.POLICIES
+
+			mirrorstatsfile: keep the mirror statistics in this file between
+				runs, None to keep them in memory only
+
+			journaldirectory: write_files() keeps the retrieved blocks in a
+				journal in this directory, so an interrupted retrieval can be
+				resumed. None for no journal.
+
+			blockcache: a blockstore.BlockCache for the retrieved blocks, which
+				may be shared with other clients. None for no cache.
+
+			timinglog: an open file to write timing measurements to, None for no timing
+
+			verbose: print progress information
+
+		<Exceptions>
+			ValueError if the parameters are invalid.
+			socket errors if the vendor can't be contacted.
+		"""
+
+		if numberofmirrors < 2:
+			raise ValueError("Mirrors to contact must be > 1")
+
+		if redundancy != None and (redundancy < 2 or redundancy > numberofmirrors):
+			raise ValueError("Redundancy must be > 1 and less or equal to the number of mirrors")
+
+		if (rng or parallel) and redundancy == None:
+			raise ValueError("Chunks must be enabled and redundancy set to use RNG or parallel queries!")
+
+		if redundancy != None and manifestdict['blockcount'] < numberofmirrors * 8:
+			raise ValueError("Block count too low to use chunks! Try reducing the block size or add more files to the database.")
+
+		if parallel:
+			simplexorrequestor.check_parallel_layout(manifestdict, numberofmirrors)
+
+		if querypoolfile != None and redundancy != None:
+			raise ValueError("A query pool can only be used without chunks!")
+
+		if window < 1:
+			raise ValueError("The window must allow at least one outstanding request")
+
+		if hedgepercentile != None and (hedgepercentile <= 0 or hedgepercentile >= 100):
+			raise ValueError("The hedge percentile must be between 0 and 100")
+
+		if hedgepercentile != None and (redundancy != None or asynchronous):
+			raise ValueError("Hedging can only be used without chunks and without asyncio!")
+
+		if selectionpolicy not in mirrorselection.POLICIES:
+			raise ValueError("The mirror selection policy must be one of " + ", ".join(mirrorselection.POLICIES))
+
+		self.manifestdict = manifestdict
+		self.numberofmirrors = numberofmirrors
+		self.redundancy = redundancy
+		self.rng = rng
+		self.parallel = parallel
+		self.batch = batch
+		self.vendorip = vendorip
+		self.asynchronous = asynchronous
+		self.window = window
+		self.hedgepercentile = hedgepercentile
+		# reply latencies of the mirrors, kept between retrievals for hedging
+		self.latencies = collections.deque(maxlen=simplexorrequestor.HEDGE_LATENCY_SAMPLES)
+		self.selectionpolicy = selectionpolicy
+		self.mirrorstats = mirrorselection.MirrorStats(mirrorstatsfile)
+		self.journaldirectory = journaldirectory
+		self.blockcache = blockcache
+		if blockcache != None:
+			self.manifestdigest = lib.manifest_digest(manifestdict)
+		self.timinglog = timinglog
+		self.timing = timinglog != None
+		self.verbose = verbose
+
+		if querypoolfile != None:
+			self.querypool = querypool.QueryPool(querypoolfile, manifestdict['blockcount'], numberofmirrors)
+		else:
+			self.querypool = None
+
+		# idle connections to the mirrors
+		self.connectionpool = connectionpool.MirrorConnectionPool()
+
+		if mirrorinfolist == None:
+			self.refresh_mirrorlist()
+		else:
+			self.mirrorinfolist = mirrorinfolist
 
-	# go until there are no more requests
-	while thisrequest != ():
-		chunks = thisrequest[2]
 
+	def refresh_mirrorlist(self):
+		"""asks the vendor for the current list of mirrors"""
+		if self.vendorip == None:
+			# use data from manifest
+			self.mirrorinfolist = lib.retrieve_mirrorinfolist(self.manifestdict['vendorhostname'], self.manifestdict['vendorport'])
+		else:
+			self.mirrorinfolist = lib.retrieve_mirrorinfolist(self.vendorip)
+
+		if self.verbose:
+			print("Mirrors: ", self.mirrorinfolist)
+
+
+	def _select_mirrors(self, mirrorinfolist):
+		"""private helper, orders the mirrors for a requestor"""
+		return mirrorselection.select_mirrors(mirrorinfolist, self.mirrorstats, self.selectionpolicy)
+
+
+	def _retrieve(self, rxgobj):
+		"""private helper that retrieves all blocks of a requestor and updates
+		the mirror statistics, also if the retrieval fails"""
 		try:
-			# request the XOR block...
-			if rqtype == 1: # chunks and seed expansion
-				lib.request_xorblock_chunked_rng(socket, chunks)
+			self._run_requestor(rxgobj)
+		finally:
+			self.mirrorstats.update(rxgobj.return_mirrorstats())
+			self.mirrorstats.save()
+
 
-			elif rqtype == 2: # chunks, seed expansion and parallel
-				lib.request_xorblock_chunked_rng_parallel(socket, chunks)
+	def _run_requestor(self, rxgobj):
+		"""private helper that retrieves all blocks of a requestor, either with
+		one sending and one receiving thread per mirror or from an event loop."""
 
-			else: # only chunks (redundancy)
-				lib.request_xorblock_chunked(socket, chunks)
+		if self.hedgepercentile != None:
+			# the hedging requestor drives (and cleans up) its connections itself
+			rxgobj.retrieve(self.connectionpool)
+			return
 
-		except Exception as e:
-			if 'socked' in str(e):
-				rxgobj.notify_failure(thisrequest)
-				sys.stdout.write('F')
-				sys.stdout.flush()
+		if self.asynchronous:
+			# all connections are handled (and closed) by one event loop
+			asyncxorrequestor.run([rxgobj], self.window)
+			return
+
+		try:
+			rxgobj.connect(self.connectionpool)
+
+			# let's fire up the requested number of threads.   Our thread will also participate (-1 because of us!)
+			for tid in range(self.numberofmirrors - 1):
+				threading.Thread(target=_request_helper, args=[rxgobj, tid]).start()
+
+			_request_helper(rxgobj, self.numberofmirrors - 1)
+
+			# wait for receiving threads to finish
+			for mirror in rxgobj.activemirrors:
+				mirror.rt.join()
+
+			# a receiving thread gave up, e.g. because there were no backup mirrors left
+			for mirror in rxgobj.activemirrors:
+				if mirror.error != None:
+					raise mirror.error
+
+			rxgobj.cleanup()
+
+		except:
+			# we don't know in which state the connections are, don't reuse them
+			for mirror in rxgobj.activemirrors:
+				if mirror.sock != None:
+					self.connectionpool.discard(mirror.sock)
+			raise
+
+
+	def get_blocks(self, blocklist, blockcallback=None):
+		"""
+		<Purpose>
+			Retrieves blocks from the mirrors
+
+			With a block cache, cached blocks are not requested again. For every
+			cached block another (uncached) block is requested instead, so the
+			mirrors see the same number of queries as without the cache. These
+			blocks go into the cache as well.   Parallel queries also retrieve
+			uncached blocks for the cache in the chunks they would leave unused.
+
+		<Arguments>
+			blocklist: the numbers of the blocks to acquire
+
+			blockcallback: an optional function(blocknumber, block). It is called
+				(from the receiving threads) as soon as a block is complete.
+				The blocks are not kept then.
+
+		<Exceptions>
+			InsufficientMirrors if there are not enough mirrors.
+			socket errors may be raised if communications fail.
+
+		<Side Effects>
+			Contacts the mirrors. Takes shares from the query pool, if there is one.
+			Adds the retrieved blocks to the block cache, if there is one.
+
+		<Returns>
+			A dict mapping blocknumber -> blockcontents. It is empty if a
+			blockcallback is used.
+		"""
+
+		if self.blockcache == None:
+			return self._request_blocks(blocklist, blockcallback)
+
+		retdict = {}
+		if blockcallback == None:
+			def keep_block(blocknum, block):
+				retdict[blocknum] = block
+			blockcallback = keep_block
+
+		requestedblocks = []
+		cachedblocks = []
+		for blocknum in blocklist:
+			block = self.blockcache.get(self.manifestdigest, blocknum)
+			if block == None:
+				requestedblocks.append(blocknum)
 			else:
-				# otherwise, re-raise...
-				raise
+				cachedblocks.append(blocknum)
+				blockcallback(blocknum, block)
 
-		# regardless of failure or success, get another request...
-		thisrequest = rxgobj.get_next_xorrequest(tid)
+		if self.verbose and len(cachedblocks) > 0:
+			print("Blocks from the cache:", len(cachedblocks))
 
-	# and that's it!
-	return
+		wanted = set(requestedblocks)
 
+		# every cached block is replaced by a dummy block, which only goes into
+		# the cache
+		excluded = set(blocklist)
+		if len(cachedblocks) > 0:
+			requestedblocks.extend(self._dummy_blocks(cachedblocks, excluded))
 
-def request_blocks_from_mirrors(requestedblocklist, manifestdict, redundancy, rng, parallel):
-	"""
-	<Purpose>
-		Retrieves blocks from mirrors
+		# parallel queries retrieve uncached blocks in the chunks they would
+		# leave unused, without an additional query
+		fillerblocks = []
+		if self.parallel and len(requestedblocks) > 0:
+			fillerblocks = self._filler_blocks(requestedblocks, excluded)
 
-	<Arguments>
-		requestedblocklist: the blocks to acquire
+		def cache_block(blocknum, block):
+			self.blockcache.add(self.manifestdigest, self.manifestdict, blocknum, block)
+			# the dummy and filler blocks only go into the cache
+			if blocknum in wanted:
+				blockcallback(blocknum, block)
 
-		manifestdict: the manifest with information about the release
+		self._request_blocks(requestedblocks, cache_block, fillerblocks)
 
-	<Side Effects>
-		Contacts mirrors to retrieve blocks. It uses some global options
+		return retdict
 
-	<Exceptions>
-		TypeError may be raised if the provided lists are invalid.
-		socket errors may be raised if communications fail.
 
-	<Returns>
-		A dict mapping blocknumber -> blockcontents.
-	"""
+	def _chunk_range(self, chunknum):
+		"""private helper, returns the first and the end block of a chunk"""
+		blockcount = self.manifestdict['blockcount']
+		chunklen = lib.chunk_length(blockcount, self.numberofmirrors)
 
-	# let's get the list of mirrors...
-	if _commandlineoptions.vendorip == None:
-		# use data from manifest
-		mirrorinfolist = lib.retrieve_mirrorinfolist(manifestdict['vendorhostname'], manifestdict['vendorport'])
-	else:
-		# use commandlineoption
-		mirrorinfolist = lib.retrieve_mirrorinfolist(_commandlineoptions.vendorip)
+		if chunknum == self.numberofmirrors - 1:
+			return min(chunknum * chunklen, blockcount), blockcount
+		return min(chunknum * chunklen, blockcount), min((chunknum + 1) * chunklen, blockcount)
 
-	print("Mirrors: ", mirrorinfolist)
 
-	if _commandlineoptions.timing:
-		setup_start = _timer()
+	def _draw_blocks(self, firstblock, endblock, count, excluded, uncachedonly=True):
+		"""private helper, draws up to count random blocks from firstblock to
+		endblock - 1 that are not excluded (and, by default, not cached). The
+		drawn blocks are added to excluded. Without enough such blocks, fewer
+		are returned."""
+		population = endblock - firstblock
+		drawn = []
 
-	# no chunks (regular upPIR / Chor)
-	if redundancy == None:
+		# rejection sampling, gives up after a few rounds if the range is
+		# (almost) completely excluded or cached
+		for _ in range(DRAW_ROUNDS):
+			needed = count - len(drawn)
+			if needed <= 0 or population <= 0:
+				break
 
-		# let's set up a requestor object...
-		rxgobj = simplexorrequestor.RandomXORRequestor(mirrorinfolist, requestedblocklist, manifestdict, _commandlineoptions.numberofmirrors, _commandlineoptions.batch, _commandlineoptions.timing)
+			for blocknum in random.SystemRandom().sample(range(firstblock, endblock), min(population, 2 * needed)):
+				if blocknum in excluded or (uncachedonly and (self.manifestdigest, blocknum) in self.blockcache):
+					continue
 
-		if _commandlineoptions.timing:
-			setup_time = _timer() - setup_start
-			_timing_log.write(str(len(rxgobj.activemirrors[0]['blockbitstringlist']))+"\n")
-			_timing_log.write(str(len(rxgobj.activemirrors[0]['blockbitstringlist']))+"\n")
+				excluded.add(blocknum)
+				drawn.append(blocknum)
+				if len(drawn) == count:
+					break
 
-		print("Blocks to request:", len(rxgobj.activemirrors[0]['blockbitstringlist']))
+		return drawn
 
-		if _commandlineoptions.timing:
-			req_start = _timer()
 
-		# let's fire up the requested number of threads.   Our thread will also participate (-1 because of us!)
-		for tid in range(_commandlineoptions.numberofmirrors - 1):
-			threading.Thread(target=_request_helper, args=[rxgobj, tid]).start()
+	def _dummy_blocks(self, cachedblocks, excluded):
+		"""private helper, picks a random block for every cached block,
+		preferably one that is not cached yet. With parallel queries, it is in
+		the same chunk, so the number of queries doesn't change."""
+		if self.parallel:
+			blockcount = self.manifestdict['blockcount']
+			chunkcachedblocks = {}
+			for blocknum in cachedblocks:
+				chunkcachedblocks.setdefault(simplexorrequestor.chunk_of_block(blocknum, blockcount, self.numberofmirrors), []).append(blocknum)
 
-		_request_helper(rxgobj, _commandlineoptions.numberofmirrors - 1)
+			ranges = [(self._chunk_range(chunknum), blocks) for chunknum, blocks in chunkcachedblocks.items()]
+		else:
+			ranges = [((0, self.manifestdict['blockcount']), cachedblocks)]
 
-		# wait for receiving threads to finish
-		for mirror in rxgobj.activemirrors:
-			mirror['rt'].join()
+		dummies = []
+		for (firstblock, endblock), blocks in ranges:
+			drawn = self._draw_blocks(firstblock, endblock, len(blocks), excluded)
+			drawn.extend(self._draw_blocks(firstblock, endblock, len(blocks) - len(drawn), excluded, False))
 
-	else: # chunks
+			# a small release (or chunk) may not have enough other blocks, then
+			# the cached blocks are requested again
+			dummies.extend(drawn + blocks[len(drawn):])
 
-		# let's set up a chunk requestor object...
-		rxgobj = simplexorrequestor.RandomXORRequestorChunks(mirrorinfolist, requestedblocklist, manifestdict, _commandlineoptions.numberofmirrors, redundancy, rng, parallel, _commandlineoptions.batch, _commandlineoptions.timing)
+		return dummies
 
-		if _commandlineoptions.timing:
-			setup_time = _timer() - setup_start
-			_timing_log.write(str(len(rxgobj.activemirrors[0]['blocksneeded']))+"\n")
-			_timing_log.write(str(len(rxgobj.activemirrors[0]['blockchunklist']))+"\n")
 
-		print("# Blocks needed:", len(rxgobj.activemirrors[0]['blocksneeded']))
+	def _filler_blocks(self, requestedblocks, excluded):
+		"""private helper, picks random uncached blocks for the chunks that the
+		parallel queries for the requested blocks leave unused"""
+		blockcount = self.manifestdict['blockcount']
 
-		if parallel:
-			print("# Requests:", len(rxgobj.activemirrors[0]['blockchunklist']))
+		chunkcounts = collections.Counter([simplexorrequestor.chunk_of_block(blocknum, blockcount, self.numberofmirrors) for blocknum in requestedblocks])
+		rounds = max(chunkcounts.values())
+
+		fillerblocks = []
+		for chunknum in range(self.numberofmirrors):
+			firstblock, endblock = self._chunk_range(chunknum)
+			fillerblocks.extend(self._draw_blocks(firstblock, endblock, rounds - chunkcounts[chunknum], excluded))
+
+		return fillerblocks
+
+
+	def count_queries(self, blocklist):
+		"""
+		<Purpose>
+			Computes how many queries every mirror gets for these blocks, before
+			anything is sent.   With parallel queries, this is the number of
+			blocks in the chunk with the most blocks (see
+			simplexorrequestor.plan_parallel_queries). Otherwise it is one
+			query per block.
+
+		<Arguments>
+			blocklist: the numbers of the blocks to acquire
+
+		<Returns>
+			The number of queries (rounds)
+		"""
+		if self.parallel:
+			return len(simplexorrequestor.plan_parallel_queries(blocklist, self.manifestdict['blockcount'], self.numberofmirrors))
+
+		return len(blocklist)
+
+
+	def _request_blocks(self, blocklist, blockcallback=None, fillerblocks=()):
+		"""private helper, retrieves blocks from the mirrors, see get_blocks().
+		Parallel queries also retrieve the fillerblocks that fit."""
+
+		if len(blocklist) == 0:
+			return {}
+
+		if self.timing:
+			setup_start = _timer()
+
+		# no chunks (regular upPIR / Chor)
+		if self.redundancy == None:
+
+			# let's set up a requestor object...
+			if self.hedgepercentile != None:
+				rxgobj = simplexorrequestor.HedgedXORRequestor(self.mirrorinfolist, blocklist, self.manifestdict, self.numberofmirrors, self.batch, self.timing, self.querypool, blockcallback, self._select_mirrors, self.hedgepercentile, self.latencies)
+			else:
+				rxgobj = simplexorrequestor.RandomXORRequestor(self.mirrorinfolist, blocklist, self.manifestdict, self.numberofmirrors, self.batch, self.timing, self.querypool, blockcallback, self._select_mirrors)
+
+			if self.timing:
+				setup_time = _timer() - setup_start
+				self.timinglog.write(str(len(rxgobj.activemirrors[0].queries))+"\n")
+				self.timinglog.write(str(len(rxgobj.activemirrors[0].queries))+"\n")
+
+			if self.verbose:
+				print("Blocks to request:", len(rxgobj.activemirrors[0].queries))
+
+		else: # chunks
 
-		#chunk lengths in BYTE
-		global chunklen
-		global lastchunklen
-		chunklen = (manifestdict['blockcount'] / 8) / _commandlineoptions.numberofmirrors
-		lastchunklen = lib.bits_to_bytes(manifestdict['blockcount']) - (_commandlineoptions.numberofmirrors-1)*chunklen
+			# let's set up a chunk requestor object...
+			rxgobj = simplexorrequestor.RandomXORRequestorChunks(self.mirrorinfolist, blocklist, self.manifestdict, self.numberofmirrors, self.redundancy, self.rng, self.parallel, self.batch, self.timing, blockcallback, self._select_mirrors, fillerblocks)
 
-		if _commandlineoptions.timing:
+			if self.timing:
+				setup_time = _timer() - setup_start
+				self.timinglog.write(str(len(rxgobj.activemirrors[0].blocksneeded))+"\n")
+				self.timinglog.write(str(len(rxgobj.activemirrors[0].queries))+"\n")
+
+			if self.verbose:
+				print("# Blocks needed:", len(rxgobj.activemirrors[0].blocksneeded))
+
+				if self.parallel:
+					print("# Requests:", len(rxgobj.activemirrors[0].queries))
+
+		if self.timing:
 			req_start = _timer()
 
-		# let's fire up the requested number of threads.   Our thread will also participate (-1 because of us!)
-		for tid in range(_commandlineoptions.numberofmirrors - 1):
-			threading.Thread(target=_request_helper_chunked, args=[rxgobj, tid]).start()
+		self._retrieve(rxgobj)
+
+		if self.timing:
+			req_time = _timer() - req_start
+			recons_time, comptimes, pings = rxgobj.return_timings()
+
+			avg_ping = sum(pings) / self.numberofmirrors
+			avg_comptime = sum(comptimes) / self.numberofmirrors
+
+			self.timinglog.write(str(setup_time)+ "\n")
+			self.timinglog.write(str(req_time)+ "\n")
+			self.timinglog.write(str(recons_time)+ "\n")
+			self.timinglog.write(str(avg_comptime)+ " " + str(comptimes)+ "\n")
+			self.timinglog.write(str(avg_ping)+ " " + str(pings)+ "\n")
+
+		# okay, now we have them all. Let's get the returned dict ready.
+		retdict = {}
+		if blockcallback == None:
+			for blocknum in blocklist:
+				retdict[blocknum] = rxgobj.return_block(blocknum)
+
+		return retdict
+
+
+	def get_files(self, filenames):
+		"""
+		<Purpose>
+			Reconstitutes files by privately contacting mirrors. The blocks of
+			all files are retrieved together.
+
+		<Arguments>
+			filenames: the files to acquire
+
+		<Exceptions>
+			ValueError if a file is not in the release.
+			socket errors may be raised if communications fail.
+
+		<Returns>
+			A dict mapping filename -> filecontents.
+		"""
+
+		filelist = lib.get_filenames_in_release(self.manifestdict)
+
+		neededblocks = []
+		# let's figure out what blocks we need
+		for filename in filenames:
+			if filename not in filelist:
+				raise ValueError("The file " + filename + " is not listed in the manifest.")
+
+			theseblocks = lib.get_blocklist_for_file(filename, self.manifestdict)
+
+			# add the blocks we don't already know we need to request
+			for blocknum in theseblocks:
+				if blocknum not in neededblocks:
+					neededblocks.append(blocknum)
+
+		# do the actual retrieval work
+		blockdict = self.get_blocks(neededblocks)
+
+		retdict = {}
+		for filename in filenames:
+			filedata = lib.extract_file_from_blockdict(filename, self.manifestdict, blockdict)
+
+			# let's check the hash
+			thisfilehash = lib.find_hash(filedata, self.manifestdict['hashalgorithm'])
+
+			for fileinfo in self.manifestdict['fileinfolist']:
+				# find this entry
+				if fileinfo['filename'] == filename:
+					if thisfilehash == fileinfo['hash']:
+						# we found it and it checks out!
+						break
+					else:
+						raise Exception("Corrupt manifest has incorrect file hash despite passing block hash checks!")
+			else:
+				raise Exception("Internal Error: Cannot locate fileinfo in manifest!")
+
+			retdict[filename] = filedata
+
+		return retdict
+
 
-		_request_helper_chunked(rxgobj, _commandlineoptions.numberofmirrors - 1)
+	def write_files(self, filenames, directory="."):
+		"""
+		<Purpose>
+			Retrieves files and writes them to a directory.   Every block is
+			written to its place in the (preallocated) files as soon as it
+			arrives, so only the blocks in flight are kept in memory.
 
-		# wait for receiving threads to finish
-		for mirror in rxgobj.activemirrors:
-			mirror['rt'].join()
+			With a journal, the blocks are also written to the journal. If the
+			retrieval is interrupted, the next call for the same release only
+			requests the blocks that are not in the journal yet.
 
-	rxgobj.cleanup()
+		<Arguments>
+			filenames: the files to acquire
 
+			directory: where to write the files (without their path in the release)
+
+		<Exceptions>
+			ValueError if a file is not in the release.
+			socket errors may be raised if communications fail.
+
+		<Side Effects>
+			Creates or overwrites the files. Creates the journal and removes it
+			when all files are complete.
+
+		<Returns>
+			A list with the paths of the written files.
+		"""
+
+		filelist = lib.get_filenames_in_release(self.manifestdict)
+
+		# blocknumber -> list of (fd, offset in block, offset in file, length)
+		destinations = {}
+		fds = []
+		paths = []
+
+		try:
+			for filename in filenames:
+				if filename not in filelist:
+					raise ValueError("The file " + filename + " is not listed in the manifest.")
+
+				path = os.path.join(directory, os.path.basename(filename))
+				fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+				fds.append(fd)
+				paths.append(path)
+
+				# give the file its final size right away
+				segments = lib.get_file_segments(filename, self.manifestdict)
+				os.ftruncate(fd, sum([segment[3] for segment in segments]))
+
+				for (blocknum, blockoffset, fileoffset, length) in segments:
+					destinations.setdefault(blocknum, []).append((fd, blockoffset, fileoffset, length))
+
+			def write_block(blocknum, block):
+				# positional writes, the receiving threads don't share a file position
+				blockview = memoryview(block)
+				for (fd, blockoffset, fileoffset, length) in destinations[blocknum]:
+					os.pwrite(fd, blockview[blockoffset:blockoffset + length], fileoffset)
+
+			if self.journaldirectory != None:
+				journal = blockstore.BlockJournal(self.journaldirectory, self.manifestdict)
+
+				# the blocks of an interrupted retrieval don't need to be requested again
+				missingblocks = []
+				for blocknum in sorted(destinations):
+					if blocknum in journal:
+						write_block(blocknum, journal.get(blocknum))
+					else:
+						missingblocks.append(blocknum)
+
+				if self.verbose and len(journal) > 0:
+					print("Blocks from the journal:", len(destinations) - len(missingblocks))
+
+				def write_and_journal_block(blocknum, block):
+					journal.add(blocknum, block)
+					write_block(blocknum, block)
+
+				try:
+					self.get_blocks(missingblocks, write_and_journal_block)
+				finally:
+					journal.close()
+
+			else:
+				self.get_blocks(sorted(destinations), write_block)
+
+		finally:
+			for fd in fds:
+				os.close(fd)
+
+		# all blocks passed the hash check, now check the files against the manifest
+		for filename, path in zip(filenames, paths):
+			thisfilehash = lib.find_hash_of_file(path, self.manifestdict['hashalgorithm'])
+
+			for fileinfo in self.manifestdict['fileinfolist']:
+				if fileinfo['filename'] == filename:
+					if thisfilehash != fileinfo['hash']:
+						raise Exception("Corrupt manifest has incorrect file hash despite passing block hash checks!")
+					break
+
+		if self.journaldirectory != None:
+			# all blocks are where they belong
+			journal.remove()
+
+		return paths
+
+
+	def get_file(self, filename):
+		"""retrieves a single file, see get_files(). Returns the file contents."""
+		return self.get_files([filename])[filename]
+
+
+	def close(self):
+		"""tells the mirrors we are done and closes all connections"""
+		self.connectionpool.close()
+
+
+def _client_from_options(manifestdict, redundancy, rng, parallel):
+	"""private helper, creates a RaidPirClient with the command line options"""
 	if _commandlineoptions.timing:
-		req_time = _timer() - req_start
-		recons_time, comptimes, pings = rxgobj.return_timings()
+		timinglog = _timing_log
+	else:
+		timinglog = None
+
+	return RaidPirClient(manifestdict, numberofmirrors=_commandlineoptions.numberofmirrors,
+		redundancy=redundancy, rng=rng, parallel=parallel, batch=_commandlineoptions.batch,
+		vendorip=_commandlineoptions.vendorip, querypoolfile=_commandlineoptions.querypool,
+		asynchronous=_commandlineoptions.asynchronous, window=_commandlineoptions.window,
+		hedgepercentile=_commandlineoptions.hedge, selectionpolicy=_commandlineoptions.mirrorselection,
+		mirrorstatsfile=_commandlineoptions.mirrorstats, journaldirectory=_commandlineoptions.journal, timinglog=timinglog, verbose=True)
+
+
+def request_blocks_from_mirrors(requestedblocklist, manifestdict, redundancy, rng, parallel):
+	"""
+	<Purpose>
+		Retrieves blocks from mirrors
 
-		avg_ping = sum(pings) / _commandlineoptions.numberofmirrors
-		avg_comptime = sum(comptimes) / _commandlineoptions.numberofmirrors
+	<Arguments>
+		requestedblocklist: the blocks to acquire
 
-		_timing_log.write(str(setup_time)+ "\n")
-		_timing_log.write(str(req_time)+ "\n")
-		_timing_log.write(str(recons_time)+ "\n")
-		_timing_log.write(str(avg_comptime)+ " " + str(comptimes)+ "\n")
-		_timing_log.write(str(avg_ping)+ " " + str(pings)+ "\n")
+		manifestdict: the manifest with information about the release
 
-	# okay, now we have them all. Let's get the returned dict ready.
-	retdict = {}
-	for blocknum in requestedblocklist:
-		retdict[blocknum] = rxgobj.return_block(blocknum)
+	<Side Effects>
+		Contacts mirrors to retrieve blocks. It uses some global options
 
-	return retdict
+	<Exceptions>
+		TypeError may be raised if the provided lists are invalid.
+		socket errors may be raised if communications fail.
+
+	<Returns>
+		A dict mapping blocknumber -> blockcontents.
+	"""
+
+	client = _client_from_options(manifestdict, redundancy, rng, parallel)
+	try:
+		return client.get_blocks(requestedblocklist)
+	finally:
+		client.close()
 
 
 def request_files_from_mirrors(requestedfilelist, redundancy, rng, parallel, manifestdict):
@@ -299,43 +830,13 @@ def request_files_from_mirrors(requestedfilelist, redundancy, rng, parallel, man
 		None
 	"""
 
-	neededblocks = []
-	#print "Request Files:"
-	# let's figure out what blocks we need
-	for filename in requestedfilelist:
-		theseblocks = lib.get_blocklist_for_file(filename, manifestdict)
-
-		# add the blocks we don't already know we need to request
-		for blocknum in theseblocks:
-			if blocknum not in neededblocks:
-				neededblocks.append(blocknum)
-
-	# do the actual retrieval work
-	blockdict = request_blocks_from_mirrors(neededblocks, manifestdict, redundancy, rng, parallel)
-
-	# now we should write out the files
-	for filename in requestedfilelist:
-		filedata = lib.extract_file_from_blockdict(filename, manifestdict, blockdict)
-
-		# let's check the hash
-		thisfilehash = lib.find_hash(filedata, manifestdict['hashalgorithm'])
-
-		for fileinfo in manifestdict['fileinfolist']:
-			# find this entry
-			if fileinfo['filename'] == filename:
-				if thisfilehash == fileinfo['hash']:
-					# we found it and it checks out!
-					break
-				else:
-					raise Exception("Corrupt manifest has incorrect file hash despite passing block hash checks!")
-		else:
-			raise Exception("Internal Error: Cannot locate fileinfo in manifest!")
-
-
-		# open the filename w/o the dir and write it
-		filenamewithoutpath = os.path.basename(filename)
-		open(filenamewithoutpath, "wb").write(filedata)
-		print("wrote", filenamewithoutpath)
+	client = _client_from_options(manifestdict, redundancy, rng, parallel)
+	try:
+		# the files are written (w/o the dir) while the blocks arrive
+		for path in client.write_files(requestedfilelist):
+			print("wrote", path)
+	finally:
+		client.close()
 
 
 ########################## Option parsing and main ###########################
@@ -394,7 +895,7 @@ def parse_options():
 				help="Use seed expansion from RNG for latter chunks (default False). Requires -r")
 
 	parser.add_option("-p", "--parallel", action="store_true", dest="parallel", default=False,
-				help="Query one block per chunk in parallel (default False). Requires -r")
+				help="Query one block per chunk in parallel (default False). Requires -r, without -R the random chunks are sent to the mirrors")
 
 	parser.add_option("-b", "--batch", action="store_true", dest="batch", default=False,
 				help="Request the mirror to do computations in a batch. (default False)")
@@ -405,14 +906,36 @@ def parse_options():
 	parser.add_option("-c", "--comment", type="string", dest="comment", default="",
 				help="Debug comment on this run, used to name timing log file.")
 
+	parser.add_option("", "--async", action="store_true", dest="asynchronous", default=False,
+				help="Handle all mirror connections in one asyncio event loop instead of threads. (default False)")
+
+	parser.add_option("", "--window", dest="window", type="int", metavar="number",
+				default=asyncxorrequestor.DEFAULT_WINDOW,
+				help="Maximum number of outstanding requests per mirror with --async (default " + str(asyncxorrequestor.DEFAULT_WINDOW) + ").")
+
+	parser.add_option("", "--hedge", dest="hedge", type="float", metavar="percentile",
+				default=None, help="Request blocks again from backup mirrors if a mirror did not reply for longer than this percentile of the reply latencies (not with -r or --async).")
+
+	parser.add_option("", "--mirrorselection", dest="mirrorselection", type="choice",
+				choices=mirrorselection.POLICIES, default=mirrorselection.DEFAULT_POLICY, metavar="policy",
+				help="How to choose the mirrors: random, weighted (random, preferring fast mirrors with little load) or best (default " + mirrorselection.DEFAULT_POLICY + "). weighted and best trust the load the mirrors report.")
+
+	parser.add_option("", "--mirrorstats", dest="mirrorstats", type="string", metavar="filename",
+				default=None, help="File to keep the mirror statistics in between runs (default: don't keep them).")
+
+	parser.add_option("", "--journal", dest="journal", type="string", metavar="directory",
+				default=None, help="Keep retrieved blocks in a journal in this directory (created if necessary), so an interrupted retrieval can be resumed (default: no journal).")
+
+	parser.add_option("", "--querypool", dest="querypool", type="string", metavar="filename",
+				default=None, help="Use precomputed query shares from this file (not with -r).")
+
+	parser.add_option("", "--fillquerypool", dest="fillquerypool", type="int", metavar="number",
+				default=0, help="Precompute this many queries into the file given by --querypool (do this while idle).")
+
 
 	# let's parse the args
 	(_commandlineoptions, remainingargs) = parser.parse_args()
 
-	# Force the use of a seeded rng (-R) if MB (-p) is used. Temporary, until -p without -R is implemented.
-	if _commandlineoptions.parallel:
-		_commandlineoptions.rng = True
-
 	# sanity check parameters
 
 	# k >= 2
@@ -435,7 +958,28 @@ def parse_options():
 		print("Chunks must be enabled and redundancy set (-r <number>) to use RNG or parallel queries!")
 		sys.exit(1)
 
-	if len(remainingargs) == 0 and _commandlineoptions.printfiles == False:
+	if _commandlineoptions.window < 1:
+		print("The window must be at least 1")
+		sys.exit(1)
+
+	if _commandlineoptions.hedge != None and (_commandlineoptions.hedge <= 0 or _commandlineoptions.hedge >= 100):
+		print("The hedge percentile must be between 0 and 100")
+		sys.exit(1)
+
+	if _commandlineoptions.hedge != None and (_commandlineoptions.redundancy or _commandlineoptions.asynchronous):
+		print("Hedging can only be used without chunks (-r) and without --async!")
+		sys.exit(1)
+
+	# the pool holds full length shares, chunked queries can't use them
+	if _commandlineoptions.querypool and _commandlineoptions.redundancy:
+		print("A query pool can only be used without chunks (-r)!")
+		sys.exit(1)
+
+	if _commandlineoptions.fillquerypool < 0 or (_commandlineoptions.fillquerypool and not _commandlineoptions.querypool):
+		print("Filling a query pool requires a positive number and --querypool <filename>")
+		sys.exit(1)
+
+	if len(remainingargs) == 0 and _commandlineoptions.printfiles == False and _commandlineoptions.fillquerypool == 0:
 		print("Must specify at least one file to retrieve!")
 		sys.exit(1)
 
@@ -502,9 +1046,22 @@ def main():
 		print("Block count too low to use chunks! Try reducing the block size or add more files to the database.")
 		sys.exit(1)
 
+	if _commandlineoptions.parallel:
+		try:
+			simplexorrequestor.check_parallel_layout(manifestdict, _commandlineoptions.numberofmirrors)
+		except ValueError as e:
+			print(e)
+			sys.exit(1)
+
 	if _commandlineoptions.printfiles:
 		print("Manifest - Blocks:", manifestdict['blockcount'], "x", manifestdict['blocksize'], "Byte - Files:\n", filelist)
 
+	# precompute queries while we are idle, so they are ready at request time
+	if _commandlineoptions.fillquerypool:
+		pool = querypool.QueryPool(_commandlineoptions.querypool, manifestdict['blockcount'], _commandlineoptions.numberofmirrors)
+		pool.fill(_commandlineoptions.fillquerypool)
+		print("Query pool", _commandlineoptions.querypool, "now holds", len(pool), "queries.")
+
 	if _commandlineoptions.timing:
 		_timing_log.write(str(manifestdict['blocksize']) + "\n")
 		_timing_log.write(str(manifestdict['blockcount']) + "\n")
@@ -96,10 +96,18 @@ def parse_options():
 
 	parser.add_option("-o", "--offsetalgorithm", dest="offsetalgorithm",
 				type="string", metavar="algorithm", default="nogaps",
-				help="Chooses how to put the files into blocks (default is 'nogaps'). Use 'eqdist' for uniform distribution of the data entries.")
+				help="Chooses how to put the files into blocks (default is 'nogaps'). Use 'eqdist' for uniform distribution of the data entries, 'roundrobin' to spread consecutive blocks over the chunks of parallel queries.")
+
+	parser.add_option("-k", "--chunks", dest="chunks", type="int",
+				metavar="number", default=2,
+				help="The number of mirrors the clients query, for the 'roundrobin' layout (default 2)")
 
 	parser.add_option("-d", "--database", dest="database", metavar="filename", type="string", default=None, help="Create a single database file with this name and copy files into it.")
 
+	parser.add_option("", "--dbalign", dest="dbalign", type="int",
+				metavar="bytes", default=4096,
+				help="The blocks in the database file start at this offset, a multiple of 4096 (default 4096, use 2097152 for huge pages)")
+
 
 	# let's parse the args
 	(commandlineoptions, remainingargs) = parser.parse_args()
@@ -124,6 +132,14 @@ def parse_options():
 		print("Blocksize must be divisible by 64")
 		sys.exit(1)
 
+	if commandlineoptions.dbalign <= 0 or commandlineoptions.dbalign % 4096:
+		print("The database alignment must be a multiple of 4096")
+		sys.exit(1)
+
+	if commandlineoptions.chunks < 2:
+		print("The number of chunks must be at least 2")
+		sys.exit(1)
+
 	if commandlineoptions.vendorport <= 0 or commandlineoptions.vendorport > 65535:
 		print("Invalid vendorport")
 		sys.exit(1)
@@ -143,7 +159,10 @@ if __name__ == '__main__':
 		block_size=commandlineoptions.blocksize,
 		datastore_layout=commandlineoptions.offsetalgorithm,
 		vendorhostname=commandlineoptions.vendorhostname,
-		vendorport=commandlineoptions.vendorport)
+		vendorport=commandlineoptions.vendorport,
+		layoutchunks=commandlineoptions.chunks,
+		database=commandlineoptions.database,
+		dbalignment=commandlineoptions.dbalign)
 
 	# open the destination file
 	manifestfo = open(commandlineoptions.manifestfile, 'wb')
@@ -154,7 +173,4 @@ if __name__ == '__main__':
 
 	manifestfo.close()
 
-	if commandlineoptions.database != None:
-		lib._write_db(commandlineoptions.rootdir, commandlineoptions.database)
-
 	print("Generated manifest", commandlineoptions.manifestfile, "with", manifestdict['blockcount'], manifestdict['blocksize'], 'Byte blocks.')
@@ -39,6 +39,8 @@
 
 import sys
 
+import os
+
 import traceback
 
 import optparse
@@ -52,6 +54,9 @@ import fastsimplexordatastore
 # helper functions that are shared
 import raidpirlib as lib
 
+# a mirror can be split across several hosts
+import mirrorshards
+
 # This is used to communicate with clients with a message like abstraction
 import session
 
@@ -85,75 +90,177 @@ def _log(stringtolog):
 	_logfo.write(str(time.process_time()) +" "+stringtolog+"\n")
 	_logfo.flush()
 
+# the default release, for clients that don't name one and for HTTP
 _global_myxordatastore = None
 _global_manifestdict = None
 _request_restart = False
 
+# all releases this mirror serves: manifest digest -> (manifestdict, xordatastore)
+_global_releases = {}
+
+# the load we advertise: open client connections and answered requests since
+# the last advertisement
+_global_loadlock = threading.Lock()
+_global_connections = 0
+_global_requestcount = 0
+_global_lastadvertise = _timer()
+
 
 #################### Advertising ourself with the vendor ######################
 def _send_mirrorinfo():
 	"""private function that sends our mirrorinfo to the vendor"""
 
 
+	# shards are only known to their coordinator
+	if _commandlineoptions.shard != None:
+		return
+
 	# adding more information here  is a natural way to extend the mirror /
 	# client.   The vendor should not need to be changed
 	# at a minimum, the 'ip' and 'port' are required to provide the client with
 	# information about how to contact the mirror.
 	mymirrorinfo = {'ip':_commandlineoptions.ip, 'port':_commandlineoptions.port}
 
-	if _commandlineoptions.vendorip == None:
-		lib.transmit_mirrorinfo(mymirrorinfo, _global_manifestdict['vendorhostname'], _global_manifestdict['vendorport'])
-	else:
-		lib.transmit_mirrorinfo(mymirrorinfo, _commandlineoptions.vendorip, _global_manifestdict['vendorport'])
+	# clients prefer mirrors with little load
+	mymirrorinfo['load'] = _current_load()
+
+	# every vendor of a release we serve is told once
+	vendors = []
+	for manifestdict, _ in _global_releases.values():
+		if _commandlineoptions.vendorip == None:
+			vendor = (manifestdict['vendorhostname'], manifestdict['vendorport'])
+		else:
+			vendor = (_commandlineoptions.vendorip, manifestdict['vendorport'])
+		if vendor not in vendors:
+			vendors.append(vendor)
+
+	for vendorlocation, vendorport in vendors:
+		lib.transmit_mirrorinfo(mymirrorinfo, vendorlocation, vendorport)
+
+
+def _current_load():
+	"""private function that returns our load since the last call"""
+	global _global_requestcount
+	global _global_lastadvertise
+
+	with _global_loadlock:
+		now = _timer()
+		requestrate = _global_requestcount / max(now - _global_lastadvertise, 1)
+		_global_requestcount = 0
+		_global_lastadvertise = now
+
+		return {'connections': _global_connections, 'requestrate': round(requestrate, 2)}
+
+
+def _note_connection(change):
+	"""private function that counts the open client connections"""
+	global _global_connections
+	with _global_loadlock:
+		_global_connections = _global_connections + change
+
+
+def _note_request():
+	"""private function that counts the answered requests"""
+	global _global_requestcount
+	with _global_loadlock:
+		_global_requestcount = _global_requestcount + 1
 
 
 #################### Batch Answer Thread ######################
-def BatchAnswer(parallel, chunknumbers, sock):
-	global _batchrequests
-	global _xorstrings
-	global _finish
-	global _batch_comp_time
+class BatchQueue(object):
+	"""
+	<Purpose>
+		Collects the requests of one client connection, so they can be answered
+		in batches by a BatchAnswer thread.   Every connection has its own queue
+		and thread, so concurrent clients don't mix up their requests.
+	"""
+
+	def __init__(self, sock):
+		self.sock = sock
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+		self.xorstrings = []
+		self.requests = 0
+		self.finish = False
+		self.comp_time = 0
+		self.xordatastore = None
+		self.parallel = False
+		self.chunknumbers = []
+		self.thread = None
+
+
+	def start(self, xordatastore, parallel, chunknumbers):
+		"""set the release and params and start the batch thread, if it isn't
+		running yet"""
+		self.xordatastore = xordatastore
+		self.parallel = parallel
+		self.chunknumbers = chunknumbers
+
+		if self.thread == None:
+			self.thread = threading.Thread(target=BatchAnswer, args=[self], name="RAID-PIR Batch XOR")
+			self.thread.daemon = True
+			self.thread.start()
+
+
+	def add(self, bitstrings):
+		"""queue the bitstring(s) of one request and notify the batch thread"""
+		with self.lock:
+			self.xorstrings.append(bitstrings)
+			self.requests = self.requests + 1
+			self.event.set()
 
-	blocksize = _global_myxordatastore.sizeofblocks
-	_batch_comp_time = 0;
+
+	def stop(self):
+		"""tell the batch thread to return"""
+		self.finish = True
+		self.event.set()
+
+
+def BatchAnswer(batchqueue):
+	sock = batchqueue.sock
 
 	# while a client is connected
-	while not _finish:
+	while not batchqueue.finish:
 
 		# wait for signal to start
-		_batchevent.wait()
+		batchqueue.event.wait()
 
-		# create local copies and reset global values
-		with _batchlock:
-			batchrequests = _batchrequests
-			xorstrings = _xorstrings
-			_batchrequests = 0
-			_xorstrings = b''
+		# take the queued requests. The flag is cleared while holding the lock,
+		# so a request that is added concurrently always sets it again.
+		with batchqueue.lock:
+			batchrequests = batchqueue.requests
+			xorstrings = b''.join(batchqueue.xorstrings)
+			batchqueue.requests = 0
+			batchqueue.xorstrings = []
+			batchqueue.event.clear()
 
 		if batchrequests == 0:
-			# all request answered, remove flag and wait/return
-			_batchevent.clear()
+			# all request answered, wait/return
+			continue
 
-		else: # answer requests
-			start_time = _timer()
+		start_time = _timer()
 
-			if parallel:
-				xoranswer = _global_myxordatastore.produce_xor_from_multiple_bitstrings(xorstrings, batchrequests*len(chunknumbers))
-				_batch_comp_time = _batch_comp_time + _timer() - start_time
-				i = 0
-				for _ in range(batchrequests):
-					result = {}
-					for c in chunknumbers:
-						result[c] = xoranswer[i*blocksize : (i+1)*blocksize]
-						i = i + 1
+		xordatastore = batchqueue.xordatastore
+		blocksize = xordatastore.sizeofblocks
 
-					session.sendmessage(sock, msgpack.packb(result, use_bin_type=True))
+		if batchqueue.parallel:
+			chunknumbers = batchqueue.chunknumbers
+			xoranswer = xordatastore.produce_xor_from_multiple_bitstrings(xorstrings, batchrequests*len(chunknumbers))
+			batchqueue.comp_time = batchqueue.comp_time + _timer() - start_time
+			i = 0
+			for _ in range(batchrequests):
+				result = {}
+				for c in chunknumbers:
+					result[c] = xoranswer[i*blocksize : (i+1)*blocksize]
+					i = i + 1
 
-			else:
-				xoranswer = _global_myxordatastore.produce_xor_from_multiple_bitstrings(xorstrings, batchrequests)
-				_batch_comp_time = _batch_comp_time + _timer() - start_time
-				for i in range(batchrequests):
-					session.sendmessage(sock, xoranswer[i*blocksize : (i+1)*blocksize])
+				session.sendmessage(sock, msgpack.packb(result, use_bin_type=True))
+
+		else:
+			xoranswer = xordatastore.produce_xor_from_multiple_bitstrings(xorstrings, batchrequests)
+			batchqueue.comp_time = batchqueue.comp_time + _timer() - start_time
+			for i in range(batchrequests):
+				session.sendmessage(sock, xoranswer[i*blocksize : (i+1)*blocksize])
 
 
 ############################### Serve via RAID-PIR ###############################
@@ -165,21 +272,27 @@ class ThreadedXORServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 
 	def handle(self):
+		_note_connection(1)
+		try:
+			self._serve_requests()
+		finally:
+			_note_connection(-1)
+
+
+	def _serve_requests(self):
 
-		global _batchrequests
-		global _xorstrings
-		global _finish
-		global _batch_comp_time
-		global _global_myxordatastore
-		global _global_manifestdict
 		global _request_restart
 
-		_finish = False
+		# the release of this connection, until the params name another one
+		xordatastore = _global_myxordatastore
+
 		comp_time = 0
-		_batch_comp_time = 0
-		_batchrequests = 0
-		_xorstrings = b''
+		batch = False
 		parallel = False
+		cipher = None
+
+		# the requests of this connection that are answered in batches
+		batchqueue = BatchQueue(self.request)
 
 		requeststring = b'0'
 
@@ -194,21 +307,21 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 
 			# if it's a request for a XORBLOCK
 			if requeststring.startswith(b'X'):
+				_note_request()
 
 				bitstring = requeststring[len(b'X'):]
-				expectedbitstringlength = lib.bits_to_bytes(_global_myxordatastore.numberofblocks)
+				expectedbitstringlength = lib.bits_to_bytes(xordatastore.numberofblocks)
 
 				if len(bitstring) != expectedbitstringlength:
 					# Invalid request length...
 					#_log("RAID-PIR "+remoteip+" "+str(remoteport)+" Invalid request with length: "+str(len(bitstring)))
 					session.sendmessage(self.request, 'Invalid request length')
-					_finish = True
-					_batchevent.set()
+					batchqueue.stop()
 					return
 
 				if not batch:
 					# Now let's process this...
-					xoranswer = _global_myxordatastore.produce_xor_from_bitstring(bitstring)
+					xoranswer = xordatastore.produce_xor_from_bitstring(bitstring)
 					comp_time = comp_time + _timer() - start_time
 
 					# and immediately send the reply.
@@ -216,17 +329,13 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 					#_log("RAID-PIR "+remoteip+" "+str(remoteport)+" GOOD")
 
 				else:
-
-					with _batchlock:
-						_xorstrings += bitstring
-						_batchrequests = _batchrequests + 1
-
-					# notify batch thread
-					_batchevent.set()
+					# queue it and notify batch thread
+					batchqueue.add(bitstring)
 
 				# done!
 
 			elif requeststring.startswith(b'C'):
+				_note_request()
 
 				payload = requeststring[len(b'C'):]
 
@@ -236,7 +345,7 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 
 				if not batch:
 					# Now let's process this...
-					xoranswer = _global_myxordatastore.produce_xor_from_bitstring(bitstring)
+					xoranswer = xordatastore.produce_xor_from_bitstring(bitstring)
 					comp_time = comp_time + _timer() - start_time
 
 					# and send the reply.
@@ -244,16 +353,13 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 					#_log("RAID-PIR "+remoteip+" "+str(remoteport)+" GOOD")
 
 				else:
-					with _batchlock:
-						_xorstrings += bitstring
-						_batchrequests = _batchrequests + 1
-
-					# notify batch thread
-					_batchevent.set()
+					# queue it and notify batch thread
+					batchqueue.add(bitstring)
 
 				#done!
 
 			elif requeststring.startswith(b'R'):
+				_note_request()
 
 				payload = requeststring[len(b'R'):]
 
@@ -274,7 +380,7 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 
 				if not batch:
 					# Now let's process this...
-					xoranswer = _global_myxordatastore.produce_xor_from_bitstring(bitstring)
+					xoranswer = xordatastore.produce_xor_from_bitstring(bitstring)
 					comp_time = comp_time + _timer() - start_time
 
 					# and send the reply.
@@ -282,12 +388,8 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 					#_log("RAID-PIR "+remoteip+" "+str(remoteport)+" GOOD")
 
 				else:
-					with _batchlock:
-						_xorstrings += bitstring
-						_batchrequests = _batchrequests + 1
-
-					# notify batch thread
-					_batchevent.set()
+					# queue it and notify batch thread
+					batchqueue.add(bitstring)
 
 				#done!
 
@@ -296,14 +398,22 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 				_request_restart = True
 
 			elif requeststring.startswith(b'M'):
+				_note_request()
 				parallel = True
 
 				payload = requeststring[len(b'M'):]
 
 				chunks = msgpack.unpackb(payload, raw=False)
 
-				#iterate through r-1 random chunks
+				#iterate through r-1 random chunks. Without a seed, the client sends them.
 				for c in chunknumbers[1:]:
+					if c in chunks:
+						continue
+
+					if cipher == None:
+						session.sendmessage(self.request, 'Invalid request, random chunks missing')
+						batchqueue.stop()
+						return
 
 					if c == k - 1:
 						length = lastchunklen
@@ -319,20 +429,15 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 
 					result = {}
 					for c in chunknumbers:
-						result[c] = _global_myxordatastore.produce_xor_from_bitstring(bitstrings[c])
+						result[c] = xordatastore.produce_xor_from_bitstring(bitstrings[c])
 
 					comp_time = comp_time + _timer() - start_time
 
 					# and send the reply.
 					session.sendmessage(self.request, msgpack.packb(result, use_bin_type=True))
 				else:
-					with _batchlock:
-						for c in chunknumbers:
-							_xorstrings += bitstrings[c]
-						_batchrequests = _batchrequests + 1
-
-					# notify batch thread
-					_batchevent.set()
+					# queue it and notify batch thread
+					batchqueue.add(b''.join([bitstrings[c] for c in chunknumbers]))
 
 				#_log("RAID-PIR "+remoteip+" "+str(remoteport)+" GOOD")
 				#done!
@@ -353,12 +458,24 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 
 				if 's' in params:
 					cipher = lib.initAES(params['s'])
+				else:
+					cipher = None
+
+				# the digest of the manifest selects the release, older clients
+				# don't send it and get the default release
+				if 'm' in params:
+					if params['m'] not in _global_releases:
+						session.sendmessage(self.request, 'Unknown release')
+						batchqueue.stop()
+						return
+					xordatastore = _global_releases[params['m']][1]
+				else:
+					xordatastore = _global_myxordatastore
 
 				if batch:
-					# create batch xor thread
-					t = threading.Thread(target=BatchAnswer, args=[parallel, chunknumbers, self.request], name="RAID-PIR Batch XOR")
-					t.daemon = True
-					t.start()
+					# start the batch xor thread. A client that keeps the connection open
+					# may send new params later, the running thread uses them.
+					batchqueue.start(xordatastore, parallel, chunknumbers)
 
 				# and send the reply.
 				session.sendmessage(self.request, b"PARAMS OK")
@@ -367,9 +484,9 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 
 			#Timing Request
 			elif requeststring == b'T':
-				session.sendmessage(self.request, b"T" + str(comp_time + _batch_comp_time))
+				session.sendmessage(self.request, b"T" + str(comp_time + batchqueue.comp_time).encode('utf-8'))
 				comp_time = 0
-				_batch_comp_time = 0
+				batchqueue.comp_time = 0
 
 			#Debug Hello
 			elif requeststring == b'HELLO':
@@ -380,15 +497,13 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 			#the client asked to close the connection
 			elif requeststring == b'Q':
 				comp_time = 0
-				_finish = True
-				_batchevent.set()
+				batchqueue.stop()
 				return
 
 			#this happens if the client closed the socket unexpectedly
 			elif requeststring == b'':
 				comp_time = 0
-				_finish = True
-				_batchevent.set()
+				batchqueue.stop()
 				return
 
 			else:
@@ -396,8 +511,7 @@ class ThreadedXORRequestHandler(socketserver.BaseRequestHandler):
 				#_log("RAID-PIR "+remoteip+" "+str(remoteport)+" Invalid request type starts:'"+requeststring[:5]+"'")
 
 				session.sendmessage(self.request, 'Invalid request type')
-				_finish = True
-				_batchevent.set()
+				batchqueue.stop()
 				return
 
 
@@ -529,7 +643,11 @@ def parse_options():
 				metavar="dir", default=None,
 				help="The base directory where all mirror files are located.")
 
-	parser.add_option("-d", "--database", dest="database", metavar="filename", type="string", default=None, help="Read this database file.")
+	parser.add_option("-d", "--database", dest="database", metavar="filename", type="string", default=None, help="Read this database file. Together with --files, the database file is written from the files (as laid out by the manifest) first.")
+
+	parser.add_option("", "--dbalign", dest="dbalign", type="int",
+				metavar="bytes", default=4096,
+				help="The blocks in a database file written by the mirror start at this offset, a multiple of 4096 (default 4096, use 2097152 for huge pages)")
 
 	parser.add_option("", "--retrievemanifestfrom", dest="retrievemanifestfrom",
 				type="string", metavar="vendorIP:port", default="",
@@ -555,6 +673,30 @@ def parse_options():
 				action="store_true", default=False,
 				help="Use 4Russian precomputation to speedup PIR responses.")
 
+	parser.add_option("", "--hugepages", dest="hugepages", type="choice",
+				choices=list(fastsimplexordatastore.HUGEPAGES), default="none", metavar="setting",
+				help="Back the RAM datastore and the precomputed data with 2 MiB pages: 'none' (default), 'transparent' or 'explicit' (reserved in /proc/sys/vm/nr_hugepages)")
+
+	parser.add_option("", "--mmapadvice", dest="mmapadvice", type="string",
+				metavar="hints", default="",
+				help="Comma separated hints for the database file: 'populate' (read it at startup), 'willneed' (read it in the background), 'sequential' (for databases larger than the memory) and 'hugepage'")
+
+	parser.add_option("", "--release", dest="releases", type="string",
+				action="append", metavar="manifest:source", default=[],
+				help="Serve another release: its manifest file and its files (a directory) or database file. Can be given several times, clients select the release by the digest of its manifest.")
+
+	parser.add_option("", "--shard", dest="shard", type="string",
+				metavar="number/count", default=None,
+				help="Hold only the blocks of this shard (numbered from 0) for a coordinator, e.g. 1/4. Needs --files and is not announced to the vendor.")
+
+	parser.add_option("", "--shards", dest="shards", type="string",
+				metavar="IP:port,...", default=None,
+				help="Run as the coordinator of these shards (in the order of their numbers): queries are split among them and their answers are XORed. No files are needed.")
+
+	parser.add_option("", "--numa", dest="numa", action="store_true",
+				default=False,
+				help="Split the RAM datastore into one shard per NUMA node, each scanned by threads on its own node")
+
 	parser.add_option("", "--vendorip", dest="vendorip", type="string", metavar="IP",
 				default=None, help="Vendor IP for overwriting the value from manifest")
 
@@ -582,60 +724,188 @@ def parse_options():
 		print("Unknown options", remainingargs)
 		sys.exit(1)
 
-	if not (_commandlineoptions.database == None) ^ (_commandlineoptions.files == None):
-		print("Must specify either files or database")
+	if _commandlineoptions.shards != None:
+		if _commandlineoptions.files != None or _commandlineoptions.database != None or _commandlineoptions.releases or _commandlineoptions.http or _commandlineoptions.shard != None:
+			print("A coordinator (--shards) can't have files, a database, other releases, HTTP or be a shard")
+			sys.exit(1)
+
+		shardinfolist = []
+		for shardlocation in _commandlineoptions.shards.split(','):
+			shardip, _, shardport = shardlocation.rpartition(':')
+			if not shardip or not shardport.isdigit():
+				print("Shards must be given as IP:port,...")
+				sys.exit(1)
+			shardinfolist.append({'ip': shardip, 'port': int(shardport)})
+		_commandlineoptions.shards = shardinfolist
+
+	elif _commandlineoptions.database == None and _commandlineoptions.files == None and not _commandlineoptions.releases:
+		print("Must specify files, database or releases")
 		sys.exit(1)
 
+	if _commandlineoptions.shard != None:
+		if _commandlineoptions.files == None or _commandlineoptions.database != None or _commandlineoptions.releases:
+			print("A shard needs --files (without -d or other releases)")
+			sys.exit(1)
+
+		shardnumber, _, shardcount = _commandlineoptions.shard.partition('/')
+		if not shardnumber.isdigit() or not shardcount.isdigit() or int(shardnumber) >= int(shardcount):
+			print("The shard must be given as number/count, e.g. 0/4")
+			sys.exit(1)
+		_commandlineoptions.shard = (int(shardnumber), int(shardcount))
+
+	releases = []
+	for release in _commandlineoptions.releases:
+		manifestfilename, _, source = release.partition(':')
+		if not manifestfilename or not source:
+			print("A release must be given as manifest:source")
+			sys.exit(1)
+		releases.append((manifestfilename, source))
+	_commandlineoptions.releases = releases
+
+	if _commandlineoptions.dbalign <= 0 or _commandlineoptions.dbalign % 4096:
+		print("The database alignment must be a multiple of 4096")
+		sys.exit(1)
+
+	if _commandlineoptions.numa and _commandlineoptions.database != None:
+		print("--numa needs the datastore in RAM (--files without -d)")
+		sys.exit(1)
+
+	_commandlineoptions.mmapadvice = [advice for advice in _commandlineoptions.mmapadvice.split(',') if advice]
+	for advice in _commandlineoptions.mmapadvice:
+		if advice not in fastsimplexordatastore.MMAPADVICE:
+			print("Unknown mmap advice", advice)
+			sys.exit(1)
+
 	# try to open the log file...
 	_logfo = open(_commandlineoptions.logfilename, 'a')
 
 
-def main():
-	global _global_myxordatastore
-	global _global_manifestdict
-	global _batchlock
-	global _batchevent
-	global _xorstrings
-	global _batchrequests
-	global _request_restart
+def load_release(manifestdict, files, database, shard=None):
+	"""
+	<Purpose>
+		Creates the datastore of a release, from the files or a database file.
+		If both are given, the database file is written from the files first.
 
-	manifestdict = retrieve_manifest_dict()
+	<Arguments>
+		manifestdict: the manifest of the release
 
-	# We should detach here.   I don't do it earlier so that error
-	# messages are written to the terminal...   I don't do it later so that any
-	# threads don't exist already.   If I do put it much later, the code hangs...
-	if _commandlineoptions.daemonize:
-		daemon.daemonize()
+		files: the directory with the files or None
+
+		database: the database file or None
+
+		shard: (number, count) to hold only the blocks of a shard (needs the
+				files), None for all blocks
+
+	<Exceptions>
+		IncorrectFileContents if the database belongs to a different manifest
+		or the files don't match the manifest.
+
+	<Returns>
+		The datastore.
+	"""
+	if database != None:
+		if files != None:
+			print("Writing database file...")
+			start = _timer()
+			lib.write_db(manifestdict, files, database, _commandlineoptions.dbalign)
+			print("Took %f seconds." % (_timer() - start))
+
+		# the header tells which manifest the database belongs to
+		lib.check_db(manifestdict, database)
 
-	if _commandlineoptions.database != None:
 		print("Using mmap datastore")
 		dstype = "mmap"
-		source = _commandlineoptions.database
+		source = database
 	else:
 		print("Using RAM datastore")
 		dstype = "RAM"
-		source = _commandlineoptions.files
-
-	myxordatastore = fastsimplexordatastore.XORDatastore(manifestdict['blocksize'], manifestdict['blockcount'], dstype, source, _commandlineoptions.use_precomputed_data)
+		source = files
+
+	firstblock = 0
+	numblocks = manifestdict['blockcount']
+	if shard != None:
+		firstblock, numblocks = mirrorshards.shard_blockrange(manifestdict['blockcount'], shard[0], shard[1])
+		print("Shard", shard[0], "of", shard[1], "holds", numblocks, "blocks from block", firstblock)
+
+	nodes = None
+	if _commandlineoptions.numa and dstype == "RAM":
+		nodes = fastsimplexordatastore.numa_nodes()
+		if len(nodes) > 1:
+			print("Sharding the datastore across", len(nodes), "NUMA nodes")
+		else:
+			print("Only one NUMA node, the datastore is not sharded")
+			nodes = None
+
+	if nodes != None:
+		xordatastore = fastsimplexordatastore.ShardedXORDatastore(manifestdict['blocksize'], numblocks, nodes, _commandlineoptions.use_precomputed_data, _commandlineoptions.hugepages)
+	else:
+		xordatastore = fastsimplexordatastore.XORDatastore(manifestdict['blocksize'], numblocks, dstype, source, _commandlineoptions.use_precomputed_data, _commandlineoptions.hugepages, _commandlineoptions.mmapadvice)
 
 	if dstype == "RAM":
 		# now let's put the content in the datastore in preparation to serve it
 		print("Loading data into RAM datastore...")
 		start = _timer()
-		lib.populate_xordatastore(manifestdict, myxordatastore, source, dstype, _commandlineoptions.use_precomputed_data)
+		lib.populate_xordatastore(manifestdict, xordatastore, source, dstype, _commandlineoptions.use_precomputed_data, firstblock)
 		elapsed = (_timer() - start)
 		print("Datastore initialized. Took %f seconds." % elapsed)
 
+	return xordatastore
+
+
+def main():
+	global _global_myxordatastore
+	global _global_manifestdict
+	global _request_restart
+
+	# (manifestdict, files, database) of every release, the first one is the
+	# default release
+	releases = []
+	if _commandlineoptions.files != None or _commandlineoptions.database != None or _commandlineoptions.shards != None:
+		releases.append((retrieve_manifest_dict(), _commandlineoptions.files, _commandlineoptions.database))
+
+	for manifestfilename, source in _commandlineoptions.releases:
+		manifestdict = lib.parse_manifest(open(manifestfilename, "rb").read())
+		if os.path.isdir(source):
+			releases.append((manifestdict, source, None))
+		else:
+			releases.append((manifestdict, None, source))
+
+	# We should detach here.   I don't do it earlier so that error
+	# messages are written to the terminal...   I don't do it later so that any
+	# threads don't exist already.   If I do put it much later, the code hangs...
+	if _commandlineoptions.daemonize:
+		daemon.daemonize()
+
+	for manifestdict, files, database in releases:
+		manifestdigest = lib.manifest_digest(manifestdict)
+		if manifestdigest in _global_releases:
+			print("The release", manifestdigest, "is given twice")
+			sys.exit(1)
+
+		try:
+			if _commandlineoptions.shards != None:
+				print("Coordinating", len(_commandlineoptions.shards), "shards")
+				xordatastore = mirrorshards.RemoteShardsXORDatastore(manifestdict, _commandlineoptions.shards)
+			else:
+				xordatastore = load_release(manifestdict, files, database, _commandlineoptions.shard)
+		except (lib.IncorrectFileContents, ValueError) as e:
+			print(e)
+			sys.exit(1)
+
+		_global_releases[manifestdigest] = (manifestdict, xordatastore)
+		print("Serving release", manifestdigest)
+
+		if len(_global_releases) == 1:
+			defaultdigest = manifestdigest
+
+	manifestdict, myxordatastore = _global_releases[defaultdigest]
+
 	# we're now ready to handle clients!
 	#_log('ready to start servers!')
 
 	# an ugly hack, but Python's request handlers don't have an easy way to pass arguments
 	_global_myxordatastore = myxordatastore
 	_global_manifestdict = manifestdict
-	_batchlock = threading.Lock()
-	_batchevent = threading.Event()
-	_batchrequests = 0
-	_xorstrings = b''
 
 	# first, let's fire up the RAID-PIR server
 	xorserver = service_raidpir_clients(myxordatastore, _commandlineoptions.ip, _commandlineoptions.port)
@@ -19,6 +19,9 @@ import sys
 # used for os.path.exists, os.path.join and os.walk
 import os
 
+# for the header of database files
+import struct
+
 # only need ceil
 import math
 
@@ -42,6 +45,11 @@ if sys.version_info[0] != 3 or sys.version_info[1] < 5:
 
 import hashlib
 
+# the manifest builder hashes blocks in worker threads
+import concurrent.futures
+
+import collections
+
 from Crypto.Cipher import AES
 from Crypto.Util import Counter
 
@@ -50,6 +58,17 @@ _timer = time.perf_counter
 
 pirversion = "v0.9.5"
 
+# the header of a database file (see write_db), little endian: magic, format
+# version, reserved, block size, block count, offset of the first block and
+# the hex digest of the manifest. mmapxordatastore.h has the same layout.
+_DB_HEADER_FORMAT = '<8sIIQQQ64s'
+_DB_MAGIC = b"RAIDPIR\0"
+_DB_FORMAT_VERSION = 2
+
+# the blocks of a database file start at a multiple of this (a page). Use
+# 2 MiB to let the data be mapped with huge pages.
+_DB_ALIGNMENT = 4096
+
 # Exceptions...
 class FileNotFound(Exception):
 	"""The file could not be found"""
@@ -85,55 +104,6 @@ def _compute_block_hashlist_fromdatastore(xordatastore, blockcount, blocksize, h
 	return currenthashlist
 
 
-# implementation to read every file from disk to prevent ram from filling up. used for creating nogaps manifest.
-def _compute_block_hashlist_fromdisk(offsetdict, blockcount, blocksize, hashalgorithm):
-	"""private helper, used both the compute and check hashes"""
-
-	print("[INFO] Calculating block hashes with algorithm", hashalgorithm, "...")
-
-	if hashalgorithm in ['noop', 'none', None]:
-		currenthashlist = ['']*blockcount
-		return currenthashlist
-
-	currenthashlist = []
-	lastoffset = 0
-	thisblock = b''
-	pt = int(blockcount / 20)
-	nextprint = pt
-
-	for blocknum in range(blockcount):
-
-		if blockcount > 99 and blocknum >= nextprint:
-			print(blocknum, "/", blockcount,\
-				  "("+str(int(round(blocknum*1.0/blockcount*100)))+"%) done...")
-			nextprint = nextprint + pt
-
-		while len(thisblock) < blocksize:
-
-			if lastoffset in offsetdict:
-				fd = open(offsetdict[lastoffset], 'rb')
-				print("[INFO] reading", offsetdict[lastoffset])
-
-				thisfilecontents = fd.read()
-				fd.close()
-				lastlen = len(thisfilecontents)
-				lastoffset = lastoffset + lastlen
-				thisblock = thisblock + thisfilecontents
-
-				del fd
-				del thisfilecontents
-			else:
-				thisblock = thisblock + blocksize * b'\0'
-
-		# ... and check its hash
-		currenthashlist.append(find_hash(thisblock[:blocksize], hashalgorithm))
-
-		thisblock = thisblock[blocksize:]
-
-	print("[INFO] All blocks done.")
-	return currenthashlist
-
-
 def _validate_manifest(manifest):
 	"""private function that validates the manifest is okay"""
 	# it raises a TypeError if it's not valid for some reason
@@ -159,12 +129,8 @@ _supported_hashalgorithms = ['md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha51
 
 _supported_hashencodings = ['hex', 'raw']
 
-def find_hash(contents, algorithm):
-	"""Helper function for hashing"""
-
-	# first, if it's a noop, do nothing. For testing and debugging only.
-	if algorithm == 'noop' or algorithm == "none" or algorithm == None:
-		return ''
+def _new_hashobj(algorithm):
+	"""private helper, returns a (hashobj, hashencoding) tuple for an algorithm like 'sha256-raw'"""
 
 	# accept things like: "sha1", "sha256-raw", etc.
 	# before the '-' is one of the types known to hashlib.   After is
@@ -181,12 +147,11 @@ def find_hash(contents, algorithm):
 	if hashencoding not in _supported_hashencodings:
 		raise TypeError("Do not understand hash encoding: '" + algorithm + "'")
 
-	if hashalgorithmname == 'sha256':
-		hashobj = hashlib.sha256(contents)
-	else:
-		hashobj = hashlib.new(hashalgorithmname)
-		hashobj.update(contents)
+	return hashlib.new(hashalgorithmname), hashencoding
+
 
+def _hash_digest(hashobj, hashencoding):
+	"""private helper, returns the digest of hashobj in the requested encoding"""
 	if hashencoding == 'raw':
 		return hashobj.digest()
 	elif hashencoding == 'hex':
@@ -195,6 +160,42 @@ def find_hash(contents, algorithm):
 		raise Exception("Internal Error! Unknown hashencoding '" + hashencoding + "'")
 
 
+def find_hash(contents, algorithm):
+	"""Helper function for hashing"""
+
+	# first, if it's a noop, do nothing. For testing and debugging only.
+	if algorithm == 'noop' or algorithm == "none" or algorithm == None:
+		return ''
+
+	hashobj, hashencoding = _new_hashobj(algorithm)
+	hashobj.update(contents)
+
+	return _hash_digest(hashobj, hashencoding)
+
+
+def find_hash_of_file(filename, algorithm, readsize=1024 * 1024):
+	"""Helper function for hashing a file without reading all of it into memory"""
+
+	if algorithm == 'noop' or algorithm == "none" or algorithm == None:
+		return ''
+
+	hashobj, hashencoding = _new_hashobj(algorithm)
+
+	with open(filename, 'rb') as fd:
+		data = fd.read(readsize)
+		while data:
+			hashobj.update(data)
+			data = fd.read(readsize)
+
+	return _hash_digest(hashobj, hashencoding)
+
+
+def manifest_digest(manifestdict):
+	"""returns a hex digest that identifies a release, e.g. to name files that
+	belong to it. Only a manifest with the very same content has the same digest."""
+	return hashlib.sha256(msgpack.packb(manifestdict, use_bin_type=True)).hexdigest()
+
+
 def transmit_mirrorinfo(mirrorinfo, vendorlocation, defaultvendorport=62293):
 	"""
 	<Purpose>
@@ -455,7 +456,7 @@ def parse_manifest(rawmanifestdata):
 
 
 def populate_xordatastore(manifestdict, xordatastore, datasource, dstype,
-						  precompute):
+						  precompute, firstblock=0):
 	"""
 	<Purpose>
 		Adds the files listed in the manifestdict to the datastore
@@ -471,6 +472,9 @@ def populate_xordatastore(manifestdict, xordatastore, datasource, dstype,
 
 		precompute: Specifies whether preprocessing should be performed
 
+		firstblock: the datastore holds the blocks of the release from this one
+				on (a shard of a sharded mirror), data outside of them is skipped.
+
 	<Exceptions>
 		TypeError if the manifest is corrupt or the datasource is the wrong type.
 
@@ -494,14 +498,14 @@ def populate_xordatastore(manifestdict, xordatastore, datasource, dstype,
 	if dstype == "mmap":
 		_mmap_database(xordatastore, datasource)
 	else: # RAM
-		_add_data_to_datastore(xordatastore, manifestdict['fileinfolist'], datasource, manifestdict['hashalgorithm'], manifestdict['datastore_layout'], manifestdict['blocksize'])
+		_add_data_to_datastore(xordatastore, manifestdict['fileinfolist'], datasource, manifestdict['hashalgorithm'], manifestdict['datastore_layout'], manifestdict['blocksize'], firstblock)
 
-	hashlist = _compute_block_hashlist_fromdatastore(xordatastore, manifestdict['blockcount'], manifestdict['blocksize'], manifestdict['hashalgorithm'])
+	hashlist = _compute_block_hashlist_fromdatastore(xordatastore, xordatastore.numberofblocks, manifestdict['blocksize'], manifestdict['hashalgorithm'])
 
-	for blocknum in range(manifestdict['blockcount']):
+	for blocknum in range(xordatastore.numberofblocks):
 
-		if hashlist[blocknum] != manifestdict['blockhashlist'][blocknum]:
-			raise TypeError("Despite matching file hashes, block '" + str(blocknum) + "' has an invalid hash.\nCorrupt manifest or dirty xordatastore")
+		if hashlist[blocknum] != manifestdict['blockhashlist'][firstblock + blocknum]:
+			raise TypeError("Despite matching file hashes, block '" + str(firstblock + blocknum) + "' has an invalid hash.\nCorrupt manifest or dirty xordatastore")
 	# We're done!
 
 	if precompute:
@@ -516,11 +520,25 @@ def _mmap_database(xordatastore, dbname):
 	xordatastore.initialize(dbname)
 
 
-def _add_data_to_datastore(xordatastore, fileinfolist, rootdir, hashalgorithm, datastore_layout, blocksize):
+def _set_data_in_range(xordatastore, firstoffset, offset, data):
+	"""private helper, writes the part of data (at offset in the release) that
+	falls into a datastore which starts at firstoffset of the release"""
+	start = max(offset, firstoffset)
+	end = min(offset + len(data), firstoffset + xordatastore.numberofblocks * xordatastore.sizeofblocks)
+
+	if start == offset and end == offset + len(data):
+		xordatastore.set_data(offset - firstoffset, data)
+	elif start < end:
+		xordatastore.set_data(start - firstoffset, data[start - offset:end - offset])
+
+
+def _add_data_to_datastore(xordatastore, fileinfolist, rootdir, hashalgorithm, datastore_layout, blocksize, firstblock=0):
 	# Private helper to populate the datastore
-	if not datastore_layout in ['nogaps', 'eqdist']:
+	if not datastore_layout in ['nogaps', 'eqdist', 'roundrobin']:
 		raise ValueError("Unknown datastore layout: "+datastore_layout)
 
+	firstoffset = firstblock * blocksize
+
 	# go through the files one at a time and populate the xordatastore
 	for thisfiledict in fileinfolist:
 
@@ -552,8 +570,8 @@ def _add_data_to_datastore(xordatastore, fileinfolist, rootdir, hashalgorithm, d
 		# and add it to the datastore
 		if datastore_layout == 'nogaps':
 			thisoffset = thisfiledict['offset']
-			xordatastore.set_data(thisoffset, thisfilecontents)
-		elif datastore_layout == 'eqdist':
+			_set_data_in_range(xordatastore, firstoffset, thisoffset, thisfilecontents)
+		elif datastore_layout in ['eqdist', 'roundrobin']:
 			offsets = thisfiledict['offsets']
 			offsetsoffset = 0
 			fileoffset = 0
@@ -561,62 +579,186 @@ def _add_data_to_datastore(xordatastore, fileinfolist, rootdir, hashalgorithm, d
 				block_remaining_bytes = blocksize - (offsets[offsetsoffset]%blocksize)
 				bytes_to_add = min(len(thisfilecontents)-fileoffset, block_remaining_bytes)
 
-				xordatastore.set_data(
+				_set_data_in_range(xordatastore, firstoffset,
 					offsets[offsetsoffset], thisfilecontents[fileoffset:fileoffset+bytes_to_add])
 
 				fileoffset += bytes_to_add
 				offsetsoffset += 1
 
 
-def _create_offset_dict(offsetdict, fileinfolist, rootdir, hashalgorithm):
-	# Private helper to populate the datastore
+# the manifest builder reads the files in pieces of this size and hands the
+# blocks to its worker threads in batches of about this size
+_BUILDER_READSIZE = 4 * 1024 * 1024
 
-	# go through the files one at a time and populate the xordatastore
-	for thisfiledict in fileinfolist:
 
-		thisrelativefilename = thisfiledict['filename']
-		thisfilehash = thisfiledict['hash']
-		thisoffset = thisfiledict['offset']
-		thisfilelength = thisfiledict['length']
+def _release_filename(rootdir, fileinfo):
+	"""private helper, returns the path of a file of the release and checks that it exists below rootdir"""
+	filename = os.path.join(rootdir, fileinfo['filename'])
 
-		thisfilename = os.path.join(rootdir, thisrelativefilename)
+	if not os.path.exists(filename):
+		raise FileNotFound("File " + fileinfo['filename'] + " -->" + filename + " listed in manifest cannot be found in manifest root: " + rootdir + ".")
 
-		# read in the files and populate the xordatastore
-		if not os.path.exists(thisfilename):
-			raise FileNotFound("File " + thisrelativefilename + " -->" + thisfilename + " listed in manifest cannot be found in manifest root: " + rootdir + ".")
+	# can't go above the root!
+	if not os.path.normpath(os.path.abspath(filename)).startswith(os.path.abspath(rootdir)):
+		raise TypeError("File in manifest cannot go back from the root dir!!!")
 
-		# can't go above the root!
-		# JAC: I would use relpath, but it's 2.6 and on
-		if not os.path.normpath(os.path.abspath(thisfilename)).startswith(os.path.abspath(rootdir)):
-			raise TypeError("File in manifest cannot go back from the root dir!!!")
+	return filename
 
-		# get the relevant data
-		fd = open(thisfilename, 'rb')
-		thisfilecontents = fd.read()
 
-		# let's see if this has the right size
-		if len(thisfilecontents) != thisfilelength:
-			raise IncorrectFileContents("File '" + thisrelativefilename + "' has the wrong size")
+class _HashingFile(object):
+	"""
+	<Purpose>
+		Private helper for the layout functions.   Reads a file of the release
+		and computes its hash on the way, so that every file is read only once
+		while the manifest is built.
+	"""
 
-		# let's see if this has the right hash
-		if thisfilehash != find_hash(thisfilecontents, hashalgorithm):
-			raise IncorrectFileContents("File '" + thisrelativefilename + "' has the wrong hash")
+	def __init__(self, rootdir, fileinfo, hashalgorithm):
+		self.fileinfo = fileinfo
+		self.filename = _release_filename(rootdir, fileinfo)
 
-		fd.close()
-		del fd
-		del thisfilecontents
+		if hashalgorithm in ['noop', 'none', None]:
+			self.hashobj = None
+		else:
+			self.hashobj, self.hashencoding = _new_hashobj(hashalgorithm)
+
+		self.fd = open(self.filename, 'rb', buffering=_BUILDER_READSIZE)
+		self.length = 0
+
+
+	def read(self, size):
+		"""reads up to size bytes"""
+		data = self.fd.read(size)
+		if self.hashobj != None:
+			self.hashobj.update(data)
+		self.length = self.length + len(data)
+		return data
+
+
+	def close(self):
+		"""closes the file and puts its hash into the fileinfo"""
+		changed = self.length != self.fileinfo['length'] or self.fd.read(1) != b''
+		self.fd.close()
 
-		# and add it to the dict
-		offsetdict[thisoffset] = thisfilename
+		# the file must not change while the manifest is built
+		if changed:
+			raise IncorrectFileContents("File '" + self.fileinfo['filename'] + "' has the wrong size")
 
-	print("[INFO] Offset-Dict generated.")
+		if self.hashobj == None:
+			self.fileinfo['hash'] = ''
+		else:
+			self.fileinfo['hash'] = _hash_digest(self.hashobj, self.hashencoding)
 
 
-def datastore_layout_function_nogaps(fileinfolist, rootdir, blocksize, hashalgorithm):
+class _BlockSink(object):
+	"""
+	<Purpose>
+		Private helper for the layout functions.   Computes the block hashes
+		with a pool of worker threads (hashlib releases the GIL while hashing)
+		and optionally writes the blocks into a database file.   Blocks are
+		collected into batches, so small blocks don't need a task each.
+
+	<Example Use>
+		sink = _BlockSink(blockcount, blocksize, hashalgorithm)
+		sink.add(0, firstblocks)
+		...
+		hashlist = sink.finish()
+	"""
+
+	def __init__(self, blockcount, blocksize, hashalgorithm, dbfd=None, dboffset=0):
+		"""
+		<Purpose>
+			Starts the worker threads.
+
+		<Arguments>
+			blockcount: the number of blocks of the release
+
+			blocksize: the size of a block
+
+			hashalgorithm: the algorithm for the block hashes
+
+			dbfd: a file descriptor of a database file the blocks are written
+				to, or None
+
+			dboffset: where the first block starts in the database file
+		"""
+		self.hashlist = [''] * blockcount
+		self.blocksize = blocksize
+		self.hashalgorithm = hashalgorithm
+		self.dbfd = dbfd
+		self.dboffset = dboffset
+
+		self.workers = os.cpu_count() or 1
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+		self.batch = []
+		self.batchbytes = 0
+
+		# the batches that are processed, oldest first
+		self.pending = collections.deque()
+
+
+	def add(self, blocknum, data):
+		"""adds the data of one or more consecutive full blocks, the first one is blocknum"""
+		self.batch.append((blocknum, data))
+		self.batchbytes = self.batchbytes + len(data)
+
+		if self.batchbytes >= _BUILDER_READSIZE:
+			self._submit()
+
+
+	def _submit(self):
+		"""private helper, hands the current batch to the worker threads"""
+		if not self.batch:
+			return
+
+		self.pending.append(self.pool.submit(self._process, self.batch))
+		self.batch = []
+		self.batchbytes = 0
+
+		# the batches are kept in memory, so don't read too far ahead
+		while len(self.pending) > 2 * self.workers:
+			self._collect(self.pending.popleft())
+
+
+	def _process(self, batch):
+		"""private helper, runs in a worker thread"""
+		results = []
+		for blocknum, data in batch:
+			if self.dbfd != None:
+				os.pwrite(self.dbfd, data, self.dboffset + blocknum * self.blocksize)
+
+			view = memoryview(data)
+			hashes = []
+			for start in range(0, len(data), self.blocksize):
+				hashes.append(find_hash(view[start:start + self.blocksize], self.hashalgorithm))
+			results.append((blocknum, hashes))
+
+		return results
+
+
+	def _collect(self, future):
+		"""private helper, stores the hashes of a processed batch"""
+		for blocknum, hashes in future.result():
+			self.hashlist[blocknum:blocknum + len(hashes)] = hashes
+
+
+	def finish(self):
+		"""waits for all blocks and returns the list of block hashes"""
+		self._submit()
+		while self.pending:
+			self._collect(self.pending.popleft())
+
+		self.pool.shutdown()
+		return self.hashlist
+
+
+def datastore_layout_function_nogaps(fileinfolist, rootdir, blocksize, hashalgorithm, dbfd=None, dboffset=0):
 	"""
 	<Purpose>
 		Specifies how to map a set of files into offsets in an xordatastore.
-		This simple function just adds them linearly.
+		This simple function just adds them linearly.   Every file is read
+		once, its hash and the block hashes are computed on the way.
 
 	<Arguments>
 		fileinfolist: a list of dictionaries with file information
@@ -625,21 +767,27 @@ def datastore_layout_function_nogaps(fileinfolist, rootdir, blocksize, hashalgor
 
 		block_size: The size of a block of data.
 
+		hashalgorithm: The hash algorithm for the file and block hashes
+
+		dbfd: a file descriptor of a database file the blocks are written to,
+			or None
+
+		dboffset: where the first block starts in the database file
+
 	<Exceptions>
 		TypeError, IndexError, or KeyError if the arguements are incorrect
 
+		FileNotFound or IncorrectFileContents if a file is missing or changes
+
 	<Side Effects>
-		Modifies the fileinfolist to add offset elements to each dict
+		Modifies the fileinfolist to add offset and hash elements to each dict
 
 	<Returns>
-		None
+		The list of block hashes
 	"""
 
 	print("[INFO] Using `nogaps` algorithm.")
 
-	# Note, this algorithm doesn't use the blocksize.   Most of algorithms will.
-	# We also don't use the rootdir.   I think this is typical
-
 	currentoffset = 0
 
 	for thisfileinfo in fileinfolist:
@@ -672,18 +820,87 @@ def datastore_layout_function_nogaps(fileinfolist, rootdir, blocksize, hashalgor
 		# since this list is sorted by offset, this should ensure the property we want is upheld.
 		nextfreeoffset = offset + length
 
-	offsetdict = {}
-	_create_offset_dict(offsetdict, fileinfolist, rootdir, hashalgorithm)
-	print("[INFO] Indexing done ...")
+	print("[INFO] Calculating block hashes with algorithm", hashalgorithm, "...")
+
+	sink = _BlockSink(blockcount, blocksize, hashalgorithm, dbfd, dboffset)
 
-	# and it is time to get the blockhashlist...
-	# manifestdict['blockhashlist'] = _compute_block_hashlist(offsetdict, manifestdict['blockcount'], manifestdict['blocksize'], manifestdict['hashalgorithm'])
-	blockhashlist = _compute_block_hashlist_fromdisk(offsetdict, blockcount, blocksize, hashalgorithm)
+	# progress counter
+	pt = int(blockcount / 20)
+	nextprint = pt
+
+	# the files are read one after the other, only the bytes of an unfinished
+	# block are kept between two reads
+	unfinished = bytearray()
+	nextblock = 0
+
+	for thisfileinfo in fileinfolist:
+		fd = _HashingFile(rootdir, thisfileinfo, hashalgorithm)
+		print("[INFO] reading", fd.filename)
 
+		data = fd.read(_BUILDER_READSIZE)
+		while data:
+			unfinished += data
+			fullbytes = len(unfinished) - len(unfinished) % blocksize
+
+			if fullbytes > 0:
+				sink.add(nextblock, bytes(unfinished[:fullbytes]))
+				del unfinished[:fullbytes]
+				nextblock = nextblock + fullbytes // blocksize
+
+				if blockcount > 99 and nextblock >= nextprint:
+					print(nextblock, "/", blockcount,\
+						  "("+str(int(round(nextblock*1.0/blockcount*100)))+"%) done...")
+					nextprint = nextblock + pt
+
+			data = fd.read(_BUILDER_READSIZE)
+
+		fd.close()
+
+	# the last block has to be padded to full block size
+	if unfinished:
+		unfinished += (blocksize - len(unfinished)) * b'\0'
+		sink.add(nextblock, bytes(unfinished))
+
+	blockhashlist = sink.finish()
+
+	print("[INFO] All blocks done.")
 	return blockhashlist
 
 
-def datastore_layout_function_eqdist(fileinfolist, rootdir, blocksize, hashalgorithm):
+class _FreeBlockIndex(object):
+	"""
+	<Purpose>
+		Private helper for the eqdist layout.   Finds the first free block at or
+		after a given block (wrapping around at the end) in nearly constant
+		time.   Every used block points to the next block, the pointers are
+		shortened while searching (union-find with path compression).
+	"""
+
+	def __init__(self, blockcount):
+		self.nextfree = list(range(blockcount))
+		self.free = blockcount
+
+
+	def take(self, block):
+		"""marks a free block as used"""
+		self.nextfree[block] = (block + 1) % len(self.nextfree)
+		self.free = self.free - 1
+
+
+	def find(self, block):
+		"""returns the first free block at or after block. There must be one."""
+		root = block
+		while self.nextfree[root] != root:
+			root = self.nextfree[root]
+
+		# let everything on the way point to the free block
+		while self.nextfree[block] != root:
+			self.nextfree[block], block = root, self.nextfree[block]
+
+		return root
+
+
+def datastore_layout_function_eqdist(fileinfolist, rootdir, blocksize, hashalgorithm, dbfd=None, dboffset=0):
 	"""
 	<Purpose>
 		Specifies how to map a set of files into offsets in an xordatastore.
@@ -696,14 +913,23 @@ def datastore_layout_function_eqdist(fileinfolist, rootdir, blocksize, hashalgor
 
 		block_size: The size of a block of data.
 
+		hashalgorithm: The hash algorithm for the file and block hashes
+
+		dbfd: a file descriptor of a database file the blocks are written to,
+			or None
+
+		dboffset: where the first block starts in the database file
+
 	<Exceptions>
 		TypeError, IndexError, or KeyError if the arguements are incorrect
 
+		FileNotFound or IncorrectFileContents if a file is missing or changes
+
 	<Side Effects>
-		Modifies the fileinfolist to add offset elements to each dict
+		Modifies the fileinfolist to add offsets and hash elements to each dict
 
 	<Returns>
-		None
+		The list of block hashes
 	"""
 
 	print("[INFO] Using `eqdist` algorithm.")
@@ -717,7 +943,9 @@ def datastore_layout_function_eqdist(fileinfolist, rootdir, blocksize, hashalgor
 
 	blockcount = int(math.ceil(db_length * 1.0 / blocksize))
 
-	free_blocks = list(range(1, blockcount))
+	# the first block is used right away
+	free_blocks = _FreeBlockIndex(blockcount)
+	free_blocks.take(0)
 	currentoffset = 0
 	currentblock = 0
 	last_block = -1
@@ -727,23 +955,17 @@ def datastore_layout_function_eqdist(fileinfolist, rootdir, blocksize, hashalgor
 	pt = blockcount*1.0/20
 	nextprint = pt
 
-	# define the hashlist for the block hashes
-	hashlist = ['']*blockcount
+	# computes the block hashes (and writes the database file)
+	sink = _BlockSink(blockcount, blocksize, hashalgorithm, dbfd, dboffset)
 	current_block_content = b''
 
 
 	for thisfileinfo in fileinfolist:
 		thisfileinfo['offsets'] = []
 
-		thisfilename = os.path.join(rootdir, thisfileinfo['filename'])
-		print("[INFO] reading", thisfilename)
-
-		# prevent access above rootdir
-		if not os.path.normpath(os.path.abspath(thisfilename)).startswith(os.path.abspath(rootdir)):
-			raise TypeError("File in manifest cannot go back from the root dir!!!")
-
-		# open the file for reading (to compute the hash for the current block)
-		fd = open(thisfilename, 'rb')
+		# open the file for reading (to compute the hashes of the file and the current block)
+		fd = _HashingFile(rootdir, thisfileinfo, hashalgorithm)
+		print("[INFO] reading", fd.filename)
 
 		remainingbytes = thisfileinfo['length']
 		blocks_per_file = thisfileinfo['length']*1.0 / blocksize
@@ -759,7 +981,7 @@ def datastore_layout_function_eqdist(fileinfolist, rootdir, blocksize, hashalgor
 			currentoffset += bytes_to_add
 			current_block_content += fd.read(bytes_to_add)
 
-			if currentoffset % blocksize == 0 and len(free_blocks) != 0:
+			if currentoffset % blocksize == 0 and free_blocks.free != 0:
 				# block is full
 				last_block = int(currentoffset/blocksize) - 1
 
@@ -772,19 +994,13 @@ def datastore_layout_function_eqdist(fileinfolist, rootdir, blocksize, hashalgor
 
 
 				# calculate hash for block
-				hashlist[last_block] = find_hash(current_block_content, hashalgorithm)
+				sink.add(last_block, current_block_content)
 				current_block_content = b''
 
 				# find new free block
 				current_step += 1
-				block_candidate = (last_block + block_steps) % blockcount
-
-				while block_candidate not in free_blocks:
-					block_candidate += 1
-					if block_candidate == blockcount:
-						block_candidate = 0
-
-				free_blocks.remove(block_candidate)
+				block_candidate = free_blocks.find((last_block + block_steps) % blockcount)
+				free_blocks.take(block_candidate)
 
 				currentoffset = block_candidate * blocksize
 				block_remaining_bytes = blocksize
@@ -794,15 +1010,19 @@ def datastore_layout_function_eqdist(fileinfolist, rootdir, blocksize, hashalgor
 		del fd
 
 
-	assert len(free_blocks) == 0
+	assert free_blocks.free == 0
 
-	# the last block has to be padded to full block size
-	block_remaining_bytes = (blocksize - (currentoffset % blocksize))
-	current_block_content += block_remaining_bytes * b'\0'
+	# the last block has to be padded to full block size (unless the files
+	# filled it exactly)
+	if currentoffset % blocksize != 0:
+		block_remaining_bytes = (blocksize - (currentoffset % blocksize))
+		current_block_content += block_remaining_bytes * b'\0'
 
 	# calculate the hash for the last block
-	current_block = int(currentoffset/blocksize)
-	hashlist[current_block] = find_hash(current_block_content, hashalgorithm)
+	current_block = int((currentoffset - 1)/blocksize)
+	sink.add(current_block, current_block_content)
+
+	hashlist = sink.finish()
 
 	for h in hashlist:
 		assert h != ''
@@ -815,6 +1035,126 @@ def datastore_layout_function_eqdist(fileinfolist, rootdir, blocksize, hashalgor
 	return hashlist
 
 
+def datastore_layout_function_roundrobin(fileinfolist, rootdir, blocksize, hashalgorithm, chunks, dbfd=None, dboffset=0):
+	"""
+	<Purpose>
+		Specifies how to map a set of files into offsets in an xordatastore.
+		This function puts consecutive blocks into the chunks of a client that
+		queries the given number of mirrors in turn.   A parallel (MB) query
+		retrieves one block per chunk, so a file of n blocks needs about n/k
+		queries instead of n.
+
+	<Arguments>
+		fileinfolist: a list of dictionaries with file information
+
+		rootdir: the root directory where the files live
+
+		block_size: The size of a block of data.
+
+		hashalgorithm: The hash algorithm for the block hashes
+
+		chunks: the number of mirrors (k) the clients are expected to use
+
+		dbfd: a file descriptor of a database file the blocks are written to,
+			or None
+
+		dboffset: where the first block starts in the database file
+
+	<Exceptions>
+		TypeError, IndexError, or KeyError if the arguements are incorrect
+
+		FileNotFound or IncorrectFileContents if a file is missing or changes
+
+	<Side Effects>
+		Modifies the fileinfolist to add offsets and hash elements to each dict
+
+	<Returns>
+		The list of block hashes
+	"""
+
+	print("[INFO] Using `roundrobin` algorithm with", chunks, "chunks.")
+
+	db_length = 0
+	for thisfileinfo in fileinfolist:
+		db_length = db_length + thisfileinfo['length']
+
+	blockcount = int(math.ceil(db_length * 1.0 / blocksize))
+
+	# the chunks as the clients compute them, the last one may be longer
+	chunklen = chunk_length(blockcount, chunks)
+	if chunklen == 0:
+		# too few blocks for chunks, the clients can't use parallel queries
+		blockorder = list(range(blockcount))
+	else:
+		# the last chunk has a few more blocks (less than 8 per chunk). They
+		# are spread evenly between the rounds, so they don't end up together.
+		laststart = (chunks - 1) * chunklen
+		extrablocks = blockcount - laststart - chunklen
+		extrarounds = {}
+		for j in range(extrablocks):
+			extrarounds.setdefault(int((j + 0.5) * chunklen / extrablocks), []).append(laststart + chunklen + j)
+
+		# take the chunks in turn
+		blockorder = []
+		for i in range(chunklen):
+			for c in range(chunks):
+				blockorder.append(c * chunklen + i)
+			blockorder.extend(extrarounds.get(i, []))
+
+	# progress counter
+	pt = blockcount*1.0/20
+	nextprint = pt
+
+	# computes the block hashes (and writes the database file)
+	sink = _BlockSink(blockcount, blocksize, hashalgorithm, dbfd, dboffset)
+
+	# the files are written into the blocks in blockorder, one after the other
+	position = 0
+	current_block_content = b''
+
+	for thisfileinfo in fileinfolist:
+		thisfileinfo['offsets'] = []
+
+		fd = _HashingFile(rootdir, thisfileinfo, hashalgorithm)
+		print("[INFO] reading", fd.filename)
+
+		remainingbytes = thisfileinfo['length']
+		while remainingbytes > 0:
+			block = blockorder[position // blocksize]
+			thisfileinfo['offsets'].append(block * blocksize + position % blocksize)
+
+			# a piece ends with the file or at the end of the block
+			bytes_to_add = min(remainingbytes, blocksize - position % blocksize)
+			current_block_content += fd.read(bytes_to_add)
+			remainingbytes -= bytes_to_add
+			position += bytes_to_add
+
+			if position % blocksize == 0:
+				# block is full
+				sink.add(block, current_block_content)
+				current_block_content = b''
+
+				# show progress
+				if blockcount > 99 and position // blocksize >= nextprint:
+					print(position // blocksize, "/", blockcount,\
+						  "("+str(int(round(position*1.0/blocksize/blockcount*100)))+"%) done...")
+					nextprint = nextprint + pt
+
+		fd.close()
+
+	if position % blocksize != 0:
+		# the last block has to be padded to full block size
+		current_block_content += (blocksize - position % blocksize) * b'\0'
+		sink.add(blockorder[position // blocksize], current_block_content)
+
+	hashlist = sink.finish()
+
+	for h in hashlist:
+		assert h != ''
+
+	return hashlist
+
+
 def _find_blockloc_from_offset(offset, sizeofblocks):
 	# Private helper function that translates an offset into (block, offset)
 	assert offset >= 0
@@ -822,26 +1162,27 @@ def _find_blockloc_from_offset(offset, sizeofblocks):
 	return (int(offset / sizeofblocks), offset % sizeofblocks)
 
 
-def extract_file_from_blockdict(filename, manifestdict, blockdict):
+def get_file_segments(filename, manifestdict):
 	"""
 	<Purpose>
-		Reconstitutes a file from a block dict
+		Describes where the contents of a file are located in the blocks of
+		the release
 
 	<Arguments>
 		filename: the file within the release we are asking about
 
 		manifestdict: the manifest for the release
 
-		blockdict: a dictionary of blocknum -> blockcontents
-
 	<Exceptions>
-		TypeError, IndexError, or KeyError if the args are incorrect
+		TypeError, IndexError, or KeyError if the manifestdict / filename are
+		corrupt
 
 	<Side Effects>
 		None
 
 	<Returns>
-		A string containing the file contents
+		A list of (blocknumber, offset in block, offset in file, length) tuples,
+		in the order of the file
 	"""
 
 	blocksize = manifestdict['blocksize']
@@ -851,48 +1192,66 @@ def extract_file_from_blockdict(filename, manifestdict, blockdict):
 		if filename == fileinfo['filename']:
 
 			if database_layout == 'nogaps':
+				# one consecutive piece of the database
+				offsets = None
 				offset = fileinfo['offset']
-				quantity = fileinfo['length']
+			elif database_layout in ['eqdist', 'roundrobin']:
+				# one offset for every piece
+				offsets = fileinfo['offsets']
+			else:
+				raise Exception("Unknown database layout")
 
-				# Let's get the block information
-				(startblock, startoffset) = _find_blockloc_from_offset(offset, blocksize)
-				(endblock, endoffset) = _find_blockloc_from_offset(offset + quantity, blocksize)
+			segments = []
+			fileoffset = 0
+			remainingbytes = fileinfo['length']
 
-				# Case 1: this does not cross blocks
-				if startblock == endblock:
-					return blockdict[startblock][startoffset:endoffset]
+			while remainingbytes > 0:
+				if offsets != None:
+					offset = offsets[len(segments)]
 
-				# Case 2: this crosses blocks
+				(block, blockoffset) = _find_blockloc_from_offset(offset, blocksize)
 
-				# we'll build up the string starting with the first block...
-				currentstring = blockdict[startblock][startoffset:]
+				# a piece ends with the file or at the end of the block
+				length = min(remainingbytes, blocksize - blockoffset)
+				segments.append((block, blockoffset, fileoffset, length))
 
-				# now add in the 'middle' blocks.   This is all of the blocks
-				# after the start and before the end
-				for currentblock in range(startblock + 1, endblock):
-					currentstring += blockdict[currentblock]
+				offset = offset + length
+				fileoffset = fileoffset + length
+				remainingbytes = remainingbytes - length
 
-				# this check is needed because we might be past the last block.
-				if endoffset > 0:
-					# finally, add the end block.
-					currentstring += blockdict[endblock][:endoffset]
+			return segments
 
-				# and return the result
-				return currentstring
-			elif database_layout == 'eqdist':
-				offsets = fileinfo['offsets']
-				quantity = fileinfo['length']
+	raise TypeError("File is not in manifest")
 
-				currentstring = ''
 
-				for offset in offsets:
-					(block, blockoffset) = _find_blockloc_from_offset(offset, blocksize)
-					currentstring += blockdict[block][blockoffset:]
+def extract_file_from_blockdict(filename, manifestdict, blockdict):
+	"""
+	<Purpose>
+		Reconstitutes a file from a block dict
+
+	<Arguments>
+		filename: the file within the release we are asking about
+
+		manifestdict: the manifest for the release
+
+		blockdict: a dictionary of blocknum -> blockcontents
+
+	<Exceptions>
+		TypeError, IndexError, or KeyError if the args are incorrect
+
+	<Side Effects>
+		None
+
+	<Returns>
+		A string containing the file contents
+	"""
+
+	pieces = []
+	for (block, blockoffset, fileoffset, length) in get_file_segments(filename, manifestdict):
+		pieces.append(blockdict[block][blockoffset:blockoffset + length])
+
+	return b''.join(pieces)
 
-				currentstring = currentstring[:quantity]
-				return currentstring
-			else:
-				raise Exception("Unknown database layout")
 
 def get_blocklist_for_file(filename, manifestdict):
 	"""
@@ -924,7 +1283,7 @@ def get_blocklist_for_file(filename, manifestdict):
 				# ending offset -1 divided by the blocksize
 				# I do + 1 because range will otherwise omit the last block
 				return range(int(fileinfo['offset'] / blocksize), int((fileinfo['offset'] + fileinfo['length'] - 1) / blocksize + 1))
-			elif manifestdict['datastore_layout'] == 'eqdist':
+			elif manifestdict['datastore_layout'] in ['eqdist', 'roundrobin']:
 				offsets = fileinfo['offsets']
 				blocks = []
 				for offset in offsets:
@@ -962,8 +1321,9 @@ def get_filenames_in_release(manifestdict):
 	return filenamelist
 
 
-def _generate_fileinfolist(startdirectory, hashalgorithm="sha256-raw"):
-	"""private helper.   Generates a list of file information dictionaries for all files under startdirectory."""
+def _generate_fileinfolist(startdirectory, hashalgorithm="sha256-raw", hashfiles=True):
+	"""private helper.   Generates a list of file information dictionaries for all files under startdirectory.
+	With hashfiles=False the files are not read, the layout functions add the hashes."""
 
 	fileinfo_list = []
 
@@ -979,13 +1339,8 @@ def _generate_fileinfolist(startdirectory, hashalgorithm="sha256-raw"):
 			thisfiledict['length'] = os.path.getsize(fullfilename)
 
 			# get the hash
-			fd = open(fullfilename, 'rb')
-			filecontents = fd.read()
-			thisfiledict['hash'] = find_hash(filecontents, hashalgorithm)
-
-			fd.close()
-			del filecontents
-			del fd
+			if hashfiles:
+				thisfiledict['hash'] = find_hash_of_file(fullfilename, hashalgorithm)
 
 			fileinfo_list.append(thisfiledict)
 
@@ -993,34 +1348,199 @@ def _generate_fileinfolist(startdirectory, hashalgorithm="sha256-raw"):
 	return fileinfo_list
 
 
-def _write_db(startdirectory, dbname):
-	"""private helper. Writes all files into a single db file"""
+def _create_db_file(dbname, blockcount, blocksize, alignment=_DB_ALIGNMENT):
+	"""private helper. Creates a database file of its final size, returns the
+	file descriptor and the offset of the first block. The header is written
+	by _write_db_header once all blocks are in place."""
 
-	oo = open(dbname, 'wb')
+	if alignment <= 0 or alignment % 4096 != 0:
+		raise TypeError("The alignment of the database must be a multiple of 4096")
 
-	# Header
-	oo.write(b"RAIDPIRDB_" + pirversion.encode('utf-8'))
+	dbfd = os.open(dbname, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
 
-	# let's walk through the directories and add the files + sizes
-	for parentdir, junkchilddirectories, filelist in os.walk(startdirectory):
-		for filename in filelist:
-			thisfiledict = {}
-			# we want the relative name in the manifest, not the actual path / name
-			fullfilename = os.path.join(parentdir, filename)
+	# the header fits into the first page
+	dboffset = alignment
+
+	# reserve the space at once, so that the file is not fragmented.
+	# Everything that is not written stays zero (like the end of the last block)
+	dbsize = dboffset + blockcount * blocksize
+	try:
+		os.posix_fallocate(dbfd, 0, dbsize)
+	except (AttributeError, OSError):
+		# not every platform and file system supports this
+		os.ftruncate(dbfd, dbsize)
+
+	return dbfd, dboffset
+
+
+def _write_db_header(dbfd, blocksize, blockcount, dboffset, manifestdigest):
+	"""private helper. Writes the header of a database file. It is written
+	last, so a database file that was not completed is never valid."""
+
+	header = struct.pack(_DB_HEADER_FORMAT, _DB_MAGIC, _DB_FORMAT_VERSION, 0,
+		blocksize, blockcount, dboffset, manifestdigest.encode('ascii'))
+	os.pwrite(dbfd, header, 0)
+
+
+def read_db_header(dbname):
+	"""
+	<Purpose>
+		Reads the header of a database file.
+
+	<Arguments>
+		dbname: the name of the database file
+
+	<Exceptions>
+		IncorrectFileContents if the file is not a database file of this
+		format (e.g. an old one or one that was not completed)
+
+		OSError if the file can't be read
+
+	<Returns>
+		A dict with the formatversion, blocksize, blockcount, dataoffset and
+		manifestdigest
+	"""
+
+	with open(dbname, 'rb') as fd:
+		header = fd.read(struct.calcsize(_DB_HEADER_FORMAT))
+
+	if len(header) != struct.calcsize(_DB_HEADER_FORMAT) or not header.startswith(_DB_MAGIC):
+		raise IncorrectFileContents(dbname + " is not a RAID-PIR database (or was not completed)")
+
+	magic, formatversion, _, blocksize, blockcount, dataoffset, manifestdigest = struct.unpack(_DB_HEADER_FORMAT, header)
+
+	if formatversion != _DB_FORMAT_VERSION:
+		raise IncorrectFileContents(dbname + " has database format " + str(formatversion) + ", expected " + str(_DB_FORMAT_VERSION))
+
+	return {'formatversion': formatversion, 'blocksize': blocksize, 'blockcount': blockcount,
+		'dataoffset': dataoffset, 'manifestdigest': manifestdigest.rstrip(b'\0').decode('ascii')}
+
+
+def check_db(manifestdict, dbname):
+	"""
+	<Purpose>
+		Checks that a database file belongs to a manifest, without reading
+		the blocks.
+
+	<Arguments>
+		manifestdict: the manifest of the release
+
+		dbname: the name of the database file
+
+	<Exceptions>
+		IncorrectFileContents if the database doesn't belong to the manifest
+		or is too short
+
+	<Returns>
+		None
+	"""
+
+	header = read_db_header(dbname)
+
+	if header['manifestdigest'] != manifest_digest(manifestdict):
+		raise IncorrectFileContents(dbname + " was written for a different manifest")
 
-			# open and read file
-			fd = open(fullfilename)
-			filecontents = fd.read()
+	if os.path.getsize(dbname) < header['dataoffset'] + header['blocksize'] * header['blockcount']:
+		raise IncorrectFileContents(dbname + " is too short")
 
-			#append it to single db file
-			oo.write(filecontents);
 
-			fd.close()
-			del filecontents
-			del fd
+def _copy_file_range(srcfd, srcoffset, dstfd, dstoffset, length):
+	"""private helper. Copies a range of bytes between two files, inside the
+	kernel if the platform allows it"""
+
+	while length > 0:
+		copied = 0
+		try:
+			copied = os.copy_file_range(srcfd, dstfd, length, srcoffset, dstoffset)
+		except (AttributeError, OSError):
+			# not available (Python < 3.8, other platforms, some file systems)
+			pass
+
+		if copied == 0:
+			data = os.pread(srcfd, min(length, _BUILDER_READSIZE), srcoffset)
+			if not data:
+				raise IncorrectFileContents("File ended before all of its data was copied")
+			copied = os.pwrite(dstfd, data, dstoffset)
+
+		srcoffset = srcoffset + copied
+		dstoffset = dstoffset + copied
+		length = length - copied
+
+
+def write_db(manifestdict, rootdir, dbname, alignment=_DB_ALIGNMENT):
+	"""
+	<Purpose>
+		Writes all files of a release into a single database file (for the
+		mmap datastore), at the offsets the manifest assigned to them.
+
+	<Arguments>
+		manifestdict: the manifest of the release
+
+		rootdir: the directory with the files of the release
+
+		dbname: the name of the database file
+
+		alignment: the blocks start at this offset in the file, a multiple of
+			4096
+
+	<Exceptions>
+		FileNotFound if a file of the manifest is missing
+
+		IncorrectFileContents if a file has the wrong size
+
+		TypeError if a file is outside of rootdir
+
+	<Side Effects>
+		Creates (or overwrites) the database file.
+
+	<Returns>
+		None
+	"""
+
+	blocksize = manifestdict['blocksize']
+
+	dbfd, dboffset = _create_db_file(dbname, manifestdict['blockcount'], blocksize, alignment)
+
+	try:
+		for fileinfo in manifestdict['fileinfolist']:
+			srcfd = os.open(_release_filename(rootdir, fileinfo), os.O_RDONLY)
+
+			try:
+				if os.fstat(srcfd).st_size != fileinfo['length']:
+					raise IncorrectFileContents("File '" + fileinfo['filename'] + "' has the wrong size")
+
+				# the pieces of the file as (file offset, database offset, length)
+				if 'offsets' in fileinfo:
+					pieces = []
+					fileoffset = 0
+					for offset in fileinfo['offsets']:
+						piecelength = min(fileinfo['length'] - fileoffset, blocksize - offset % blocksize)
+						pieces.append((fileoffset, offset, piecelength))
+						fileoffset = fileoffset + piecelength
+				else:
+					pieces = [(0, fileinfo['offset'], fileinfo['length'])]
+
+				# pieces that follow each other in the database are copied at once
+				runstart, rundboffset, runlength = 0, 0, 0
+				for fileoffset, offset, piecelength in pieces:
+					if runlength > 0 and rundboffset + runlength == offset:
+						runlength = runlength + piecelength
+						continue
+
+					_copy_file_range(srcfd, runstart, dbfd, dboffset + rundboffset, runlength)
+					runstart, rundboffset, runlength = fileoffset, offset, piecelength
+
+				_copy_file_range(srcfd, runstart, dbfd, dboffset + rundboffset, runlength)
+
+			finally:
+				os.close(srcfd)
+
+		_write_db_header(dbfd, blocksize, manifestdict['blockcount'], dboffset, manifest_digest(manifestdict))
+
+	finally:
+		os.close(dbfd)
 
 	print("Database", dbname, "created.")
-	oo.close();
 
 
 def bits_to_bytes(num_bits):
@@ -1076,7 +1596,7 @@ def flip_array_bit(ba, bitnum):
 	return ba
 
 
-def create_manifest(rootdir=".", hashalgorithm="sha256-raw", block_size=1024 * 1024, datastore_layout="nogaps", vendorhostname=None, vendorport=62293):
+def create_manifest(rootdir=".", hashalgorithm="sha256-raw", block_size=1024 * 1024, datastore_layout="nogaps", vendorhostname=None, vendorport=62293, layoutchunks=2, database=None, dbalignment=_DB_ALIGNMENT):
 	"""
 	<Purpose>
 		Create a manifest
@@ -1090,6 +1610,14 @@ def create_manifest(rootdir=".", hashalgorithm="sha256-raw", block_size=1024 * 1
 
 		datastore_layout: specifies how to lay out the files in blocks.
 
+		layoutchunks: the number of mirrors (k) the 'roundrobin' layout is made for.
+
+		database: if given, a single database file with this name is written
+			while the files are read.
+
+		dbalignment: the blocks start at this offset in the database file, a
+			multiple of 4096
+
 	<Exceptions>
 		TypeError if the arguments are corrupt or of the wrong type
 
@@ -1098,9 +1626,7 @@ def create_manifest(rootdir=".", hashalgorithm="sha256-raw", block_size=1024 * 1
 		IncorrectFileContents if the file listed in the manifest file has the wrong size or hash
 
 	<Side Effects>
-		This function creates an XORdatastore while processing.   This may use
-		a very large amount of memory.   (This is not fundamental, and is done only
-		for convenience).
+		Reads every file once.   Creates the database file, if requested.
 
 	<Returns>
 		The manifest dictionary
@@ -1114,8 +1640,8 @@ def create_manifest(rootdir=".", hashalgorithm="sha256-raw", block_size=1024 * 1
 
 	# general workflow:
 	#   set the global parameters
-	#   build an xordatastore and add file information as you go
-	#   derive hash information from the xordatastore
+	#   list the files
+	#   read every file once, computing the file and block hashes as you go
 
 	manifestdict = {}
 
@@ -1126,8 +1652,8 @@ def create_manifest(rootdir=".", hashalgorithm="sha256-raw", block_size=1024 * 1
 	manifestdict['vendorport'] = vendorport
 	manifestdict['datastore_layout'] = datastore_layout
 
-	# first get the file information
-	fileinfolist = _generate_fileinfolist(rootdir, manifestdict['hashalgorithm'])
+	# first get the file information, the layout functions add the hashes
+	fileinfolist = _generate_fileinfolist(rootdir, manifestdict['hashalgorithm'], hashfiles=False)
 
 	# Let's see how many blocks we need
 	db_length = 0
@@ -1138,15 +1664,37 @@ def create_manifest(rootdir=".", hashalgorithm="sha256-raw", block_size=1024 * 1
 
 	# now let's assign the files to offsets as the caller requests and create
 	# the hashes for the PIR blocks
-	if datastore_layout == "nogaps":
-		manifestdict['blockhashlist'] = datastore_layout_function_nogaps(fileinfolist, rootdir, manifestdict['blocksize'], hashalgorithm)
-	elif datastore_layout == "eqdist":
-		manifestdict['blockhashlist'] = datastore_layout_function_eqdist(fileinfolist, rootdir, manifestdict['blocksize'], hashalgorithm)
-	else:
-		print("Unknown datastore layout function. Try 'nogaps' or 'eqdist'")
+	if datastore_layout not in ["nogaps", "eqdist", "roundrobin"]:
+		print("Unknown datastore layout function. Try 'nogaps', 'eqdist' or 'roundrobin'")
 		sys.exit(1)
 
-	manifestdict['fileinfolist'] = fileinfolist
+	# the blocks are written into the database file as they are hashed
+	dbfd = None
+	dboffset = 0
+	if database != None:
+		dbfd, dboffset = _create_db_file(database, manifestdict['blockcount'], manifestdict['blocksize'], dbalignment)
+
+	try:
+		if datastore_layout == "nogaps":
+			manifestdict['blockhashlist'] = datastore_layout_function_nogaps(fileinfolist, rootdir, manifestdict['blocksize'], hashalgorithm, dbfd, dboffset)
+		elif datastore_layout == "eqdist":
+			manifestdict['blockhashlist'] = datastore_layout_function_eqdist(fileinfolist, rootdir, manifestdict['blocksize'], hashalgorithm, dbfd, dboffset)
+		else:
+			manifestdict['layoutchunks'] = layoutchunks
+			manifestdict['blockhashlist'] = datastore_layout_function_roundrobin(fileinfolist, rootdir, manifestdict['blocksize'], hashalgorithm, layoutchunks, dbfd, dboffset)
+
+		manifestdict['fileinfolist'] = fileinfolist
+
+		# the header needs the digest of the complete manifest
+		if dbfd != None:
+			_write_db_header(dbfd, manifestdict['blocksize'], manifestdict['blockcount'], dboffset, manifest_digest(manifestdict))
+
+	finally:
+		if dbfd != None:
+			os.close(dbfd)
+
+	if database != None:
+		print("Database", database, "created.")
 
 	# we are done!
 	return manifestdict
@@ -1175,6 +1723,12 @@ def randombits(bitlength):
 	return randombytes
 
 
+def chunk_length(blockcount, k):
+	"""returns the length (in bits) of the first k-1 chunks of a query, the
+	last chunk holds the remaining blocks. It is a multiple of 8."""
+	return int(blockcount/8/k) * 8
+
+
 def build_bitstring_from_chunks(chunks, k, chunklen, lastchunklen):
 	"""
 	<Purpose>
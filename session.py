@@ -16,6 +16,15 @@ def recvmessage(socketobj):
 
 	# receive length of next message
 	msglen = socketobj.recv(lengthbytes)
+
+	# the length may arrive in pieces. If nothing arrives at all, the peer
+	# closed the connection and we return b'' (see below).
+	while 0 < len(msglen) < lengthbytes:
+		chunk = socketobj.recv(lengthbytes - len(msglen))
+		if chunk == b'':
+			raise SessionEOF("Connection Closed")
+		msglen = msglen + chunk
+
 	messagesize = int.from_bytes(msglen, byteorder = 'big', signed=True)
 
 	#print("rcv", messagesize, end="")
@@ -62,3 +71,43 @@ def sendmessage(socketobj, data):
 
 	#the data
 	_sendhelper(socketobj, data)
+
+
+# asyncio versions of the above, used by clients that drive many connections
+# from a single event loop. They speak exactly the same protocol.
+
+# get the next message off of an asyncio StreamReader...
+async def recvmessage_async(reader):
+
+	try:
+		# receive length of next message
+		msglen = await reader.readexactly(lengthbytes)
+	except EOFError:
+		raise SessionEOF("Connection Closed")
+
+	messagesize = int.from_bytes(msglen, byteorder = 'big', signed=True)
+
+	# nothing to read...
+	if messagesize == 0:
+		return b''
+
+	# end of messages
+	if messagesize == -1:
+		raise SessionEOF("Connection Closed")
+
+	if messagesize < 0:
+		raise ValueError("Bad message size")
+
+	try:
+		return await reader.readexactly(messagesize)
+	except EOFError:
+		raise SessionEOF("Connection Closed")
+
+# send the message on an asyncio StreamWriter, waiting if the send buffer is full
+async def sendmessage_async(writer, data):
+	if type(data) == str:
+		data = str.encode(data)
+
+	writer.write(len(data).to_bytes(lengthbytes, byteorder = 'big', signed=True))
+	writer.write(data)
+	await writer.drain()
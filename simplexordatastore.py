@@ -18,6 +18,11 @@ import math
 # alternative for fast XOR
 import numpy
 
+# the options of fastsimplexordatastore, this datastore ignores them
+HUGEPAGES = {'none': 0, 'transparent': 1, 'explicit': 2}
+
+MMAPADVICE = {'populate': 1, 'sequential': 2, 'willneed': 4, 'hugepage': 8}
+
 
 def do_xor(bytes_a, bytes_b):
 	"""
@@ -73,6 +78,39 @@ def do_xor_blocks(bytes_a, bytes_b):
 	return (n_a ^ n_b).tostring()
 
 
+def do_xor_multiple(byteslist):
+	"""
+	<Purpose>
+		Produce the XOR of a list of equal length strings
+
+	<Arguments>
+		byteslist: the strings to XOR
+
+	<Exceptions>
+		ValueError if the list is empty or the strings are of unequal lengths
+		TypeError if the strings are not strings
+
+	<Returns>
+		The XORed result.
+	"""
+	if len(byteslist) == 0:
+		raise ValueError("do_xor_multiple requires at least one string")
+
+	for thisbytes in byteslist:
+		if type(thisbytes) != bytes:
+			raise TypeError("do_xor_multiple must be called with bytes")
+
+		if len(thisbytes) != len(byteslist[0]):
+			raise ValueError("do_xor_multiple requires byte arrays of the same length")
+
+	# accumulate everything in a single buffer
+	result = numpy.frombuffer(byteslist[0], dtype='uint8').copy()
+	for thisbytes in byteslist[1:]:
+		numpy.bitwise_xor(result, numpy.frombuffer(thisbytes, dtype='uint8'), out=result)
+
+	return result.tobytes()
+
+
 def do_xor_old(string_a, string_b):
 	"""
 	<Purpose>
@@ -147,7 +185,7 @@ class XORDatastore(object):
 	numberofblocks = None
 	sizeofblocks = None
 
-	def __init__(self, block_size, num_blocks, dstype, dbname, use_precomputed_data=False):  # allocate
+	def __init__(self, block_size, num_blocks, dstype, dbname, use_precomputed_data=False, hugepages='none', mmapadvice=()):  # allocate
 		"""
 		<Purpose>
 			Allocate a place to store data for efficient XOR.
@@ -158,6 +196,9 @@ class XORDatastore(object):
 
 			num_blocks: the number of blocks.   This must be a positive integer
 
+			hugepages, mmapadvice: accepted for compatibility with
+									fastsimplexordatastore, they are ignored
+
 		<Exceptions>
 			TypeError is raised if invalid parameters are given.
 
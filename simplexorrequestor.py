@@ -24,6 +24,9 @@ import socket
 
 import session
 
+# precomputed query shares
+import querypool as querypool_module
+
 # to sleep...
 _timer = lib._timer
 
@@ -40,35 +43,109 @@ _randomnumberfunction = os.urandom
 # used for mirror selection...
 import random
 
+# O(1) queues for the per mirror bookkeeping
+import collections
+
 
 ########################### XORRequestGenerator ################################
 
 # receive thread
 def rcvlet(mirror, rxgobj):
-	sock = mirror['info']['sock']
+	try:
+		_receive_replies(mirror, rxgobj)
+	except Exception as e:
+		# the client raises this after joining us
+		mirror.error = e
+
+
+def _receive_replies(mirror, rxgobj):
+	"""private helper, receives the replies of a mirror and fails over to a
+	backup mirror if the connection breaks"""
+	sock = None
+	received = 0
+
+	# the mirror sends exactly one reply per request. Counting them (instead of
+	# looking at 'blocksrequested') also works if the sender is slower than us.
+	while received < mirror.replies:
+		try:
+			if sock is not mirror.sock:
+				# a new connection (the first one or one to a backup mirror). Check
+				# if the params were received correctly (a pooled connection may
+				# still have the right params, then none were sent).
+				sock = mirror.sock
+				if mirror.paramssent:
+					reply = session.recvmessage(sock)
+					if reply == b'':
+						raise session.SessionEOF("Connection Closed")
+					if reply != b'PARAMS OK':
+						raise Exception("Params were not delivered correctly or wrong format.")
+
+			data = session.recvmessage(sock)
+
+			# replies are never empty, the mirror closed the connection
+			if data == b'':
+				raise session.SessionEOF("Connection Closed")
+
+		except (OSError, session.SessionEOF):
+			rxgobj.notify_failure((mirror,), sock)
+			continue
+
+		with mirror.lock:
+			if sock is not mirror.sock:
+				# the connection was replaced meanwhile and the request was sent
+				# to the backup mirror again
+				continue
+
+			if mirror.skip > 0:
+				# the backup mirror answered a request we have the reply for
+				mirror.skip = mirror.skip - 1
+				continue
+
+			if mirror.seed != None:
+				mirror.answered = mirror.answered + 1
+			else:
+				mirror.sentqueries.popleft()
+
+		rxgobj.notify_success(mirror, data)
+		mirror.note_reply(data)
+		received = received + 1
+
 
-	# first, check if params were received correctly
-	if session.recvmessage(sock) != b'PARAMS OK':
-		raise Exception("Params were not delivered correctly or wrong format.")
+def request_message(xorrequest):
+	"""builds the message for a tuple returned by get_next_xorrequest"""
 
-	data = "0"
-	first = True
-	while data != '' and len(mirror['blocksrequested']) > 0 or first:
-		first = False
-		data = session.recvmessage(sock)
-		rxgobj.notify_success(mirror['info'], data)
+	# plain requests for the full bitstring have no request type
+	if len(xorrequest) == 3:
+		return b"X" + xorrequest[2]
+
+	rqtype = xorrequest[3]
+	if rqtype == 1: # chunks and seed expansion
+		prefix = b"R"
+	elif rqtype == 2: # chunks and parallel, the random chunks are only sent without seed expansion
+		prefix = b"M"
+	else: # only chunks (redundancy)
+		prefix = b"C"
+
+	return prefix + msgpack.packb(xorrequest[2], use_bin_type=True)
+
+
+def _order_mirrors(mirrorinfolist, mirrorselector):
+	"""private helper, returns a copy of mirrorinfolist in the order the mirrors
+	should be used. Without a selector, the order is random."""
+	if mirrorselector != None:
+		return mirrorselector(mirrorinfolist)
+
+	# I copy the mirrorinfolist to avoid changing the list in place.
+	orderedlist = mirrorinfolist[:]
+	random.shuffle(orderedlist)
+	return orderedlist
 
 
 def _reconstruct_block(blockinfolist):
 	# private helper to reconstruct a block
 
-	# xor the blocks together
-	ret = blockinfolist[0]
-	for xorblock in blockinfolist[1:]:
-		ret = xordatastore.do_xor(ret, xorblock)
-
-	# and return the answer
-	return ret
+	# xor the blocks together, in one pass
+	return xordatastore.do_xor_multiple(blockinfolist)
 
 
 def _reconstruct_block_parallel(responses, chunklen, k, blocklen, blocknumbers):
@@ -80,44 +157,403 @@ def _reconstruct_block_parallel(responses, chunklen, k, blocklen, blocknumbers):
 		index = min(int(blocknum/chunklen), k-1)
 
 		if index not in results:
-			results[index] = blocklen*b'\0'
+			# all answers for this chunk, xored in one pass
+			answers = [responses[m][index] for m in range(k) if index in responses[m]]
 
-	for m in range(k):
-		for c in results:
-			if c in responses[m]:
-				results[c] = xordatastore.do_xor(results[c], responses[m][c])
+			if len(answers) == 0:
+				results[index] = blocklen*b'\0'
+			else:
+				results[index] = xordatastore.do_xor_multiple(answers)
 
 	return results
 
 
+def chunk_of_block(blocknum, blockcount, k):
+	"""returns the number of the chunk a block is in"""
+	return min(int(blocknum/lib.chunk_length(blockcount, k)), k-1)
+
+
+def check_parallel_layout(manifestdict, k):
+	"""raises ValueError if parallel queries to k mirrors don't fit the layout
+	of the release. The roundrobin layout only puts consecutive blocks into
+	different chunks for the number of mirrors it was made for."""
+	if manifestdict.get('datastore_layout') == 'roundrobin' and manifestdict['layoutchunks'] != k:
+		raise ValueError("The release has the roundrobin layout for " + str(manifestdict['layoutchunks']) + " mirrors, parallel queries must use " + str(manifestdict['layoutchunks']) + " mirrors, not " + str(k))
+
+
+def plan_parallel_queries(blocklist, blockcount, k, fillerblocks=()):
+	"""
+	<Purpose>
+		Packs blocks into parallel (MB) queries.   A query retrieves at most one
+		block per chunk, so the chunk with the most blocks determines the number
+		of queries (rounds).   This packing needs no more than that.
+
+	<Arguments>
+		blocklist: the blocks to retrieve
+
+		blockcount: the number of blocks in the release
+
+		k: the number of mirrors (and chunks)
+
+		fillerblocks: other blocks, in order of preference. They are retrieved
+			in the chunks a query would leave unused, so they never add a query.
+
+	<Returns>
+		A list of queries, each a dict chunk number -> block number.   Its length
+		is the number of rounds.
+	"""
+
+	#map block numbers to chunks, keeping their order
+	blockchunks = {}
+	for blocknum in blocklist:
+		blockchunks.setdefault(chunk_of_block(blocknum, blockcount, k), []).append(blocknum)
+
+	if len(blockchunks) == 0:
+		return []
+
+	rounds = max([len(blocks) for blocks in blockchunks.values()])
+
+	queries = []
+	for i in range(rounds):
+		queries.append({})
+
+	for c in blockchunks:
+		for i, blocknum in enumerate(blockchunks[c]):
+			queries[i][c] = blocknum
+
+	# use the free chunks of the queries for the filler blocks
+	used = set(blocklist)
+	filled = {}
+	for blocknum in fillerblocks:
+		if blocknum in used:
+			continue
+
+		c = chunk_of_block(blocknum, blockcount, k)
+		i = filled.get(c, len(blockchunks.get(c, [])))
+		if i < rounds:
+			queries[i][c] = blocknum
+			filled[c] = i + 1
+			used.add(blocknum)
+
+	return queries
+
+
 class InsufficientMirrors(Exception):
 	"""There are insufficient mirrors to handle your request"""
 
 
+class MirrorState(object):
+	"""
+	<Purpose>
+		The state of a retrieval from one mirror.   The sending side takes the
+		queries from here, the receiving side gets a direct reference and
+		matches the replies without searching or locking: every reply belongs
+		to the oldest entry in blocksrequested.
+
+	<Side Effects>
+		None.
+	"""
+
+	def __init__(self, mirrorinfo, params, blocklist):
+		self.info = mirrorinfo
+
+		# parameters that are sent to the mirror once, when connecting
+		self.params = params
+
+		# the blocks that still have to be requested (only for the client, obviously)
+		self.blocksneeded = collections.deque(blocklist)
+
+		# the blocks (lists of blocks for parallel queries) that were requested,
+		# oldest first
+		self.blocksrequested = collections.deque()
+
+		# the prepared queries (bitstrings or chunk dicts), in the order they are sent
+		self.queries = collections.deque()
+
+		# how many replies the mirror will send
+		self.replies = 0
+
+		# set by the requestors that use chunks
+		self.chunknumbers = []
+		self.parallelblocksneeded = collections.deque()
+		self.seed = None
+		self.cipher = None
+
+		# set when connecting
+		self.sock = None
+		self.paramssent = False
+		self.rt = None
+
+		# the messages that were sent but not answered yet, in order. They are
+		# sent again if we have to fail over to a backup mirror.
+		self.sentqueries = collections.deque()
+
+		# with seed expansion, the mirror's random stream advances with every
+		# request. A backup mirror has to get all requests again to end up at
+		# the same position, so the answered ones are kept as well: the first
+		# 'answered' entries of sentqueries. The backup's replies to these are
+		# dropped ('skip').
+		self.answered = 0
+		self.skip = 0
+
+		# guards sock, sentqueries, answered and skip.   It is never held while
+		# sending or receiving, the receiving thread needs it after every reply.
+		self.lock = threading.Lock()
+
+		# held while a request (or the requests for a backup mirror) is sent, so
+		# the messages reach the connection in the order of sentqueries
+		self.sendlock = threading.Lock()
+
+		# held while the mirror is replaced by a backup mirror
+		self.failoverlock = threading.Lock()
+
+		# the mirrors that failed and were replaced by this one
+		self.failedmirrors = []
+
+		# set if the receiving thread gave up
+		self.error = None
+
+		# timing info
+		self.comptime = 0
+		self.ping = 0
+
+		# for the mirror statistics (see mirrorselection.py), the
+		# HedgedXORRequestor also uses them to detect slow mirrors
+		self.connecttime = 0
+		self.firstreply = 0
+		self.lastreply = 0
+		self.bytesreceived = 0
+
+		# set by the HedgedXORRequestor when it gives up on the mirror
+		self.abandoned = False
+
+
+	def note_reply(self, data):
+		"""notes the arrival of a reply for the statistics"""
+		now = _timer()
+		if self.firstreply == 0:
+			self.firstreply = now
+		self.lastreply = now
+		self.bytesreceived = self.bytesreceived + len(data)
+
+
+	def return_stats(self):
+		"""returns (mirrorinfo, latency, throughput) of this retrieval, with a
+		latency of None if the mirror did not reply at all"""
+		if self.firstreply == 0:
+			return (self.info, None, None)
+
+		latency = self.firstreply - self.connecttime
+		if self.lastreply > self.connecttime:
+			throughput = self.bytesreceived / (self.lastreply - self.connecttime)
+		else:
+			throughput = None
+
+		return (self.info, latency, throughput)
+
+
 # Super class of requestors that offers identical functions
 class Requestor(object):
 
+	def connect(self, connectionpool=None):
+		"""open a socket to each active mirror (or take one from the connection
+		pool), send the params and start a receiving thread per mirror"""
+		self.connectionpool = connectionpool
+
+		for mirror in self.activemirrors:
+			try:
+				mirror.sock = self._open_connection(mirror)
+			except OSError:
+				# the mirror is down, use a backup
+				self.notify_failure((mirror,))
+
+			# start separate receiving thread for this socket
+			t = threading.Thread(target=rcvlet, args=[mirror, self], name=("rcv_thread_" + str((mirror.info['ip'], mirror.info['port']))))
+			mirror.rt = t
+			t.start()
+
+
+	def _open_connection(self, mirror):
+		"""private helper, connects to a mirror (or takes a connection from the
+		pool) and sends the params if necessary, rcvlet will check the response.
+		Returns the socket, the caller makes it the mirror's connection."""
+		mirror.connecttime = _timer()
+
+		if self.connectionpool != None:
+			# the pool only sends the params if the connection has different ones
+			sock, mirror.paramssent = self.connectionpool.acquire(mirror.info, mirror.params)
+
+		else:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) #TODO check this in the cloud
+			try:
+				sock.connect((mirror.info['ip'], mirror.info['port']))
+				session.sendmessage(sock, b"P" + msgpack.packb(mirror.params, use_bin_type=True))
+			except OSError:
+				sock.close()
+				raise
+			mirror.paramssent = True
+
+		return sock
+
+
+	def _close_failed(self, sock):
+		"""private helper, closes a broken connection. Shutting it down first
+		wakes up a thread that is blocked on it."""
+		try:
+			sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+		if self.connectionpool != None:
+			self.connectionpool.discard(sock)
+		else:
+			sock.close()
+
+
+	def send_xorrequest(self, xorrequesttuple):
+		"""
+		<Purpose>
+			Sends a request that was returned by get_next_xorrequest to its mirror.
+			If the connection is broken, fails over to a backup mirror.
+
+		<Arguments>
+			xorrequesttuple: the tuple returned by get_next_xorrequest
+
+		<Exceptions>
+			InsufficientMirrors if the mirror failed and there is no backup left
+
+		<Returns>
+			None
+		"""
+		mirror = xorrequesttuple[0]
+		message = request_message(xorrequesttuple)
+
+		with mirror.sendlock:
+			with mirror.lock:
+				mirror.sentqueries.append(message)
+				sock = mirror.sock
+
+			# the mirror may only read our next request after we received its
+			# replies, so don't hold the lock the receiving thread needs
+			try:
+				session.sendmessage(sock, message)
+				return
+			except OSError:
+				pass
+
+		# the failover sends it again, together with all other unanswered requests
+		self.notify_failure(xorrequesttuple, sock)
+
+
+	def notify_failure(self, xorrequesttuple, failedsock=None):
+		"""
+		<Purpose>
+			Handles that a mirror has failed: connects to a backup mirror instead,
+			sends it the same params and all requests the failed mirror did not
+			answer yet.   The backup gets the very same shares, so privacy is not
+			affected.
+
+		<Arguments>
+			xorrequesttuple: a tuple returned by get_next_xorrequest (only the
+				mirror in the first field is used)
+
+			failedsock: the connection that failed. If the mirror uses a different
+				connection already, another thread did the failover and nothing
+				happens. None for the current connection.
+
+		<Exceptions>
+			InsufficientMirrors if there are not enough mirrors
+
+		<Side Effects>
+			Closes the failed connection and opens a new one.
+
+		<Returns>
+			None
+		"""
+		mirror = xorrequesttuple[0]
+
+		with mirror.failoverlock:
+			with mirror.lock:
+				if failedsock == None:
+					failedsock = mirror.sock
+
+				# somebody else took care of it already
+				if mirror.sock is not failedsock:
+					return
+
+				if mirror.error != None:
+					raise mirror.error
+
+			# (there is no connection if connecting failed). Closing it also wakes
+			# up the sending thread if it is blocked on it.
+			if failedsock != None:
+				self._close_failed(failedsock)
+
+			# no other requests are sent until the backup has all requests
+			with mirror.sendlock:
+				while True:
+					with self.tablelock:
+						# if we're out of replacements, quit
+						if len(self.backupmirrorinfolist) == 0:
+							mirror.error = InsufficientMirrors("There are no replacement mirrors")
+							raise mirror.error
+
+						nextmirrorinfo = self.backupmirrorinfolist.pop(0)
+
+					# the statistics are about the new mirror from now on
+					mirror.failedmirrors.append(mirror.info)
+					mirror.info = nextmirrorinfo
+					mirror.firstreply = 0
+					mirror.bytesreceived = 0
+
+					try:
+						sock = self._open_connection(mirror)
+					except OSError:
+						# the backup doesn't work either, try the next one
+						continue
+
+					# switch to the new connection. The receiving thread drops the
+					# replies to the requests that were answered already.
+					with mirror.lock:
+						mirror.sock = sock
+						mirror.skip = mirror.answered
+						messages = list(mirror.sentqueries)
+
+					try:
+						for message in messages:
+							session.sendmessage(sock, message)
+						return
+
+					except OSError:
+						self._close_failed(sock)
+
+
 	def cleanup(self):
-		"""cleanup. here: maybe request debug timing info and always close sockets"""
+		"""cleanup. here: maybe request debug timing info and close the sockets
+		or return them to the connection pool"""
 		for mirror in self.activemirrors:
 
 			if self.timing:
 				# request total computation time and measure delay
 				ping_start = _timer()
-				session.sendmessage(mirror['info']['sock'], "T")
-				mirror['info']['comptime'] = float(session.recvmessage(mirror['info']['sock'])[1:])
-				mirror['info']['ping'] = _timer() - ping_start
+				session.sendmessage(mirror.sock, "T")
+				mirror.comptime = float(session.recvmessage(mirror.sock)[1:])
+				mirror.ping = _timer() - ping_start
 
-			session.sendmessage(mirror['info']['sock'], "Q")
-			mirror['info']['sock'].close()
+			if self.connectionpool != None:
+				self.connectionpool.release(mirror.info, mirror.sock)
+			else:
+				session.sendmessage(mirror.sock, "Q")
+				mirror.sock.close()
 
 
 	def return_timings(self):
 		comptimes = []
 		pings = []
 		for mirror in self.activemirrors:
-			comptimes.append(mirror['info']['comptime'])
-			pings.append(mirror['info']['ping'])
+			comptimes.append(mirror.comptime)
+			pings.append(mirror.ping)
 
 		return self.recons_time, comptimes, pings
 
@@ -126,6 +562,47 @@ class Requestor(object):
 		return self.finishedblockdict[blocknum]
 
 
+	def return_mirrorstats(self):
+		"""returns a list of (mirrorinfo, latency, throughput) for the mirrors
+		that were used, see mirrorselection.MirrorStats.update()"""
+		stats = []
+		for mirror in self.activemirrors:
+			for failedinfo in mirror.failedmirrors:
+				stats.append((failedinfo, None, None))
+			stats.append(mirror.return_stats())
+		return stats
+
+
+	def _add_piece(self, key, piece):
+		"""private helper, stores a reply for the block(s) with this key. Returns
+		all k pieces once the last one arrived, None otherwise."""
+		with self.tablelock:
+			pieces = self.returnedxorblocksdict[key]
+			pieces.append(piece)
+
+			if len(pieces) != self.privacythreshold:
+				return None
+
+			# it should be safe to delete this
+			del self.returnedxorblocksdict[key]
+			return pieces
+
+
+	def _finish_block(self, blocknum, block):
+		"""private helper, passes a checked block to the callback or keeps it in
+		the finishedblockdict"""
+		if self.blockcallback != None:
+			self.blockcallback(blocknum, block)
+		else:
+			self.finishedblockdict[blocknum] = block
+
+
+	def _add_recons_time(self, duration):
+		"""private helper, sums up the reconstruction time of all threads"""
+		with self.tablelock:
+			self.recons_time = self.recons_time + duration
+
+
 
 # These provide an easy way for the client XOR request behavior to be
 # modified. If you wanted to change the policy by which mirrors are selected,
@@ -148,7 +625,7 @@ class RandomXORRequestor(Requestor):
 	"""
 
 
-	def __init__(self, mirrorinfolist, blocklist, manifestdict, privacythreshold, batch, timing):
+	def __init__(self, mirrorinfolist, blocklist, manifestdict, privacythreshold, batch, timing, querypool=None, blockcallback=None, mirrorselector=None):
 		"""
 		<Purpose>
 			Get ready to handle requests for XOR block strings, etc.
@@ -164,6 +641,17 @@ class RandomXORRequestor(Requestor):
 
 			timing: collect timing info
 
+			querypool: an optional querypool.QueryPool with precomputed shares.
+				Shares are taken from the pool first, missing ones are generated.
+
+			blockcallback: an optional function(blocknumber, block) that is called
+				as soon as a block is reconstructed and checked. These blocks are
+				not kept for return_block().
+
+			mirrorselector: an optional function that returns the mirrorinfolist
+				in the order the mirrors should be used (the first k are contacted,
+				the rest are backups). By default the order is random.
+
 		<Exceptions>
 			TypeError may be raised if invalid parameters are given.
 
@@ -174,34 +662,23 @@ class RandomXORRequestor(Requestor):
 		self.manifestdict = manifestdict
 		self.privacythreshold = privacythreshold
 		self.timing = timing
+		self.blockcallback = blockcallback
 		if timing:
 			self.recons_time = 0
 
 		if len(mirrorinfolist) < self.privacythreshold:
 			raise InsufficientMirrors("Requested the use of "+str(self.privacythreshold)+" mirrors, but only "+str(len(mirrorinfolist))+" were available.")
 
-		# now we do the 'random' part.   I copy the mirrorinfolist to avoid changing the list in place.
-		self.fullmirrorinfolist = mirrorinfolist[:]
-		random.shuffle(self.fullmirrorinfolist)
+		# now we do the 'random' part (unless a selector prefers some mirrors)
+		self.fullmirrorinfolist = _order_mirrors(mirrorinfolist, mirrorselector)
+
+		manifestdigest = lib.manifest_digest(manifestdict)
 
 		# let's make a list of mirror information (what has been retrieved, etc.)
 		self.activemirrors = []
 		for mirrorinfo in self.fullmirrorinfolist[:self.privacythreshold]:
-			mirrors = {}
-			mirrors['info'] = mirrorinfo
-			mirrors['blocksneeded'] = blocklist[:]
-			mirrors['blockbitstringlist'] = []
-			mirrors['blocksrequested'] = []
-
-			# open a socket once:
-			mirrors['info']['sock'] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-			mirrors['info']['sock'].setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) #TODO check this in the cloud
-			mirrors['info']['sock'].connect((mirrorinfo['ip'], mirrorinfo['port']))
 
-			self.activemirrors.append(mirrors)
-
-		for thisrequestinfo in self.activemirrors:
-			#send parameters to mirrors once
+			# parameters that are sent to the mirror once, when connecting
 			params = {}
 			params['cn'] = 1 # chunk numbers, here fixed to 1
 			params['k'] = privacythreshold
@@ -210,36 +687,34 @@ class RandomXORRequestor(Requestor):
 			params['lcl'] = 1 # last chunk length, here fixed to 1
 			params['b'] = batch
 			params['p'] = False
+			params['m'] = manifestdigest # the release, a mirror may serve several
 
-			#send the params, rcvlet will check response
-			session.sendmessage(thisrequestinfo['info']['sock'], b"P" + msgpack.packb(params, use_bin_type=True))
-
-			# start separate receiving thread for this socket
-			t = threading.Thread(target=rcvlet, args=[thisrequestinfo, self], name=("rcv_thread_" + str((thisrequestinfo['info']['ip'], thisrequestinfo['info']['port']))))
-			thisrequestinfo['rt'] = t
-			t.start()
-
-		bitstringlength = lib.bits_to_bytes(manifestdict['blockcount'])
+			mirror = MirrorState(mirrorinfo, params, blocklist)
+			mirror.replies = len(blocklist) # one reply per block
 
-		# let's generate the random bitstrings for k-1 mirrors
-		for thisrequestinfo in self.activemirrors[:-1]:
+			self.activemirrors.append(mirror)
 
-			for _ in blocklist:
-				thisrequestinfo['blockbitstringlist'].append(lib.randombits(manifestdict['blockcount']))
+		# use precomputed shares if we have them. The randomness does not depend
+		# on the block, only the bit flip below does.
+		if querypool != None:
+			pooledshares = querypool.take(len(blocklist))
+		else:
+			pooledshares = []
 
-		# now, let's do the 'derived' ones...
+		# let's generate the random bitstrings for k-1 mirrors and the 'derived'
+		# one for the last mirror...
 		for blocknum in range(len(blocklist)):
-			thisbitstring = b'\0'*bitstringlength
-
-			# xor the random strings together
-			for requestinfo in self.activemirrors[:-1]:
-				thisbitstring = xordatastore.do_xor(thisbitstring, requestinfo['blockbitstringlist'][blocknum])
+			if blocknum < len(pooledshares):
+				shares = pooledshares[blocknum]
+			else:
+				shares = querypool_module.generate_query_shares(manifestdict['blockcount'], privacythreshold)
 
-			# flip the appropriate bit for the block we want
-			thisbitstring = lib.flip_bitstring_bit(thisbitstring, blocklist[blocknum])
+			for thisrequestinfo, thisshare in zip(self.activemirrors[:-1], shares[:-1]):
+				thisrequestinfo.queries.append(thisshare)
 
-			# store the result for the last mirror
-			self.activemirrors[-1]['blockbitstringlist'].append(thisbitstring)
+			# flip the appropriate bit for the block we want and store the result
+			# for the last mirror
+			self.activemirrors[-1].queries.append(lib.flip_bitstring_bit(shares[-1], blocklist[blocknum]))
 
 		# want to have a structure for locking
 		self.tablelock = threading.Lock()
@@ -271,7 +746,7 @@ class RandomXORRequestor(Requestor):
 			InsufficientMirrors if there are not enough mirrors
 
 		<Returns>
-			Either a requesttuple (mirrorinfo, blocknumber, bitstring) or ()
+			Either a requesttuple (mirrorstate, blocknumber, bitstring) or ()
 			when all strings have been retrieved...
 
 		"""
@@ -283,74 +758,29 @@ class RandomXORRequestor(Requestor):
 		mirror = self.activemirrors[tid]
 
 		# this mirror is done...
-		if len(mirror['blocksneeded']) == 0:
+		if len(mirror.blocksneeded) == 0:
 			return ()
 
 		# otherwise set it to be taken...
-		blocknum = mirror['blocksneeded'].pop()
-		mirror['blocksrequested'].append(blocknum)
+		blocknum = mirror.blocksneeded.popleft()
+		mirror.blocksrequested.append(blocknum)
 
-		return (mirror['info'], blocknum, mirror['blockbitstringlist'].pop())
+		return (mirror, blocknum, mirror.queries.popleft())
 
 
-	def notify_failure(self, xorrequesttuple):
-		"""
-		<Purpose>
-			Handles that a mirror has failed
-
-		<Arguments>
-			The XORrequesttuple that was returned by get_next_xorrequest
-
-		<Exceptions>
-			InsufficientMirrors if there are not enough mirrors
-
-			An internal error is raised if the XORrequesttuple is bogus
-
-		<Returns>
-			None
-
-		"""
-		# I should lock the table...
-		self.tablelock.acquire()
-
-		# but *always* release it
-		try:
-			# if we're out of replacements, quit
-			if len(self.backupmirrorinfolist) == 0:
-				raise InsufficientMirrors("There are no replacement mirrors")
-
-			nextmirrorinfo = self.backupmirrorinfolist.pop(0)
-
-			failedmirrorsinfo = xorrequesttuple[0]
-
-			# now, let's find the activemirror this corresponds to.
-			for mirror in self.activemirrors:
-				if mirror['info'] == failedmirrorsinfo:
-
-					# let's mark it as inactive and set up a different mirror
-					mirror['info'] = nextmirrorinfo
-					return
-
-			raise Exception("InternalError: Unknown mirror in notify_failure")
-
-		finally:
-			# release the lock
-			self.tablelock.release()
-
-
-	def notify_success(self, thismirrorsinfo, xorblock):
+	def notify_success(self, mirror, xorblock):
 		"""
 		<Purpose>
 			Handles the receipt of an xorblock
 
 		<Arguments>
-			xorrequesttuple: The tuple that was returned by get_next_xorrequest
+			mirror: the MirrorState of the mirror that sent the reply
 
 			xorblock: the data returned by the mirror
 
 		<Exceptions>
 			Assertions / IndexError / TypeError / InternalError if the
-			XORrequesttuple is bogus
+			reply was not expected
 
 		<Returns>
 			None
@@ -360,48 +790,28 @@ class RandomXORRequestor(Requestor):
 		if self.timing:
 			stime = _timer()
 
-		# acquire the lock...
-		self.tablelock.acquire()
-		#... but always release it
-		try:
-
-			# now, let's find the activemirror this corresponds to.
-			for mirror in self.activemirrors:
-				if mirror['info'] == thismirrorsinfo:
-
-					# remove the block and bitstring (asserting they match what we said before)
-					blocknumber = mirror['blocksrequested'].pop(0)
+		# replies arrive in the order of the requests
+		blocknumber = mirror.blocksrequested.popleft()
 
-					# add the xorblockinfo to the dict
-					self.returnedxorblocksdict[blocknumber].append(xorblock)
+		# only collecting the pieces needs the lock. The thread that adds the last
+		# piece takes them all and reconstructs the block without holding it.
+		pieces = self._add_piece(blocknumber, xorblock)
 
-					# if we don't have all of the pieces, continue
-					if len(self.returnedxorblocksdict[blocknumber]) != self.privacythreshold:
-						return
+		if pieces != None:
+			# we have all of the pieces, reconstruct it
+			resultingblock = _reconstruct_block(pieces)
 
-					# if we have all of the pieces, reconstruct it
-					resultingblock = _reconstruct_block(self.returnedxorblocksdict[blocknumber])
+			# let's check the hash...
+			resultingblockhash = lib.find_hash(resultingblock, self.manifestdict['hashalgorithm'])
+			if resultingblockhash != self.manifestdict['blockhashlist'][blocknumber]:
+				# TODO: We should notify the vendor!
+				raise Exception('Should notify vendor that one of the mirrors or manifest is corrupt')
 
-					# let's check the hash...
-					resultingblockhash = lib.find_hash(resultingblock, self.manifestdict['hashalgorithm'])
-					if resultingblockhash != self.manifestdict['blockhashlist'][blocknumber]:
-						# TODO: We should notify the vendor!
-						raise Exception('Should notify vendor that one of the mirrors or manifest is corrupt')
+			# otherwise, let's hand it on
+			self._finish_block(blocknumber, resultingblock)
 
-					# otherwise, let's put this in the finishedblockdict
-					self.finishedblockdict[blocknumber] = resultingblock
-
-					# it should be safe to delete this
-					del self.returnedxorblocksdict[blocknumber]
-					return
-
-			raise Exception("InternalError: Unknown mirror in notify_success")
-
-		finally:
-			# release the lock
-			self.tablelock.release()
-			if self.timing:
-				self.recons_time = self.recons_time + _timer() - stime
+		if self.timing:
+			self._add_recons_time(_timer() - stime)
 
 
 ######################################################################
@@ -409,20 +819,31 @@ class RandomXORRequestor(Requestor):
 
 class RandomXORRequestorChunks(Requestor):
 
-	def __init__(self, mirrorinfolist, blocklist, manifestdict, privacythreshold, redundancy, rng, parallel, batch, timing):
+	def __init__(self, mirrorinfolist, blocklist, manifestdict, privacythreshold, redundancy, rng, parallel, batch, timing, blockcallback=None, mirrorselector=None, fillerblocks=()):
 		"""
 		<Purpose>
 			Get ready to handle requests for XOR block strings, etc.
 			This is meant to be used for queries partitioned in chunks
 				(parallel or SB queries with redundancy parameter)
 
+			See RandomXORRequestor for the blockcallback and mirrorselector.
+			With parallel queries, the fillerblocks are retrieved as well where
+			they fit without an additional query (see plan_parallel_queries).
+			They are handed on like the other blocks.
+
 		<Exceptions>
 			TypeError may be raised if invalid parameters are given.
 
+			ValueError if parallel queries don't fit the layout of the release
+			(see check_parallel_layout).
+
 			InsufficientMirrors if there are not enough mirrors
 
 		"""
 
+		if parallel:
+			check_parallel_layout(manifestdict, privacythreshold)
+
 		self.blocklist = blocklist
 		self.manifestdict = manifestdict
 		self.privacythreshold = privacythreshold # aka k, the number of mirrors to use
@@ -431,21 +852,23 @@ class RandomXORRequestorChunks(Requestor):
 		self.parallel = parallel
 		self.blockcount = manifestdict['blockcount']
 		self.timing = timing
+		self.blockcallback = blockcallback
 		if timing:
 			self.recons_time = 0
 
 		#length of one chunk in BITS (1 bit per block)
 		#chunk length of the first chunks must be a multiple of 8, last chunk can be longer than first chunks
-		self.chunklen = int(self.blockcount/8/privacythreshold) * 8
+		self.chunklen = lib.chunk_length(self.blockcount, privacythreshold)
 		self.lastchunklen = self.blockcount - (privacythreshold-1)*self.chunklen
 
 		if len(mirrorinfolist) < self.privacythreshold:
 			raise InsufficientMirrors("Requested the use of " + str(self.privacythreshold) + " mirrors, but only " + str(len(mirrorinfolist)) + " were available.")
 
-		# now we do the 'random' part. I copy the mirrorinfolist to avoid changing the list in place.
-		self.fullmirrorinfolist = mirrorinfolist[:]
-		random.shuffle(self.fullmirrorinfolist)
+		# now we do the 'random' part (unless a selector prefers some mirrors)
+		self.fullmirrorinfolist = _order_mirrors(mirrorinfolist, mirrorselector)
+
 
+		manifestdigest = lib.manifest_digest(manifestdict)
 
 		# let's make a list of mirror information (what has been retrieved, etc.)
 		self.activemirrors = []
@@ -453,78 +876,43 @@ class RandomXORRequestorChunks(Requestor):
 		#initialize queries for mirrors
 		i = 0
 		for mirrorinfo in self.fullmirrorinfolist[:self.privacythreshold]:
-			mirror = {}
-			mirror['info'] = mirrorinfo
-			mirror['blocksneeded'] = blocklist[:] # only for the client, obviously
-			mirror['blocksrequested'] = []
-
-			if parallel:
-				mirror['parallelblocksneeded'] = []
-
-			mirror['blockchunklist'] = []
-
 
 			# chunk numbers [0, ..., r-1]
-			mirror['chunknumbers'] = [i]
+			chunknumbers = [i]
 			for j in range(1, redundancy):
-				mirror['chunknumbers'].append((i+j) % privacythreshold)
+				chunknumbers.append((i+j) % privacythreshold)
 			i = i + 1
 
-			#open a socket once:
-			mirror['info']['sock'] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-			mirror['info']['sock'].connect((mirrorinfo['ip'], mirrorinfo['port']))
-
-			if rng:
-				#pick a random seed (key) and initialize AES
-				seed = _randomnumberfunction(16) # random 128 bit key
-				mirror['seed'] = seed
-				mirror['cipher'] = lib.initAES(seed)
-
-			self.activemirrors.append(mirror)
-
-		for mirror in self.activemirrors:
-			#send parameters to mirrors once
+			# parameters that are sent to the mirror once, when connecting
 			params = {}
-			params['cn'] = mirror['chunknumbers']
+			params['cn'] = chunknumbers
 			params['k'] = privacythreshold
 			params['r'] = redundancy
 			params['cl'] = self.chunklen
 			params['lcl'] = self.lastchunklen
 			params['b'] = batch
 			params['p'] = parallel
+			params['m'] = manifestdigest # the release, a mirror may serve several
 
-			if rng:
-				params['s'] = mirror['seed']
+			mirror = MirrorState(mirrorinfo, params, blocklist)
+			mirror.chunknumbers = chunknumbers
 
-			#send the params, rcvlet will check response
-			session.sendmessage(mirror['info']['sock'], b"P" + msgpack.packb(params, use_bin_type=True))
+			if rng:
+				#pick a random seed (key) and initialize AES
+				seed = _randomnumberfunction(16) # random 128 bit key
+				mirror.seed = seed
+				mirror.cipher = lib.initAES(seed)
+				params['s'] = seed
 
-			# start separate receiving thread for this socket
-			t = threading.Thread(target=rcvlet, args=[mirror, self], name=("rcv_thread_" + str((mirror['info']['ip'], mirror['info']['port']))))
-			mirror['rt'] = t
-			t.start()
+			self.activemirrors.append(mirror)
 
 
 		#multi block query. map the blocks to the minimum amount of queries
 		if parallel:
 
-			#create dictionary for each chunk, will hold block indices per chunk
-			blockchunks = {}
-			for i in range(0, privacythreshold):
-				blockchunks[i] = []
-
-			#map block numbers to chunks
-			for blocknum in blocklist:
-				index = min(int(blocknum/self.chunklen), privacythreshold-1)
-				blockchunks[index].append(blocknum)
-
-			#remove chunks that are still empty
-			for i in range(0, privacythreshold):
-				if len(blockchunks[i]) == 0:
-					del blockchunks[i]
+			self.plan = plan_parallel_queries(blocklist, self.blockcount, privacythreshold, fillerblocks)
 
-			#do until all blocks are in queries
-			while len(blockchunks)>0:
+			for plannedquery in self.plan:
 
 				#iterate through mirrors
 				for mirror in self.activemirrors:
@@ -533,7 +921,7 @@ class RandomXORRequestorChunks(Requestor):
 					chunks = {}
 
 					#iterate through r-1 random chunks, skipping the head (flip) chunk
-					for c in mirror['chunknumbers'][1:]:
+					for c in mirror.chunknumbers[1:]:
 
 						#pick correct length in bits
 						if c == self.privacythreshold - 1:
@@ -543,22 +931,22 @@ class RandomXORRequestorChunks(Requestor):
 
 						if rng:
 							#set random bytes for the latter chunk(s) from AES (will be deleted later)
-							chunks[c] = lib.nextrandombitsAES(mirror['cipher'], length)
+							chunks[c] = lib.nextrandombitsAES(mirror.cipher, length)
 
 						else:
 							#set random bytes for the latter chunk(s) randomly
 							chunks[c] = lib.randombits(length)
 
-					mirror['blockchunklist'].append(chunks)
+					mirror.queries.append(chunks)
 
-				#list of blocknumbers
-				blocks = []
+				#list of blocknumbers, ordered by chunk
+				blocks = [plannedquery[c] for c in sorted(plannedquery)]
 
 				# now derive the first chunks
 				for mirror in self.activemirrors:
 
 					#number of the first chunk
-					c = mirror['chunknumbers'][0]
+					c = mirror.chunknumbers[0]
 
 					#pick correct length for the chunk
 					if c == self.privacythreshold - 1:
@@ -571,21 +959,17 @@ class RandomXORRequestorChunks(Requestor):
 
 					#xor all other rnd chunks onto it
 					for rqi in self.activemirrors:
-						if c in rqi['blockchunklist'][-1]:
-							thisbitstring = xordatastore.do_xor(thisbitstring, rqi['blockchunklist'][-1][c])
+						if c in rqi.queries[-1]:
+							thisbitstring = xordatastore.do_xor(thisbitstring, rqi.queries[-1][c])
 							if rng:
-								del rqi['blockchunklist'][-1][c] #remove the pre-computed random chunk from the packet to send
+								del rqi.queries[-1][c] #remove the pre-computed random chunk from the packet to send
 
 					#if there is a block within this chunk, then add it to the bitstring by flipping the bit
-					if c in blockchunks:
-						blocknum = blockchunks[c].pop(0)
-						thisbitstring = lib.flip_bitstring_bit(thisbitstring, blocknum - c*self.chunklen)
-						blocks.append(blocknum)
-						if len(blockchunks[c]) == 0:
-							del blockchunks[c]
+					if c in plannedquery:
+						thisbitstring = lib.flip_bitstring_bit(thisbitstring, plannedquery[c] - c*self.chunklen)
 
-					mirror['parallelblocksneeded'].append(blocks)
-					mirror['blockchunklist'][-1][c] = thisbitstring
+					mirror.parallelblocksneeded.append(blocks)
+					mirror.queries[-1][c] = thisbitstring
 
 
 		#single block query:
@@ -599,7 +983,7 @@ class RandomXORRequestorChunks(Requestor):
 					chunks = {}
 
 					#iterate through r-1 random chunks
-					for c in mirror['chunknumbers'][1:]:
+					for c in mirror.chunknumbers[1:]:
 
 						#pick correct length in bits
 						if c == self.privacythreshold - 1:
@@ -608,19 +992,19 @@ class RandomXORRequestorChunks(Requestor):
 							length = self.chunklen
 
 						if rng:
-							chunks[c] = lib.nextrandombitsAES(mirror['cipher'], length)
+							chunks[c] = lib.nextrandombitsAES(mirror.cipher, length)
 
 						else:
 							#set random bytes for the latter chunk(s)
 							chunks[c] = lib.randombits(length)
 
-					mirror['blockchunklist'].append(chunks)
+					mirror.queries.append(chunks)
 
 				# now derive the first chunks
 				for mirror in self.activemirrors:
 
 					#number of the first chunk
-					c = mirror['chunknumbers'][0]
+					c = mirror.chunknumbers[0]
 
 					#pick correct length for the chunk
 					if c == self.privacythreshold - 1:
@@ -633,16 +1017,16 @@ class RandomXORRequestorChunks(Requestor):
 
 					#xor all other rnd chunks onto it
 					for rqi in self.activemirrors:
-						if c in rqi['blockchunklist'][-1]:
-							thisbitstring = xordatastore.do_xor(thisbitstring, rqi['blockchunklist'][-1][c])
+						if c in rqi.queries[-1]:
+							thisbitstring = xordatastore.do_xor(thisbitstring, rqi.queries[-1][c])
 							if rng:
-								del rqi['blockchunklist'][-1][c] #remove the pre-computed random chunk from the packet to send
+								del rqi.queries[-1][c] #remove the pre-computed random chunk from the packet to send
 
 					#if the desired block is within this chunk, flip the bit
 					if c*self.chunklen <= blocknum and blocknum < c*self.chunklen + length:
 						thisbitstring = lib.flip_bitstring_bit(thisbitstring, blocknum - c*self.chunklen)
 
-					mirror['blockchunklist'][-1][c] = thisbitstring
+					mirror.queries[-1][c] = thisbitstring
 
 
 		########################################
@@ -659,9 +1043,19 @@ class RandomXORRequestorChunks(Requestor):
 			# make these all empty lists to start with
 			self.returnedxorblocksdict[blocknum] = []
 
+		if parallel:
+			# the replies are collected under the first block of each query,
+			# which may be a filler block
+			for plannedquery in self.plan:
+				self.returnedxorblocksdict[plannedquery[min(plannedquery)]] = []
+
 		# and here is where they are put when reconstructed
 		self.finishedblockdict = {}
 
+		# the mirrors answer every query with one reply
+		for mirror in self.activemirrors:
+			mirror.replies = len(mirror.queries)
+
 		# preparation done. queries are ready to be sent.
 
 
@@ -678,7 +1072,7 @@ class RandomXORRequestorChunks(Requestor):
 			InsufficientMirrors if there are not enough mirrors
 
 		<Returns>
-			Either a requesttuple (mirrorinfo, blocknumber, bitstring) or ()
+			Either a requesttuple (mirrorstate, blocknumber, bitstring) or ()
 			when all strings have been retrieved...
 
 		"""
@@ -687,181 +1081,569 @@ class RandomXORRequestorChunks(Requestor):
 
 
 		if self.parallel:
-			if len(requestinfo['parallelblocksneeded']) == 0:
+			if len(requestinfo.parallelblocksneeded) == 0:
 				return ()
 
-			blocknums = requestinfo['parallelblocksneeded'].pop(0)
-			requestinfo['blocksrequested'].append(blocknums)
+			blocknums = requestinfo.parallelblocksneeded.popleft()
+			requestinfo.blocksrequested.append(blocknums)
 
-			if self.rng:
-				return (requestinfo['info'], blocknums, requestinfo['blockchunklist'].pop(0), 2)
-			else:
-				raise Exception("Parallel Query without RNG not yet implemented!")
+			# without rng, the query contains all random chunks
+			return (requestinfo, blocknums, requestinfo.queries.popleft(), 2)
 
 		#single block
 		else:
 			# this mirror is done...
-			if len(requestinfo['blocksneeded']) == 0:
+			if len(requestinfo.blocksneeded) == 0:
 				return ()
 
-			blocknum = requestinfo['blocksneeded'].pop(0)
-			requestinfo['blocksrequested'].append(blocknum)
+			blocknum = requestinfo.blocksneeded.popleft()
+			requestinfo.blocksrequested.append(blocknum)
 
 			if self.rng:
-				return (requestinfo['info'], blocknum, requestinfo['blockchunklist'].pop(0), 1)
+				return (requestinfo, blocknum, requestinfo.queries.popleft(), 1)
 			else:
-				return (requestinfo['info'], blocknum, requestinfo['blockchunklist'].pop(0), 0)
+				return (requestinfo, blocknum, requestinfo.queries.popleft(), 0)
 
 
-	def notify_failure(self, xorrequesttuple):
+	def notify_success(self, mirror, xorblock):
 		"""
 		<Purpose>
-			Handles that a mirror has failed
+			Handles the receipt of an xorblock
 
 		<Arguments>
-			The XORrequesttuple that was returned by get_next_xorrequest
+			mirror: the MirrorState of the mirror that sent the reply
 
-		<Exceptions>
-			InsufficientMirrors if there are not enough mirrors
+			xorblock: the data returned by the mirror
 
-			An internal error is raised if the XORrequesttuple is bogus
+		<Exceptions>
+			Assertions / IndexError / TypeError / InternalError if the
+			reply was not expected
 
 		<Returns>
 			None
 
 		"""
-		# I should lock the table...
-		self.tablelock.acquire()
 
-		# but *always* release it
+		if self.timing:
+			stime = _timer()
+
+		if self.parallel:
+			# replies arrive in the order of the requests
+			blocknumbers = mirror.blocksrequested.popleft()
+
+			# use blocknumbers[0] as index from now on. Only collecting the pieces
+			# needs the lock, the thread that adds the last piece reconstructs.
+			pieces = self._add_piece(blocknumbers[0], msgpack.unpackb(xorblock, raw=False))
+
+			if pieces != None:
+				# we have all of the pieces, reconstruct it
+				resultingblockdict = _reconstruct_block_parallel(pieces, self.chunklen, self.privacythreshold, self.manifestdict['blocksize'], blocknumbers)
+
+				#parse resultingblocks into single blocks
+				for blocknumber in blocknumbers:
+
+					index = min(int(blocknumber/self.chunklen), self.privacythreshold-1)
+
+					# let's check the hash...
+					resultingblockhash = lib.find_hash(resultingblockdict[index], self.manifestdict['hashalgorithm'])
+					if resultingblockhash != self.manifestdict['blockhashlist'][blocknumber]:
+						print(mirror.info)
+						# TODO: We should notify the vendor!
+						raise Exception('Should notify vendor that one of the mirrors or manifest is corrupt, for blocknumber ' + str(blocknumber))
+
+					# otherwise, let's hand it on
+					self._finish_block(blocknumber, resultingblockdict[index])
+
+		#single block query:
+		else:
+			# replies arrive in the order of the requests
+			blocknumber = mirror.blocksrequested.popleft()
+
+			pieces = self._add_piece(blocknumber, xorblock)
+
+			if pieces != None:
+				# we have all of the pieces, reconstruct it
+				resultingblock = _reconstruct_block(pieces)
+
+				# let's check the hash...
+				resultingblockhash = lib.find_hash(resultingblock, self.manifestdict['hashalgorithm'])
+				if resultingblockhash != self.manifestdict['blockhashlist'][blocknumber]:
+					print(mirror.info)
+					# TODO: We should notify the vendor!
+					raise Exception('Should notify vendor that one of the mirrors or manifest is corrupt')
+
+				# otherwise, let's hand it on
+				self._finish_block(blocknumber, resultingblock)
+
+		if self.timing:
+			self._add_recons_time(_timer() - stime)
+
+
+######################################################################
+
+# replies that are faster than this (in seconds) never trigger hedging
+HEDGE_MIN_DELAY = 0.05
+
+# hedging starts once this many reply latencies were measured
+HEDGE_MIN_SAMPLES = 10
+
+# the number of recent reply latencies the threshold is computed from
+HEDGE_LATENCY_SAMPLES = 1000
+
+# how often (in seconds) the mirrors are checked for late replies
+HEDGE_CHECK_INTERVAL = 0.01
+
+# how long (in seconds) a mirror may take for outstanding replies after all
+# blocks are complete, before its connection is abandoned
+HEDGE_DRAIN_TIMEOUT = 1.0
+
+
+def _snapshot(queue):
+	"""private helper, copies a deque that other threads append to or pop from"""
+	while True:
+		try:
+			return list(queue)
+		except RuntimeError:
+			# it was changed while copying
+			pass
+
+
+class HedgedXORRequestor(RandomXORRequestor):
+	"""
+	<Purpose>
+		A RandomXORRequestor that doesn't wait for slow mirrors.   It measures
+		the reply latencies of all mirrors.   If a mirror did not reply (or
+		could not be connected to) for longer than the given percentile of these
+		latencies, the blocks it still owes are requested again: for each of
+		these blocks a fresh set of shares is generated and sent to the other
+		mirrors plus a backup mirror.   The block is reconstructed from
+		whichever share set is complete first.
+
+		Each share set is independent, so privacy holds as long as fewer than
+		k of the contacted mirrors collude, just like without hedging.
+
+		Unlike the other requestors, it drives its connections itself (see
+		retrieve()).   Only queries without chunks are supported: with chunks
+		the shares are tied to the chunk numbers and seeds of the mirrors.
+
+	<Side Effects>
+		None.
+	"""
+
+	def __init__(self, mirrorinfolist, blocklist, manifestdict, privacythreshold, batch, timing, querypool=None, blockcallback=None, mirrorselector=None, hedgepercentile=95, latencies=None):
+		"""
+		<Purpose>
+			Get ready to handle requests for XOR block strings, etc.
+
+		<Arguments>
+			See RandomXORRequestor.
+
+			hedgepercentile: a mirror is considered slow if it did not reply
+				for longer than this percentile of all reply latencies
+
+			latencies: a deque with the reply latencies of earlier retrievals.
+				It is updated, so it can be handed to the next requestor.
+
+		<Exceptions>
+			TypeError may be raised if invalid parameters are given.
+
+			InsufficientMirrors if there are not enough mirrors
+		"""
+		RandomXORRequestor.__init__(self, mirrorinfolist, blocklist, manifestdict, privacythreshold, batch, timing, querypool, blockcallback, mirrorselector)
+
+		self.hedgepercentile = hedgepercentile
+
+		# the queries of a mirror are (blocknumber, share set, bitstring) here.
+		# The shares that were prepared above are share set 0.
+		for mirror in self.activemirrors:
+			mirror.queries = collections.deque(zip(mirror.blocksneeded, [0] * len(mirror.queries), mirror.queries))
+			mirror.blocksneeded.clear()
+
+		# the returned pieces are keyed by (blocknumber, share set)
+		self.returnedxorblocksdict = {}
+		self.sharesetmirrors = {0: self.activemirrors}
+		self.sharesetsofblock = {}
+		for blocknum in blocklist:
+			self.sharesetsofblock[blocknum] = [0]
+
+		self.doneblocks = set()
+
+		# recent reply latencies, the time between a request (or the previous
+		# reply of the same mirror, if that came later) and the reply
+		if latencies == None:
+			latencies = collections.deque(maxlen=HEDGE_LATENCY_SAMPLES)
+		self.latencies = latencies
+
+		# the mirrors that were too slow, and the backup mirrors that were added
+		self.slowmirrors = []
+		self.backupmirrors = []
+
+		# (blocknumber, share set) pairs that were already replaced
+		self.hedged = set()
+		self.hedgecount = 0
+
+		# set when all blocks are complete (or a thread failed)
+		self.finished = threading.Event()
+		self.error = None
+
+		# wakes the threads that wait for queries to send or replies to receive
+		self.condition = threading.Condition()
+
+
+	def retrieve(self, connectionpool=None):
+		"""
+		<Purpose>
+			Retrieves all blocks and hedges requests to slow mirrors.
+
+		<Arguments>
+			connectionpool: an optional connectionpool.MirrorConnectionPool
+
+		<Exceptions>
+			socket errors or SessionEOF if communications fail.
+
+		<Side Effects>
+			Contacts the mirrors.   Connections to slow mirrors are closed, the
+			others are returned to the pool (or closed).
+
+		<Returns>
+			None. The blocks can be read with return_block()
+		"""
+		self.connectionpool = connectionpool
+
+		for mirror in self.activemirrors:
+			self._start(mirror)
+
 		try:
-			# if we're out of replacements, quit
-			if len(self.backupmirrorinfolist) == 0:
-				raise InsufficientMirrors("There are no replacement mirrors")
+			while not self.finished.wait(HEDGE_CHECK_INTERVAL):
+				self._hedge_slow_mirrors()
+		except Exception as e:
+			self._fail(e)
+
+		self._close_connections()
+
+		if self.error != None:
+			raise self.error
 
-			nextmirrorinfo = self.backupmirrorinfolist.pop(0)
 
-			failedmirrorsinfo = xorrequesttuple[0]
+	def _start(self, mirror):
+		"""private helper, starts the sending thread of a mirror"""
+		# the time spent connecting counts like the time waiting for a reply
+		mirror.connecttime = _timer()
+		mirror.lastreply = mirror.connecttime
 
-			# now, let's find the activemirror this corresponds to.
-			for mirror in self.activemirrors:
-				if mirror['info'] == failedmirrorsinfo:
+		# the retrieval doesn't wait for the sending threads. One may still be
+		# stuck connecting to an unresponsive mirror when we are done.
+		sendthread = threading.Thread(target=self._send_queries, args=[mirror], name="hedged_send_thread")
+		sendthread.daemon = True
+		sendthread.start()
+
+
+	def _open(self, mirror):
+		"""private helper, connects to a mirror and starts its receiving thread"""
+		if self.connectionpool != None:
+			sock, mirror.paramssent = self.connectionpool.acquire(mirror.info, mirror.params)
+		else:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			sock.connect((mirror.info['ip'], mirror.info['port']))
+			session.sendmessage(sock, b"P" + msgpack.packb(mirror.params, use_bin_type=True))
+			mirror.paramssent = True
+
+		with self.tablelock:
+			mirror.sock = sock
+
+			# we may have given up on the mirror while connecting
+			if mirror.abandoned:
+				self._abandon(mirror)
+				return False
+
+			mirror.rt = threading.Thread(target=self._receive, args=[mirror], name=("rcv_thread_" + str((mirror.info['ip'], mirror.info['port']))))
+			mirror.rt.start()
+
+		return True
+
+
+	def _abandon(self, mirror):
+		"""private helper, closes a connection that is in an unknown state"""
+		mirror.abandoned = True
+		if mirror.sock == None:
+			# still connecting, _open cleans up
+			return
+
+		# shutting it down also wakes up threads that are blocked on it
+		try:
+			mirror.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
 
-					# let's mark it as inactive and set up a different mirror
-					mirror['info'] = nextmirrorinfo
+		if self.connectionpool != None:
+			self.connectionpool.discard(mirror.sock)
+		else:
+			mirror.sock.close()
+
+
+	def _fail(self, error):
+		"""private helper, stops the retrieval because a thread failed"""
+		if self.error == None:
+			self.error = error
+		self.finished.set()
+		with self.condition:
+			self.condition.notify_all()
+
+
+	def _send_queries(self, mirror):
+		"""private helper (thread), connects to a mirror and sends it all queries"""
+		try:
+			if not self._open(mirror):
+				return
+
+			while True:
+				with self.condition:
+					while len(mirror.queries) == 0 and not self.finished.is_set() and mirror not in self.slowmirrors:
+						self.condition.wait()
+
+					# the queries that are left when the mirror turns out to be slow are hedged
+					if self.finished.is_set() or mirror in self.slowmirrors:
+						return
+
+					(blocknum, shareset, bitstring) = mirror.queries[0]
+					mirror.blocksrequested.append((blocknum, shareset, _timer()))
+					mirror.queries.popleft()
+
+					# the receiving thread may wait for this
+					self.condition.notify_all()
+
+				lib.request_xorblock(mirror.sock, bitstring)
+
+		except Exception as e:
+			if not mirror.abandoned:
+				self._fail(e)
+
+
+	def _receive(self, mirror):
+		"""private helper (thread), receives the replies of a mirror"""
+		try:
+			if mirror.paramssent and session.recvmessage(mirror.sock) != b'PARAMS OK':
+				raise Exception("Params were not delivered correctly or wrong format.")
+
+			while True:
+				# wait for an outstanding request. After all blocks are complete,
+				# the replies that are still outstanding are read and dropped.
+				with self.condition:
+					while len(mirror.blocksrequested) == 0 and not self.finished.is_set():
+						self.condition.wait()
+
+				if len(mirror.blocksrequested) == 0 or mirror.abandoned:
 					return
 
-			raise Exception("InternalError: Unknown mirror in notify_failure")
+				data = session.recvmessage(mirror.sock)
 
-		finally:
-			# release the lock
-			self.tablelock.release()
+				if mirror.abandoned:
+					return
+
+				self.notify_success(mirror, data)
+				mirror.note_reply(data)
+
+		except Exception as e:
+			if not mirror.abandoned:
+				self._fail(e)
 
 
-	def notify_success(self, thismirrorsinfo, xorblock):
+	def notify_success(self, mirror, xorblock):
 		"""
 		<Purpose>
 			Handles the receipt of an xorblock
 
 		<Arguments>
-			xorrequesttuple: The tuple that was returned by get_next_xorrequest
+			mirror: the MirrorState of the mirror that sent the reply
 
 			xorblock: the data returned by the mirror
 
-		<Exceptions>
-			Assertions / IndexError / TypeError / InternalError if the
-			XORrequesttuple is bogus
-
 		<Returns>
 			None
-
 		"""
-
 		if self.timing:
 			stime = _timer()
 
-		# acquire the lock...
-		self.tablelock.acquire()
+		now = _timer()
+		(blocknumber, shareset, sendtime) = mirror.blocksrequested.popleft()
 
-		try:
+		with self.tablelock:
+			self.latencies.append(now - max(sendtime, mirror.lastreply))
 
-			# now, let's find the activemirror this corresponds to.
-			for mirror in self.activemirrors:
-				if mirror['info'] == thismirrorsinfo:
+			# another share set was faster
+			if blocknumber in self.doneblocks:
+				return
 
-					if self.parallel:
-						#use blocknumbers[0] as index from now on
-						blocknumbers = mirror['blocksrequested'].pop(0)
+			pieces = self.returnedxorblocksdict.setdefault((blocknumber, shareset), [])
+			pieces.append(xorblock)
 
-						# add the xorblocks to the dict
-						self.returnedxorblocksdict[blocknumbers[0]].append(msgpack.unpackb(xorblock, raw=False))
+			if len(pieces) != self.privacythreshold:
+				return
 
-						#print "Appended blocknumber", blocknumbers[0], "from", thismirrorsinfo['port']
+			# the pieces of the other share sets aren't needed anymore
+			self.doneblocks.add(blocknumber)
+			for thisshareset in self.sharesetsofblock[blocknumber]:
+				self.returnedxorblocksdict.pop((blocknumber, thisshareset), None)
 
-						# if we don't have all of the pieces, continue
-						if len(self.returnedxorblocksdict[blocknumbers[0]]) != self.privacythreshold:
-							return
+		# if we have all of the pieces, reconstruct it
+		resultingblock = _reconstruct_block(pieces)
 
-						# if we have all of the pieces, reconstruct it
-						resultingblockdict = _reconstruct_block_parallel(self.returnedxorblocksdict[blocknumbers[0]], self.chunklen, self.privacythreshold, self.manifestdict['blocksize'], blocknumbers)
+		# let's check the hash...
+		resultingblockhash = lib.find_hash(resultingblock, self.manifestdict['hashalgorithm'])
+		if resultingblockhash != self.manifestdict['blockhashlist'][blocknumber]:
+			print(mirror.info)
+			# TODO: We should notify the vendor!
+			raise Exception('Should notify vendor that one of the mirrors or manifest is corrupt')
 
-						#parse resultingblocks into single blocks
+		# otherwise, let's hand it on
+		self._finish_block(blocknumber, resultingblock)
 
+		if self.timing:
+			self._add_recons_time(_timer() - stime)
 
-						for blocknumber in blocknumbers:
+		if len(self.doneblocks) == len(self.sharesetsofblock):
+			self.finished.set()
+			with self.condition:
+				self.condition.notify_all()
 
-							index = min(int(blocknumber/self.chunklen), self.privacythreshold-1)
 
-							# let's check the hash...
-							resultingblockhash = lib.find_hash(resultingblockdict[index], self.manifestdict['hashalgorithm'])
-							if resultingblockhash != self.manifestdict['blockhashlist'][blocknumber]:
-								print(mirror)
-								# TODO: We should notify the vendor!
-								raise Exception('Should notify vendor that one of the mirrors or manifest is corrupt, for blocknumber ' + str(blocknumber))
+	def return_mirrorstats(self):
+		"""returns the statistics of all mirrors that were used, slow ones count as failed"""
+		stats = []
+		for mirror in self.activemirrors + self.backupmirrors:
+			if mirror in self.slowmirrors:
+				stats.append((mirror.info, None, None))
+			else:
+				stats.append(mirror.return_stats())
+		return stats
 
-							# otherwise, let's put this in the finishedblockdict
-							self.finishedblockdict[blocknumber] = resultingblockdict[index]
 
+	def _threshold(self):
+		"""private helper, the reply latency above which a mirror is slow, or
+		None if there are not enough measurements yet"""
+		with self.tablelock:
+			if len(self.latencies) < HEDGE_MIN_SAMPLES:
+				return None
+			latencies = sorted(self.latencies)
 
-						# it should be safe to delete this
-						del self.returnedxorblocksdict[blocknumbers[0]]
+		index = min(len(latencies) - 1, int(len(latencies) * self.hedgepercentile / 100.0))
+		return max(latencies[index], HEDGE_MIN_DELAY)
 
+
+	def _hedge_slow_mirrors(self):
+		"""private helper, checks for slow mirrors and requests their blocks again"""
+		threshold = self._threshold()
+		if threshold == None:
+			return
+
+		now = _timer()
+		for mirror in self.activemirrors + self.backupmirrors:
+			if mirror in self.slowmirrors:
+				continue
+
+			if mirror.rt == None:
+				# not connected yet
+				waitingsince = mirror.lastreply
+			else:
+				try:
+					(_, _, sendtime) = mirror.blocksrequested[0]
+				except IndexError:
+					# nothing outstanding
+					continue
+				waitingsince = max(sendtime, mirror.lastreply)
+
+			if now - waitingsince > threshold:
+				# too slow, nothing is sent to it anymore
+				with self.condition:
+					self.slowmirrors.append(mirror)
+					self.condition.notify_all()
+
+		# hedge everything the slow mirrors still owe. This is repeated on every
+		# check, the sending thread may have sent another query meanwhile.
+		for mirror in self.slowmirrors:
+			owed = _snapshot(mirror.blocksrequested) + _snapshot(mirror.queries)
+
+			for (blocknum, shareset, _) in owed:
+				if blocknum not in self.doneblocks and (blocknum, shareset) not in self.hedged:
+					if not self._hedge(blocknum, shareset):
+						# no backup mirrors left
 						return
 
 
-					#single block query:
-					else:
-					# remove the block and bitstring (asserting they match what we said before)
-						blocknumber = mirror['blocksrequested'].pop(0)
+	def _find_backup(self, excludedmirrors):
+		"""private helper, returns a mirror that is not slow and not excluded,
+		starting a new backup mirror if necessary. None if there is none."""
+		for mirror in self.activemirrors + self.backupmirrors:
+			if mirror not in self.slowmirrors and mirror not in excludedmirrors:
+				return mirror
 
-						# add the xorblock to the dict
-						self.returnedxorblocksdict[blocknumber].append(xorblock)
+		if len(self.backupmirrorinfolist) == 0:
+			return None
 
-						# if we don't have all of the pieces, continue
-						if len(self.returnedxorblocksdict[blocknumber]) != self.privacythreshold:
-							return
+		mirror = MirrorState(self.backupmirrorinfolist.pop(0), self.activemirrors[0].params, [])
+		self.backupmirrors.append(mirror)
+		self._start(mirror)
+		return mirror
 
-						# if we have all of the pieces, reconstruct it
-						resultingblock = _reconstruct_block(self.returnedxorblocksdict[blocknumber])
 
-						# let's check the hash...
-						resultingblockhash = lib.find_hash(resultingblock, self.manifestdict['hashalgorithm'])
-						if resultingblockhash != self.manifestdict['blockhashlist'][blocknumber]:
-							print(mirror)
-							# TODO: We should notify the vendor!
-							raise Exception('Should notify vendor that one of the mirrors or manifest is corrupt')
+	def _hedge(self, blocknum, shareset):
+		"""private helper, requests a block again with a fresh share set. Returns
+		False if there are not enough mirrors for that."""
 
-						# otherwise, let's put this in the finishedblockdict
-						self.finishedblockdict[blocknumber] = resultingblock
+		# the mirrors of the old share set that are not slow, plus backups
+		mirrors = [m for m in self.sharesetmirrors[shareset] if m not in self.slowmirrors]
+		while len(mirrors) < self.privacythreshold:
+			backup = self._find_backup(mirrors)
+			if backup == None:
+				return False
+			mirrors.append(backup)
 
-						# it should be safe to delete this
-						del self.returnedxorblocksdict[blocknumber]
-						return
+		shares = querypool_module.generate_query_shares(self.manifestdict['blockcount'], self.privacythreshold)
+		shares[-1] = lib.flip_bitstring_bit(shares[-1], blocknum)
+
+		with self.tablelock:
+			newshareset = len(self.sharesetmirrors)
+			self.sharesetmirrors[newshareset] = mirrors
+			self.sharesetsofblock[blocknum].append(newshareset)
+			self.hedged.add((blocknum, shareset))
+			self.hedgecount = self.hedgecount + 1
+
+		with self.condition:
+			for mirror, share in zip(mirrors, shares):
+				mirror.queries.append((blocknum, newshareset, share))
+			self.condition.notify_all()
+
+		return True
+
+
+	def _close_connections(self):
+		"""private helper, closes the connections to slow mirrors and cleans up the others"""
+		for mirror in self.activemirrors + self.backupmirrors:
+			with self.tablelock:
+				if mirror.rt == None:
+					# still connecting
+					self._abandon(mirror)
+					continue
 
-			raise Exception("InternalError: Unknown mirror in notify_success")
+			if mirror not in self.slowmirrors:
+				# let it deliver replies that are still outstanding
+				mirror.rt.join(HEDGE_DRAIN_TIMEOUT)
+
+			if mirror in self.slowmirrors or mirror.rt.is_alive() or self.error != None:
+				# we don't know in which state the connection is
+				self._abandon(mirror)
+				continue
 
-		finally:
-			# release the lock
-			self.tablelock.release()
 			if self.timing:
-				self.recons_time = self.recons_time + _timer() - stime
+				# request total computation time and measure delay
+				ping_start = _timer()
+				session.sendmessage(mirror.sock, "T")
+				mirror.comptime = float(session.recvmessage(mirror.sock)[1:])
+				mirror.ping = _timer() - ping_start
+
+			if self.connectionpool != None:
+				self.connectionpool.release(mirror.info, mirror.sock)
+			else:
+				session.sendmessage(mirror.sock, "Q")
+				mirror.sock.close()
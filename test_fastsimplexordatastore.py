@@ -122,4 +122,125 @@ for pos in range(len(aa)):
 
 assert result == cc
 
+# test fastsimplexordatastore.do_xor_multiple() against pairwise XORs
+for numstrings in [1, 2, 3, 7]:
+	strings = [urandom(xorlen) for _ in range(numstrings)]
+
+	result = strings[0]
+	for thisstring in strings[1:]:
+		result = fastsimplexordatastore.do_xor(result, thisstring)
+
+	assert fastsimplexordatastore.do_xor_multiple(strings) == result
+
+# strings that are shorter than an SSE register
+assert fastsimplexordatastore.do_xor_multiple([b'\x0f\xf0', b'\xff\xff', b'\x01\x00']) == b'\xf1\x0f'
+
+try:
+	fastsimplexordatastore.do_xor_multiple([aa, bb[1:]])
+except ValueError:
+	pass
+else:
+	print("didn't detect strings of unequal length")
+
+# the same with huge pages (transparent, or explicit with a fallback)
+for hugepages in ['transparent', 'explicit']:
+	hugexordatastore = fastsimplexordatastore.XORDatastore(size, num_blocks, "ram", "db_name", True, hugepages)
+	for char in range(65, 65 + num_blocks):
+		hugexordatastore.set_data((char - 65) * size, bytes([char]) * size)
+	hugexordatastore.finalize()
+	assert hugexordatastore.produce_xor_from_bitstring(b'\xa0\x01')[0] == ord('R')
+
+try:
+	fastsimplexordatastore.XORDatastore(size, num_blocks, "ram", "db_name", False, "gigantic")
+except TypeError:
+	pass
+else:
+	print("didn't detect an unknown huge page setting")
+
+# the mmap datastore reads a database file as written by raidpirlib
+import os
+import tempfile
+import raidpirlib
+
+dbname = tempfile.mkstemp()[1]
+dbfd, dboffset = raidpirlib._create_db_file(dbname, num_blocks, size)
+os.pwrite(dbfd, b''.join(bytes([char]) * size for char in range(65, 65 + num_blocks)), dboffset)
+
+# without the header (an incomplete database) the file is refused
+try:
+	fastsimplexordatastore.XORDatastore(size, num_blocks, "mmap", dbname)
+except ValueError:
+	pass
+else:
+	print("didn't detect a database without header")
+
+raidpirlib._write_db_header(dbfd, size, num_blocks, dboffset, 64 * '0')
+os.close(dbfd)
+
+assert raidpirlib.read_db_header(dbname)['dataoffset'] == 4096
+
+# the number of blocks must match
+try:
+	fastsimplexordatastore.XORDatastore(size, num_blocks * 2, "mmap", dbname)
+except ValueError:
+	pass
+else:
+	print("didn't detect a database with the wrong number of blocks")
+
+mmapxordatastore = fastsimplexordatastore.XORDatastore(size, num_blocks, "mmap", dbname, mmapadvice=['populate', 'willneed', 'sequential'])
+
+assert mmapxordatastore.get_data(size, 1) == b'B'
+
+# A, C, and P again, the flag for precomputed data is ignored
+assert mmapxordatastore.produce_xor_from_bitstring(b'\xa0\x01')[0] == ord('R')
+
+xorresult = mmapxordatastore.produce_xor_from_multiple_bitstrings(bitstring, 3)
+assert xorresult[0] == ord('R')
+assert xorresult[64] == ord('A')
+assert xorresult[128] == ord('V')
+
+# the tables of the C datastores grow, there can be many datastores at once
+mmapxordatastores = [fastsimplexordatastore.XORDatastore(size, num_blocks, "mmap", dbname) for _ in range(40)]
+assert mmapxordatastores[-1].get_data(size, 1) == b'B'
+del mmapxordatastores
+
+ramxordatastores = []
+for char in range(65, 65 + 40):
+	ramxordatastore = fastsimplexordatastore.XORDatastore(size, num_blocks, "RAM", None, True)
+	ramxordatastore.set_data(0, bytes([char]) * size)
+	ramxordatastore.finalize()
+	ramxordatastores.append(ramxordatastore)
+
+for char, ramxordatastore in zip(range(65, 65 + 40), ramxordatastores):
+	assert ramxordatastore.produce_xor_from_bitstring(b'\x80\x00')[0] == char
+del ramxordatastores
+
+os.remove(dbname)
+
+# a datastore that is split across NUMA nodes answers like a single one.
+# Pretend there are three nodes, the shards have 8, 8 and 1 blocks
+nodes = [os.sched_getaffinity(0)] * 3
+for use_precomputed_data in [False, True]:
+	shardedxordatastore = fastsimplexordatastore.ShardedXORDatastore(size, 17, nodes, use_precomputed_data)
+	assert len(shardedxordatastore.shards) == 3
+
+	# the letters A to Q, written across the shard boundaries
+	shardedxordatastore.set_data(0, b''.join(bytes([char]) * size for char in range(65, 65 + 17)))
+	assert shardedxordatastore.get_data(size * 8 - 1, 2) == b'HI'
+	assert shardedxordatastore.get_data(size * 16, 1) == b'Q'
+
+	shardedxordatastore.finalize()
+
+	# A, C, P and Q
+	assert shardedxordatastore.produce_xor_from_bitstring(b'\xa0\x01\x80')[0] == ord('A') ^ ord('C') ^ ord('P') ^ ord('Q')
+
+	# the extra bits of the last byte are ignored
+	assert shardedxordatastore.produce_xor_from_bitstring(b'\x00\x00\x7f') == bytes(size)
+
+	xorresult = shardedxordatastore.produce_xor_from_multiple_bitstrings(b'\xa0\x01\x00' + b'\x00\x00\x80', 2)
+	assert xorresult[0] == ord('R')
+	assert xorresult[size] == ord('Q')
+
+	shardedxordatastore.close()
+
 print("no news is good news. everything OK.")
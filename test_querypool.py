@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# tests of the query pool of the client.
+
+import os
+import tempfile
+
+import fastsimplexordatastore
+import querypool
+
+# the shares of a query XOR to zero, before the bit of a block is flipped
+for blockcount, privacythreshold in [(1, 2), (8, 2), (17, 3), (1000, 4)]:
+	shares = querypool.generate_query_shares(blockcount, privacythreshold)
+
+	assert len(shares) == privacythreshold
+	for share in shares:
+		assert len(share) == (blockcount + 7) // 8
+
+	assert fastsimplexordatastore.do_xor_multiple(shares) == bytes((blockcount + 7) // 8)
+
+# fill, take and len round trip
+poolname = tempfile.mkstemp()[1]
+os.remove(poolname)
+
+pool = querypool.QueryPool(poolname, 17, 3)
+assert len(pool) == 0
+assert pool.take(5) == []
+
+pool.fill(4)
+assert len(pool) == 4
+pool.fill(3)
+assert len(pool) == 7
+
+# a second pool object sees the same file
+samepool = querypool.QueryPool(poolname, 17, 3)
+assert len(samepool) == 7
+
+taken = pool.take(5)
+assert len(taken) == 5
+assert len(pool) == 2
+for shares in taken:
+	assert len(shares) == 3
+	assert fastsimplexordatastore.do_xor_multiple(shares) == bytes(3)
+
+# an entry is never handed out twice
+rest = samepool.take(5)
+assert len(rest) == 2
+assert len(pool) == 0
+assert pool.take(1) == []
+for shares in rest:
+	assert shares not in taken
+
+# an interrupted fill left an incomplete entry, it is not handed out
+pool.fill(1)
+with open(poolname, 'ab') as fd:
+	fd.write(b'\xff' * 4)
+assert len(pool) == 1
+pool.fill(1)
+assert len(pool) == 2
+for shares in pool.take(2):
+	assert fastsimplexordatastore.do_xor_multiple(shares) == bytes(3)
+
+# the pool was created for other parameters
+for blockcount, privacythreshold in [(16, 3), (17, 2)]:
+	try:
+		querypool.QueryPool(poolname, blockcount, privacythreshold)
+	except querypool.IncompatibleQueryPool:
+		pass
+	else:
+		print("didn't detect a pool for other parameters")
+
+# a fill was interrupted before the header was complete
+for partialheader in [b'', b'\x83']:
+	with open(poolname, 'wb') as fd:
+		fd.write(partialheader)
+
+	pool = querypool.QueryPool(poolname, 17, 3)
+	assert len(pool) == 0
+	assert pool.take(1) == []
+	pool.fill(1)
+	assert len(pool) == 1
+
+# not a pool at all
+with open(poolname, 'wb') as fd:
+	fd.write(b'\xc1' * 100)
+try:
+	querypool.QueryPool(poolname, 17, 3)
+except querypool.IncompatibleQueryPool:
+	pass
+else:
+	print("didn't detect a file that is not a pool")
+
+os.remove(poolname)
+
+print("no news is good news. everything OK.")
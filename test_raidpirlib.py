@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# tests of the manifest creation in raidpirlib.
+
+import contextlib
+import io
+import math
+import os
+import random
+import shutil
+import tempfile
+
+import raidpirlib
+
+# read and hash in small pieces, so the files and batches are split up
+raidpirlib._BUILDER_READSIZE = 4096
+
+
+def baseline_eqdist(fileinfolist, rootdir, blocksize, hashalgorithm):
+	"""the eqdist layout as it was before it was made near-linear. It adds the
+	offsets to the fileinfolist and returns the list of block hashes."""
+	db_length = 0
+	for thisfileinfo in fileinfolist:
+		db_length = db_length + thisfileinfo['length']
+
+	blockcount = int(math.ceil(db_length * 1.0 / blocksize))
+
+	free_blocks = list(range(1, blockcount))
+	currentoffset = 0
+	hashlist = [''] * blockcount
+	current_block_content = b''
+
+	for thisfileinfo in fileinfolist:
+		thisfileinfo['offsets'] = []
+
+		with open(os.path.join(rootdir, thisfileinfo['filename']), 'rb') as fd:
+			remainingbytes = thisfileinfo['length']
+			blocks_per_file = thisfileinfo['length'] * 1.0 / blocksize
+			block_steps = max(2, int(blockcount / blocks_per_file))
+
+			while remainingbytes > 0:
+				block_remaining_bytes = (blocksize - (currentoffset % blocksize))
+				thisfileinfo['offsets'].append(currentoffset)
+
+				bytes_to_add = min(remainingbytes, block_remaining_bytes)
+				remainingbytes -= bytes_to_add
+				currentoffset += bytes_to_add
+				current_block_content += fd.read(bytes_to_add)
+
+				if currentoffset % blocksize == 0 and len(free_blocks) != 0:
+					# the block is full, continue in the next free block after some steps
+					last_block = int(currentoffset / blocksize) - 1
+					hashlist[last_block] = raidpirlib.find_hash(current_block_content, hashalgorithm)
+					current_block_content = b''
+
+					block_candidate = (last_block + block_steps) % blockcount
+					while block_candidate not in free_blocks:
+						block_candidate += 1
+						if block_candidate == blockcount:
+							block_candidate = 0
+
+					free_blocks.remove(block_candidate)
+					currentoffset = block_candidate * blocksize
+
+	# the last block is padded to the full block size
+	current_block_content += (blocksize - (currentoffset % blocksize)) * b'\0'
+	hashlist[int(currentoffset / blocksize)] = raidpirlib.find_hash(current_block_content, hashalgorithm)
+
+	return hashlist
+
+
+def make_files(lengths):
+	"""creates a directory with files of these lengths, returns its name"""
+	rootdir = tempfile.mkdtemp()
+	for filenum, length in enumerate(lengths):
+		with open(os.path.join(rootdir, "file%04d" % filenum), 'wb') as fd:
+			fd.write(os.urandom(length))
+	return rootdir
+
+
+def create_manifest(rootdir, blocksize, layout, hashalgorithm="sha256-raw", database=None):
+	"""creates a manifest without printing the progress"""
+	with contextlib.redirect_stdout(io.StringIO()):
+		return raidpirlib.create_manifest(rootdir, hashalgorithm, blocksize, layout, "127.0.0.1", layoutchunks=3, database=database)
+
+
+random.seed(0)
+
+filesets = [
+	# a single file, with and without a partial last block
+	[64 * 5],
+	[64 * 5 + 1],
+	# files that end on block boundaries
+	[64, 128, 64 * 3],
+	# files smaller than a block
+	[1, 2, 3, 5, 7, 11, 13],
+	# random files of a few blocks each
+	[random.randint(1, 64 * 20) for _ in range(30)],
+	# one large file among small ones
+	[64 * 200 + 3] + [random.randint(1, 64) for _ in range(10)],
+]
+
+# the new eqdist layout puts the files into the same blocks as before.   The
+# baseline failed for releases that fill their last block exactly, those are
+# only checked below.
+for lengths in filesets:
+	if sum(lengths) % 64 == 0:
+		continue
+
+	rootdir = make_files(lengths)
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		fileinfolist = raidpirlib._generate_fileinfolist(rootdir)
+		blockhashlist = baseline_eqdist(fileinfolist, rootdir, 64, "sha256-raw")
+
+	manifestdict = create_manifest(rootdir, 64, "eqdist")
+
+	assert manifestdict['blockcount'] == len(blockhashlist)
+	assert manifestdict['blockhashlist'] == blockhashlist, lengths
+	assert manifestdict['fileinfolist'] == fileinfolist, lengths
+
+	shutil.rmtree(rootdir)
+
+# the single pass over the files computes the same file hashes as reading
+# every file on its own, and the block hashes match the database file
+for layout in ['nogaps', 'eqdist', 'roundrobin']:
+	for hashalgorithm in ['sha256-raw', 'sha1-hex']:
+		for lengths in filesets:
+			rootdir = make_files(lengths)
+			dbname = tempfile.mkstemp()[1]
+
+			manifestdict = create_manifest(rootdir, 64, layout, hashalgorithm, dbname)
+
+			for fileinfo in manifestdict['fileinfolist']:
+				assert fileinfo['hash'] == raidpirlib.find_hash_of_file(os.path.join(rootdir, fileinfo['filename']), hashalgorithm)
+
+			dataoffset = raidpirlib.read_db_header(dbname)['dataoffset']
+			with open(dbname, 'rb') as fd:
+				fd.seek(dataoffset)
+				for blocknum in range(manifestdict['blockcount']):
+					assert raidpirlib.find_hash(fd.read(64), hashalgorithm) == manifestdict['blockhashlist'][blocknum]
+
+			# the same manifest without a database
+			assert create_manifest(rootdir, 64, layout, hashalgorithm) == manifestdict
+
+			os.remove(dbname)
+			shutil.rmtree(rootdir)
+
+print("no news is good news. everything OK.")